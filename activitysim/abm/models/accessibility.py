@@ -10,6 +10,7 @@ from activitysim.core import tracing
 from activitysim.core import config
 from activitysim.core import inject
 from activitysim.core import pipeline
+from activitysim.core import skim
 
 
 logger = logging.getLogger(__name__)
@@ -94,7 +95,7 @@ class AccessibilitySkims(object):
 
             data = data[self.orig_map, :][:, self.dest_map]
 
-        return data.flatten()
+        return skim.upcast(data.flatten())
 
 
 @inject.step()
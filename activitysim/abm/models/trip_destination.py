@@ -135,7 +135,8 @@ def compute_ood_logsums(
         skims=od_skims,
         locals_d=locals_dict,
         chunk_size=chunk_size,
-        trace_label=trace_label)
+        trace_label=trace_label,
+        dedupe=logsum_settings.get('DEDUPE_CHOOSERS', False))
 
     assert logsums.index.equals(choosers.index)
 
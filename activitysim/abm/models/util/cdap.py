@@ -938,9 +938,12 @@ def run_cdap(
     rows_per_chunk, effective_chunk_size = \
         calc_rows_per_chunk(chunk_size, persons, trace_label=trace_label)
 
-    result_list = []
+    # chunk results are written into columns preallocated for all persons
+    # (chunks of households needn't be contiguous in persons, so rows are located by index)
+    sink = chunk.ChunkSink(persons.index, ordered=False)
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, persons_chunk in chunk.chunked_choosers_by_chunk_id(persons, rows_per_chunk):
+    for i, num_chunks, persons_chunk in \
+            chunk.chunked_choosers_by_chunk_id(persons, rows_per_chunk, chunk_size, trace_label):
 
         logger.info("Running chunk %s of %s with %d persons" % (i, num_chunks, len(persons_chunk)))
 
@@ -958,13 +961,10 @@ def run_cdap(
 
         chunk.log_close(chunk_trace_label)
 
-        result_list.append(cdap_results)
+        sink.append(cdap_results)
+        del cdap_results
 
-    # FIXME: this will require 2X RAM
-    # if necessary, could append to hdf5 store on disk:
-    # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        cdap_results = pd.concat(result_list)
+    cdap_results = sink.result()
 
     if trace_hh_id:
 
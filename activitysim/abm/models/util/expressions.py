@@ -161,18 +161,21 @@ def assign_columns(df, model_settings, locals_dict={}, trace_label=None):
 # helpers
 # ##################################################################################################
 
-def skim_time_period_label(time_period):
+def skim_time_period_label(time_period, as_category=False):
     """
     convert time period times to skim time period labels (e.g. 9 -> 'AM')
 
     Parameters
     ----------
     time_period : pandas Series
+    as_category : bool
+        return categorical rather than str labels (for columns only used as skim keys,
+        which skim stacks map to skims by category rather than row by row)
 
     Returns
     -------
     pandas Series
-        string time period labels
+        string (or categorical) time period labels
     """
 
     skim_time_periods = config.setting('skim_time_periods')
@@ -204,8 +207,10 @@ def skim_time_period_label(time_period):
                           skim_time_periods[period_label], right=True)[0] - 1
         return skim_time_periods['labels'][bin]
 
-    return pd.cut(time_period, skim_time_periods[period_label],
-                  labels=skim_time_periods['labels'], right=True).astype(str)
+    labels = pd.cut(time_period, skim_time_periods[period_label],
+                    labels=skim_time_periods['labels'], right=True)
+
+    return labels if as_category else labels.astype(str)
 
 
 def annotate_preprocessors(
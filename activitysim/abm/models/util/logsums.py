@@ -134,6 +134,7 @@ def compute_logsums(choosers,
         locals_d=locals_dict,
         chunk_size=chunk_size,
         trace_label=trace_label,
-        alt_col_name=dest_col_name)
+        alt_col_name=dest_col_name,
+        dedupe=logsum_settings.get('DEDUPE_CHOOSERS', False))
 
     return logsums
@@ -9,6 +9,7 @@ import numpy as np
 import pandas.testing as pdt
 
 from activitysim.core import inject
+from activitysim.core import timetable as tt
 
 from ..vectorize_tour_scheduling import get_previous_tour_by_tourid, \
     vectorize_tour_scheduling
@@ -77,3 +78,53 @@ def test_vts():
     # by the trip index.  shrug?
     expected = [2, 2, 2, 0, 0]
     assert (tdd_choices.values == expected).all()
+
+
+def test_vts_threads():
+
+    alts = pd.DataFrame({
+        "start": [1, 1, 2, 3, 2],
+        "end": [1, 4, 5, 6, 2]
+    })
+    alts['duration'] = alts.end - alts.start
+    inject.add_injectable("tdd_alts", alts)
+
+    tours = pd.DataFrame({
+        "person_id": [1, 1, 2, 3, 3, 4],
+        "tour_num": [1, 2, 1, 1, 2, 1],
+        "tour_type": ['x', 'y', 'y', 'x', 'y', 'x']
+    }, index=pd.Index([10, 11, 12, 13, 14, 15], name='tour_id'))
+
+    persons = pd.DataFrame({
+        "income": [20, 30, 25, 40]
+    }, index=pd.Index([1, 2, 3, 4], name='person_id'))
+    inject.add_table('persons', persons, replace=True)
+
+    spec = pd.DataFrame({"Coefficient": [0.1, 1.0]},
+                        index=["income", "duration"])
+    spec.index.name = "Expression"
+    tour_segments = {'x': {'spec': spec}, 'y': {'spec': -spec}}
+
+    inject.add_injectable("check_for_variability", False)
+    inject.add_injectable("trace_hh_id", None)
+    inject.add_injectable("traceable_table_ids", {})
+
+    results = []
+    for scheduling_threads in [1, 2]:
+
+        inject.add_injectable("settings", {'scheduling_threads': scheduling_threads})
+
+        timetable = tt.TimeTable(tt.create_timetable_windows(persons, alts), alts)
+
+        tdd_choices = vectorize_tour_scheduling(
+            tours, persons, alts, timetable,
+            tour_segments=tour_segments,
+            tour_segment_col='tour_type',
+            model_settings={},
+            chunk_size=0, trace_label='test_vts_threads')
+
+        results.append((tdd_choices, timetable.get_windows_df().copy()))
+
+    # choices are driven by utilities not rands, so threaded and serial results should be identical
+    pdt.assert_series_equal(results[0][0], results[1][0])
+    pdt.assert_frame_equal(results[0][1], results[1][1])
@@ -2,6 +2,8 @@
 # See full license in LICENSE.txt.
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 
@@ -110,7 +112,8 @@ def _compute_logsums(alt_tdd, tours_merged, tour_purpose, model_settings, trace_
         skims=skims,
         locals_d=locals_dict,
         chunk_size=0,
-        trace_label=trace_label)
+        trace_label=trace_label,
+        dedupe=logsum_settings.get('DEDUPE_CHOOSERS', False))
 
     return logsums
 
@@ -126,12 +129,17 @@ def compute_logsums(alt_tdd, tours_merged, tour_purpose, model_settings, trace_l
 
     For efficiency, rather compute a lot of redundant logsums, we compute logsums for the unique
     (out-period, in-period) pairs and then join them back to the alt_tdds.
+
+    Since logsum specs may also depend on tour duration (e.g. for parking costs) the alt_tdds of each
+    tour are deduped on (out_period, in_period, duration) by default. Models whose logsums only depend
+    on the skim periods can specify a coarser LOGSUM_TDD_KEY (e.g. [out_period, in_period]) in
+    model_settings to compute fewer logsums.
     """
     # - in_period and out_period
     assert 'out_period' not in alt_tdd
     assert 'in_period' not in alt_tdd
-    alt_tdd['out_period'] = expressions.skim_time_period_label(alt_tdd['start'])
-    alt_tdd['in_period'] = expressions.skim_time_period_label(alt_tdd['end'])
+    alt_tdd['out_period'] = expressions.skim_time_period_label(alt_tdd['start'], as_category=True)
+    alt_tdd['in_period'] = expressions.skim_time_period_label(alt_tdd['end'], as_category=True)
     alt_tdd['duration'] = alt_tdd['end'] - alt_tdd['start']
 
     USE_BRUTE_FORCE = False
@@ -140,23 +148,23 @@ def compute_logsums(alt_tdd, tours_merged, tour_purpose, model_settings, trace_l
         logsums = _compute_logsums(alt_tdd, tours_merged, tour_purpose, model_settings, trace_label)
         return logsums
 
-    # - get list of unique (tour_id, out_period, in_period, duration) in alt_tdd_periods
+    # - get list of unique (tour_id, <tdd_key>) in alt_tdd_periods
     # we can cut the number of alts roughly in half (for mtctm1) by conflating duplicates
-    index_name = alt_tdd.index.name
-    alt_tdd_periods = alt_tdd[['out_period', 'in_period', 'duration']]\
-        .reset_index().drop_duplicates().set_index(index_name)
+    tdd_key = model_settings.get('LOGSUM_TDD_KEY', ['out_period', 'in_period', 'duration'])
+    tdd_keys = alt_tdd[tdd_key].reset_index()
+    first_rows, row_codes = simulate.unique_rows(tdd_keys, tdd_keys.columns)
+
+    alt_tdd_periods = alt_tdd[['out_period', 'in_period', 'duration']].iloc[first_rows]
+
+    logger.debug("%s compute_logsums for %s unique of %s alt_tdds" %
+                 (trace_label, len(alt_tdd_periods.index), len(alt_tdd.index)))
 
     # - compute logsums for the alt_tdd_periods
-    alt_tdd_periods['logsums'] = \
+    period_logsums = \
         _compute_logsums(alt_tdd_periods, tours_merged, tour_purpose, model_settings, trace_label)
 
-    # - join the alt_tdd_period logsums to alt_tdd to get logsums for alt_tdd
-    logsums = pd.merge(
-        alt_tdd.reset_index(),
-        alt_tdd_periods.reset_index(),
-        on=[index_name, 'out_period', 'in_period', 'duration'],
-        how='left'
-    ).set_index(index_name).logsums
+    # - map the alt_tdd_period logsums back to alt_tdd to get logsums for alt_tdd
+    logsums = pd.Series(np.asanyarray(period_logsums)[row_codes], index=alt_tdd.index, name='logsums')
 
     return logsums
 
@@ -229,27 +237,21 @@ def tdd_interaction_dataset(tours, alts, timetable, choice_column, window_id_col
 
     """
 
-    alts_ids = np.tile(alts.index, len(tours.index))
-    tour_ids = np.repeat(tours.index, len(alts.index))
-    window_row_ids = np.repeat(tours[window_id_col], len(alts.index))
+    # enumerate only the available (tour, tdd alt) pairs rather than tiling every alt for
+    # every tour and slicing out the unavailable ones
+    tour_ixs, alts_ixs = timetable.available_tdds(tours[window_id_col], pd.Series(alts.index))
+    assert len(tour_ixs) > 0
+
+    alts_ids = alts.index.values[alts_ixs]
 
-    alt_tdd = alts.take(alts_ids)
+    alt_tdd = alts.take(alts_ixs)
 
-    alt_tdd.index = tour_ids
-    alt_tdd[window_id_col] = window_row_ids
+    alt_tdd.index = tours.index[tour_ixs]
 
     # add tdd alternative id
     # by convention, the choice column is the first column in the interaction dataset
     alt_tdd.insert(loc=0, column=choice_column, value=alts_ids)
 
-    # slice out all non-available tours
-    available = timetable.tour_available(alt_tdd[window_id_col], alt_tdd[choice_column])
-    assert available.any()
-    alt_tdd = alt_tdd[available]
-
-    # FIXME - don't need this any more after slicing
-    del alt_tdd[window_id_col]
-
     return alt_tdd
 
 
@@ -260,7 +262,8 @@ def _schedule_tours(
         timetable, window_id_col,
         previous_tour, tour_owner_id_col,
         estimator,
-        tour_trace_label):
+        tour_trace_label,
+        deferred_updates=None):
     """
     previous_tour stores values used to add columns that can be used in the spec
     which have to do with the previous tours per person.  Every column in the
@@ -299,6 +302,9 @@ def _schedule_tours(
         (person_id for non/mandatory tours, parent_tour_id for subtours,
         household_id for joint_tours)
     tour_trace_label
+    deferred_updates : list or None
+        if not None, previous_tour and timetable updates are appended to deferred_updates
+        (to be applied later by apply_schedule_updates) rather than applied
 
     Returns
     -------
@@ -371,14 +377,27 @@ def _schedule_tours(
     )
 
     # - update previous_tour and timetable parameters
+    updates = (tours[tour_owner_id_col], tours[window_id_col], choices)
+    if deferred_updates is None:
+        apply_schedule_updates([updates], previous_tour, timetable)
+    else:
+        deferred_updates.append(updates)
 
-    # update previous_tour (series with most recent previous tdd choices) with latest values
-    previous_tour.loc[tours[tour_owner_id_col]] = choices.values
+    return choices
 
-    # update timetable with chosen tdd footprints
-    timetable.assign(tours[window_id_col], choices)
 
-    return choices
+def apply_schedule_updates(updates, previous_tour, timetable):
+    """
+    apply list of (owner_ids, window_row_ids, choices) updates from _schedule_tours, in order
+    """
+
+    for owner_ids, window_row_ids, choices in updates:
+
+        # update previous_tour (series with most recent previous tdd choices) with latest values
+        previous_tour.loc[owner_ids] = choices.values
+
+        # update timetable with chosen tdd footprints
+        timetable.assign(window_row_ids, choices)
 
 
 def calc_rows_per_chunk(chunk_size, tours, persons_merged, alternatives, model_settings, trace_label=None):
@@ -434,7 +453,8 @@ def schedule_tours(
         timetable, timetable_window_id_col,
         previous_tour, tour_owner_id_col,
         estimator,
-        chunk_size, tour_trace_label):
+        chunk_size, tour_trace_label,
+        deferred_updates=None):
     """
     chunking wrapper for _schedule_tours
 
@@ -463,7 +483,7 @@ def schedule_tours(
 
     result_list = []
     for i, num_chunks, chooser_chunk \
-            in chunk.chunked_choosers(tours, rows_per_chunk):
+            in chunk.chunked_choosers(tours, rows_per_chunk, chunk_size, tour_trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -477,7 +497,8 @@ def schedule_tours(
                                   timetable, timetable_window_id_col,
                                   previous_tour, tour_owner_id_col,
                                   estimator,
-                                  tour_trace_label=chunk_trace_label)
+                                  tour_trace_label=chunk_trace_label,
+                                  deferred_updates=deferred_updates)
 
         chunk.log_close(chunk_trace_label)
 
@@ -496,6 +517,27 @@ def schedule_tours(
     return choices
 
 
+def scheduling_threads(tour_segments):
+    """
+    number of threads to use to schedule tour segments concurrently (scheduling_threads setting)
+
+    Since tracing and estimation write to shared files and tables, segments are scheduled
+    serially when tracing or estimating.
+    """
+
+    num_threads = config.setting('scheduling_threads', 1) or 1
+
+    if num_threads > 1:
+        if inject.get_injectable('trace_hh_id', None) is not None:
+            logger.info("scheduling_threads ignored since tracing")
+            num_threads = 1
+        elif any(segment_info.get('estimator') for segment_info in tour_segments.values()):
+            logger.info("scheduling_threads ignored since estimating")
+            num_threads = 1
+
+    return num_threads
+
+
 def vectorize_tour_scheduling(tours, persons_merged, alts, timetable,
                               tour_segments, tour_segment_col,
                               model_settings,
@@ -566,26 +608,39 @@ def vectorize_tour_scheduling(tours, persons_merged, alts, timetable,
     # second trip of type must be in group immediately following first
     # segregate scheduling by tour_type if multiple specs passed in dict keyed by tour_type
 
+    # segments of the same tour_num schedule disjoint persons' tours, so they can be scheduled
+    # concurrently, as long as timetable and previous_tour updates are deferred until all are done
+    num_threads = scheduling_threads(tour_segments) if tour_segment_col is not None else 1
+
     for tour_num, nth_tours in tours.groupby('tour_num', sort=True):
 
         tour_trace_label = tracing.extend_trace_label(trace_label, 'tour_%s' % (tour_num,))
 
         if tour_segment_col is not None:
 
+            segment_batches = []
             for tour_segment_name, tour_segment_info in tour_segments.items():
 
+                nth_tours_in_segment = nth_tours[nth_tours[tour_segment_col] == tour_segment_name]
+                if nth_tours_in_segment.empty:
+                    logger.info("skipping empty segment %s" % tour_segment_name)
+                    continue
+
+                segment_batches.append((tour_segment_name, tour_segment_info, nth_tours_in_segment))
+
+            num_workers = min(num_threads, len(segment_batches))
+
+            def schedule_segment(segment_batch, deferred_updates=None):
+
+                tour_segment_name, tour_segment_info, nth_tours_in_segment = segment_batch
+
                 segment_trace_label = tracing.extend_trace_label(tour_trace_label, tour_segment_name)
 
                 # assume segmentation of spec and logsum coefficients are aligned
                 spec_segment_name = tour_segment_info.get('spec_segment_name')
                 logsum_tour_purpose = spec_segment_name if compute_logsums else None
 
-                nth_tours_in_segment = nth_tours[nth_tours[tour_segment_col] == tour_segment_name]
-                if nth_tours_in_segment.empty:
-                    logger.info("skipping empty segment %s" % tour_segment_name)
-                    continue
-
-                choices = \
+                return \
                     schedule_tours(nth_tours_in_segment, persons_merged, alts,
                                    spec=tour_segment_info['spec'],
                                    logsum_tour_purpose=logsum_tour_purpose,
@@ -595,10 +650,29 @@ def vectorize_tour_scheduling(tours, persons_merged, alts, timetable,
                                    previous_tour=previous_tour_by_personid,
                                    tour_owner_id_col=tour_owner_id_col,
                                    estimator=tour_segment_info.get('estimator'),
-                                   chunk_size=chunk_size,
-                                   tour_trace_label=segment_trace_label)
+                                   # concurrent segments share chunk_size
+                                   chunk_size=chunk_size // num_workers if chunk_size else 0,
+                                   tour_trace_label=segment_trace_label,
+                                   deferred_updates=deferred_updates)
+
+            if num_workers > 1:
+
+                logger.info("%s scheduling %s segments in %s threads" %
+                            (tour_trace_label, len(segment_batches), num_workers))
+
+                deferred_updates = [[] for _ in segment_batches]
+                with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                    segment_choices = list(executor.map(schedule_segment, segment_batches, deferred_updates))
+
+                # apply updates in segment order so results don't depend on thread timing
+                for updates in deferred_updates:
+                    apply_schedule_updates(updates, previous_tour_by_personid, timetable)
+
+                choice_list.extend(segment_choices)
 
-                choice_list.append(choices)
+            else:
+                for segment_batch in segment_batches:
+                    choice_list.append(schedule_segment(segment_batch))
 
         else:
 
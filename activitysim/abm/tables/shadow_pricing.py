@@ -1,7 +1,6 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 import logging
-import time
 import multiprocessing
 import ctypes
 
@@ -54,7 +53,10 @@ we use the first two rows of the final column in numpy-wrapped shared data as 'r
 
 ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate zone counts
 (local_modeled_size summed across all sub-processes) using these two semaphores
-(which are really only tuples of indexes of locations in the shared data array.
+(which are really only tuples of indexes of locations in the shared data array.)
+
+The shared data buffer's lock is a multiprocessing.Condition, which processes wait on (releasing the
+lock) until another process changes a tally and notifies them.
 """
 TALLY_CHECKIN = (0, -1)
 TALLY_CHECKOUT = (1, -1)
@@ -84,7 +86,7 @@ class ShadowPriceCalculator(object):
         Presence of shared_data is used as a flag for multiprocessing
         If we are multiprocessing, shared_data should be a multiprocessing.RawArray buffer
         to aggregate modeled_size across all sub-processes, and shared_data_lock should be
-        a multiprocessing.Lock object to coordinate access to that buffer.
+        a multiprocessing.Condition object to coordinate access to that buffer.
 
         Optionally load saved shadow_prices from data_dir if config setting use_shadow_pricing
         and shadow_setting LOAD_SAVED_SHADOW_PRICES are both True
@@ -93,7 +95,7 @@ class ShadowPriceCalculator(object):
         ----------
         model_settings : dict
         shared_data : multiprocessing.Array or None (if single process)
-        shared_data_lock : numpy array wrapping multiprocessing.RawArray or None (if single process)
+        shared_data_lock : multiprocessing.Condition or None (if single process)
         """
 
         self.num_processes = num_processes
@@ -200,7 +202,9 @@ class ShadowPriceCalculator(object):
         zone counts are in shared data, we have to coordinate access to the data structure across
         sub-processes.
 
-        Note that all access to self.shared_data has to be protected by acquiring shared_data_lock
+        Note that all access to self.shared_data has to be protected by acquiring shared_data_lock,
+        which is a multiprocessing.Condition, so processes waiting on a tally sleep until another
+        process changes it and notifies them, rather than polling.
 
         ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate
         zone counts (local_modeled_size summed across all sub-processes).
@@ -233,42 +237,42 @@ class ShadowPriceCalculator(object):
         assert self.shared_data is not None
         assert self.num_processes > 1
 
-        def get_tally(t):
-            with self.shared_data_lock:
-                return self.shared_data[t]
-
         def wait(tally, target):
-            while get_tally(tally) != target:
-                time.sleep(1)
+            # releases shared_data_lock until notified that tally has changed, then reacquires it
+            self.shared_data_lock.wait_for(lambda: self.shared_data[tally] == target)
 
-        # - nobody checks in until checkout clears
-        wait(TALLY_CHECKOUT, 0)
+        def tally(t):
+            self.shared_data[t] += 1
+            self.shared_data_lock.notify_all()
 
-        # - add local_modeled_size data, increment TALLY_CHECKIN
         with self.shared_data_lock:
+
+            # - nobody checks in until checkout clears
+            wait(TALLY_CHECKOUT, 0)
+
+            # - add local_modeled_size data, increment TALLY_CHECKIN
             first_in = self.shared_data[TALLY_CHECKIN] == 0
             # add local data from df to shared data buffer
             # final column is used for tallys, hence the negative index
             self.shared_data[..., 0:-1] += local_modeled_size.values
-            self.shared_data[TALLY_CHECKIN] += 1
+            tally(TALLY_CHECKIN)
 
-        # - wait until everybody else has checked in
-        wait(TALLY_CHECKIN, self.num_processes)
+            # - wait until everybody else has checked in
+            wait(TALLY_CHECKIN, self.num_processes)
 
-        # - copy shared data, increment TALLY_CHECKIN
-        with self.shared_data_lock:
+            # - copy shared data, increment TALLY_CHECKOUT
             logger.info("copy shared_data")
             # numpy array with sum of local_modeled_size.values from all processes
             global_modeled_size_array = self.shared_data[..., 0:-1].copy()
-            self.shared_data[TALLY_CHECKOUT] += 1
+            tally(TALLY_CHECKOUT)
 
-        # - first in waits until all other processes have checked out, and cleans tub
-        if first_in:
-            wait(TALLY_CHECKOUT, self.num_processes)
-            with self.shared_data_lock:
+            # - first in waits until all other processes have checked out, and cleans tub
+            if first_in:
+                wait(TALLY_CHECKOUT, self.num_processes)
                 # zero shared_data, clear TALLY_CHECKIN, and TALLY_CHECKOUT semaphores
                 self.shared_data[:] = 0
-            logger.info("first_in clearing shared_data")
+                self.shared_data_lock.notify_all()
+                logger.info("first_in clearing shared_data")
 
         # convert summed numpy array data to conform to original dataframe
         global_modeled_size_df = \
@@ -619,8 +623,9 @@ def buffers_for_shadow_pricing(shadow_pricing_info):
     buffers are multiprocessing.Array (RawArray protected by a multiprocessing.Lock wrapper)
     We don't actually use the wrapped version as it slows access down and doesn't provide
     protection for numpy-wrapped arrays, but it does provide a convenient way to bundle
-    RawArray and an associated lock. (ShadowPriceCalculator uses the lock to coordinate access to
-    the numpy-wrapped RawArray.)
+    RawArray and an associated lock. The lock is a multiprocessing.Condition, which
+    ShadowPriceCalculator uses both to coordinate access to the numpy-wrapped RawArray and to
+    wait for other processes to update its tallies.
 
     Parameters
     ----------
@@ -650,7 +655,8 @@ def buffers_for_shadow_pricing(shadow_pricing_info):
         else:
             raise RuntimeError("buffer_for_shadow_pricing unrecognized dtype %s" % dtype)
 
-        shared_data_buffer = multiprocessing.Array(typecode, buffer_size)
+        # Condition has to be created before sub-processes are launched, as it can't be pickled later
+        shared_data_buffer = multiprocessing.Array(typecode, buffer_size, lock=multiprocessing.Condition())
 
         logger.info("buffer_for_shadow_pricing added block %s" % block_key)
 
@@ -681,8 +687,8 @@ def shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_sele
     Returns
     -------
     shared_data, shared_data_lock
-        shared_data : multiprocessing.Array or None (if single process)
-        shared_data_lock : numpy array wrapping multiprocessing.RawArray or None (if single process)
+        shared_data : numpy array wrapping multiprocessing.RawArray
+        shared_data_lock : multiprocessing.Condition
     """
 
     assert type(data_buffers) == dict
@@ -23,6 +23,9 @@ from activitysim.core import tracing
 
 logger = logging.getLogger(__name__)
 
+# multiprocessing.RawArray typecodes for integer skim dtypes by itemsize
+RAW_ARRAY_INT_TYPECODES = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
 """
 Read in the omx files and create the skim objects
 """
@@ -35,9 +38,11 @@ def get_skim_info(omx_file_path, tags_to_load=None):
     MAX_BLOCK_BYTES = sys.maxint - 1 if sys.version_info < (3,) else sys.maxsize - 1
 
     # Note: we load all skims except those with key2 not in tags_to_load
-    # Note: we require all skims to be of same dtype so they can share buffer - is that ok?
-    # fixme is it ok to require skims be all the same type? if so, is this the right choice?
+    # Note: skims in a block share a buffer so must all be of the same dtype
+    # skims are float32 unless a (possibly reduced precision) dtype is specified for their key1
+    # in the skim_dtypes setting (e.g. DRV_COM_WLK_BOARDS: int8) and are quantized as they are loaded
     skim_dtype = np.float32
+    skim_dtypes = config.setting('skim_dtypes', None) or {}
     omx_name = os.path.splitext(os.path.basename(omx_file_path))[0]
 
     with omx.open_file(omx_file_path) as omx_file:
@@ -90,34 +95,55 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         key2_dict = key1_subkeys.setdefault(key1, {})
         key2_dict[key2] = len(key2_dict)
 
+    # - dtype_key1s dict maps dtype to list of key1s of skims with that dtype
+    # float32: ['DIST', 'DISTWALK', ...],
+    # int8: ['DRV_COM_WLK_BOARDS', ...]
+    unknown_keys = set(skim_dtypes.keys()) - set(key1_subkeys.keys())
+    if unknown_keys:
+        logger.warning("get_skim_info skim_dtypes keys not in %s: %s" % (omx_name, unknown_keys))
+    dtype_key1s = OrderedDict()
+    for key1 in key1_subkeys:
+        dtype = np.dtype(skim_dtypes.get(key1, skim_dtype))
+        dtype_key1s.setdefault(dtype, []).append(key1)
+
     # - blocks dict maps block name to blocksize (number of subkey skims in block)
     # skims_0: 198,
     # skims_1: 198, ...
+    # - block_dtypes dict maps block name to dtype of skims in block
+    # skims_0: float32, ...
     # - key1_block_offsets dict maps key1 to (block, offset) of first skim with that key1
     # DISTWALK: (0, 2),
     # DRV_COM_WLK_BOARDS: (0, 3), ...
 
-    if MAX_BLOCK_BYTES:
-        max_block_items = MAX_BLOCK_BYTES // np.dtype(skim_dtype).itemsize
-        max_skims_per_block = max_block_items // multiply_large_numbers(omx_shape)
-    else:
-        max_skims_per_block = num_skims
-
     def block_name(block):
         return "skim_%s_%s" % (omx_name, block)
 
     key1_block_offsets = OrderedDict()
     blocks = OrderedDict()
-    block = offset = 0
-    for key1, v in key1_subkeys.items():
-        num_subkeys = len(v)
-        if offset + num_subkeys > max_skims_per_block:  # next block
-            blocks[block_name(block)] = offset
+    block_dtypes = OrderedDict()
+    block = 0
+    for dtype, key1s in dtype_key1s.items():
+
+        if MAX_BLOCK_BYTES:
+            max_block_items = MAX_BLOCK_BYTES // dtype.itemsize
+            max_skims_per_block = max_block_items // multiply_large_numbers(omx_shape)
+        else:
+            max_skims_per_block = num_skims
+
+        if blocks:  # skims of different dtypes can't share a block
             block += 1
-            offset = 0
-        key1_block_offsets[key1] = (block, offset)
-        offset += num_subkeys
-    blocks[block_name(block)] = offset  # last block
+        offset = 0
+        for key1 in key1s:
+            num_subkeys = len(key1_subkeys[key1])
+            if offset + num_subkeys > max_skims_per_block:  # next block
+                blocks[block_name(block)] = offset
+                block_dtypes[block_name(block)] = dtype
+                block += 1
+                offset = 0
+            key1_block_offsets[key1] = (block, offset)
+            offset += num_subkeys
+        blocks[block_name(block)] = offset  # last block of dtype
+        block_dtypes[block_name(block)] = dtype
 
     # - block_offsets dict maps skim_key to (block, offset) of omx matrix
     # DIST: (0, 0),
@@ -138,8 +164,8 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         block_offsets[skim_key] = (block, key1_offset + key2_relative_offset)
 
     logger.debug("get_skim_info from %s" % (omx_file_path, ))
-    logger.debug("get_skim_info skim_dtype %s omx_shape %s num_skims %s num_blocks %s" %
-                 (skim_dtype, omx_shape, num_skims, len(blocks)))
+    logger.debug("get_skim_info skim_dtypes %s omx_shape %s num_skims %s num_blocks %s" %
+                 (list(dtype_key1s.keys()), omx_shape, num_skims, len(blocks)))
 
     skim_info = {
         'omx_name': omx_name,
@@ -152,6 +178,7 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         'key1_block_offsets': key1_block_offsets,
         'block_offsets': block_offsets,
         'blocks': blocks,
+        'block_dtypes': block_dtypes,
     }
 
     return skim_info
@@ -159,13 +186,15 @@ def get_skim_info(omx_file_path, tags_to_load=None):
 
 def buffers_for_skims(skim_info, shared=False):
 
-    skim_dtype = skim_info['dtype']
     omx_shape = skim_info['omx_shape']
     blocks = skim_info['blocks']
+    block_dtypes = skim_info['block_dtypes']
 
     skim_buffers = {}
     for block_name, block_size in blocks.items():
 
+        skim_dtype = block_dtypes[block_name]
+
         # buffer_size must be int, not np.int64
         buffer_size = int(multiply_large_numbers(omx_shape) * block_size)
 
@@ -179,6 +208,11 @@ def buffers_for_skims(skim_info, shared=False):
                 typecode = 'd'
             elif np.issubdtype(skim_dtype, np.float32):
                 typecode = 'f'
+            elif np.issubdtype(skim_dtype, np.float16):
+                # no ctypes float16, so allocate as int16 of same itemsize
+                typecode = 'h'
+            elif skim_dtype.kind in 'iu' and skim_dtype.itemsize in RAW_ARRAY_INT_TYPECODES:
+                typecode = RAW_ARRAY_INT_TYPECODES[skim_dtype.itemsize]
             else:
                 raise RuntimeError("buffers_for_skims unrecognized dtype %s" % skim_dtype)
 
@@ -196,15 +230,15 @@ def skim_data_from_buffers(skim_buffers, skim_info):
     assert type(skim_buffers) == dict
 
     omx_shape = skim_info['omx_shape']
-    skim_dtype = skim_info['dtype']
     blocks = skim_info['blocks']
+    block_dtypes = skim_info['block_dtypes']
 
     skim_data = []
     for block_name, block_size in blocks.items():
         skims_shape = omx_shape + (block_size,)
         block_buffer = skim_buffers[block_name]
         assert len(block_buffer) == int(multiply_large_numbers(skims_shape))
-        block_data = np.frombuffer(block_buffer, dtype=skim_dtype).reshape(skims_shape)
+        block_data = np.frombuffer(block_buffer, dtype=block_dtypes[block_name]).reshape(skims_shape)
         skim_data.append(block_data)
 
     return skim_data
@@ -218,6 +252,50 @@ def build_skim_cache_file_name(omx_name, block):
     return f"cached_{omx_name}_{block}.mmap"
 
 
+def memmap_skim_cache(skim_info):
+    """
+        return list of read-only memmapped skim data blocks from canonically named cache file(s)
+
+        Unlike read_skim_cache, the cached data is not copied into skim buffers, so only the pages
+        of the cache files actually touched by skim lookups are read, and (since the os page cache
+        is shared) multiprocess sub-processes share a single in-memory copy of the skims.
+    """
+
+    skim_cache_dir = config.setting('skim_cache_dir', default_skim_cache_dir())
+    logger.info(f"skim_dict memmapping skims data from cache directory {skim_cache_dir}")
+
+    omx_name = skim_info['omx_name']
+    omx_shape = skim_info['omx_shape']
+    block_dtypes = skim_info['block_dtypes']
+
+    skim_data = []
+    blocks = skim_info['blocks']
+    block = 0
+    for block_name, block_size in blocks.items():
+        skim_cache_file_name = build_skim_cache_file_name(omx_name, block)
+        skim_cache_path = os.path.join(skim_cache_dir, skim_cache_file_name)
+
+        assert os.path.isfile(skim_cache_path), \
+            "memmap_skim_cache could not find skim_cache_path: %s" % (skim_cache_path, )
+
+        skims_shape = omx_shape + (block_size,)
+        logger.info(f"skim_dict memmapping block_name {block_name} {skims_shape} from {skim_cache_file_name}")
+
+        data = np.memmap(skim_cache_path, shape=skims_shape, dtype=block_dtypes[block_name], mode='r')
+        skim_data.append(data)
+
+        block += 1
+
+    return skim_data
+
+
+def use_memmap_skim_cache():
+    """
+        True if skims should be memmapped directly from the skim cache rather than loaded into buffers
+    """
+    return bool(config.setting('read_skim_cache') and config.setting('memmap_skim_cache'))
+
+
 def read_skim_cache(skim_info, skim_data):
     """
         read cached memmapped skim data from canonically named cache file(s) in output directory into skim_data
@@ -227,7 +305,7 @@ def read_skim_cache(skim_info, skim_data):
     logger.info(f"load_skims reading skims data from cache directory {skim_cache_dir}")
 
     omx_name = skim_info['omx_name']
-    dtype = np.dtype(skim_info['dtype'])
+    block_dtypes = skim_info['block_dtypes']
 
     blocks = skim_info['blocks']
     block = 0
@@ -242,7 +320,7 @@ def read_skim_cache(skim_info, skim_data):
 
         logger.info(f"load_skims reading block_name {block_name} {block_data.shape} from {skim_cache_file_name}")
 
-        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=dtype, mode='r')
+        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=block_dtypes[block_name], mode='r')
         assert data.shape == block_data.shape
 
         block_data[::] = data[::]
@@ -259,7 +337,7 @@ def write_skim_cache(skim_info, skim_data):
     logger.info(f"load_skims writing skims data to cache directory {skim_cache_dir}")
 
     omx_name = skim_info['omx_name']
-    dtype = np.dtype(skim_info['dtype'])
+    block_dtypes = skim_info['block_dtypes']
 
     blocks = skim_info['blocks']
     block = 0
@@ -271,20 +349,52 @@ def write_skim_cache(skim_info, skim_data):
 
         logger.info(f"load_skims writing block_name {block_name} {block_data.shape} to {skim_cache_file_name}")
 
-        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=dtype, mode='w+')
+        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=block_dtypes[block_name], mode='w+')
         data[::] = block_data
 
         block += 1
 
 
-def read_skims_from_omx(skim_info, skim_data, omx_file_path):
+def quantize_skim(omx_data, dtype, skim_key):
+    """
+    return omx skim data (floats) quantized to (possibly reduced precision) skim dtype
+
+    integer skims are rounded to the nearest integer and clipped to the range of dtype,
+    with a warning if that changes any values by more than rounding error
+    (float skims are simply cast to dtype)
+    """
+
+    dtype = np.dtype(dtype)
+
+    if dtype.kind not in 'iu' or omx_data.size == 0:
+        return omx_data
+
+    if np.isnan(omx_data).any():
+        logger.warning("quantize_skim %s has nan values that can't be represented as %s" % (skim_key, dtype))
+
+    dtype_info = np.iinfo(dtype)
+    quantized = np.clip(np.round(omx_data), dtype_info.min, dtype_info.max)
+
+    max_error = np.nanmax(np.abs(quantized - omx_data))
+    if max_error > 0.5:
+        logger.warning("quantize_skim %s to %s max error %s" % (skim_key, dtype, max_error))
+
+    return quantized.astype(dtype)
+
+
+def read_skims_from_omx(skim_info, skim_data, omx_file_path, skim_keys=None):
     """
     read skims from omx file into skim_data
+
+    if skim_keys is specified, only read the skims with those keys (e.g. to preload lazy skims)
     """
 
     block_offsets = skim_info['block_offsets']
     omx_keys = skim_info['omx_keys']
 
+    if skim_keys is not None:
+        omx_keys = OrderedDict((k, v) for k, v in omx_keys.items() if k in skim_keys)
+
     # read skims into skim_data
     with omx.open_file(omx_file_path) as omx_file:
         for skim_key, omx_key in omx_keys.items():
@@ -300,9 +410,66 @@ def read_skims_from_omx(skim_info, skim_data, omx_file_path):
 
             # this will trigger omx readslice to read and copy data to skim_data's buffer
             a = block_data[:, :, offset]
-            a[:] = omx_data[:]
+            a[:] = quantize_skim(omx_data[:], a.dtype, skim_key)
 
-    logger.info("load_skims loaded skims from %s" % (omx_file_path, ))
+    logger.info("load_skims loaded %s skims from %s" % (len(omx_keys), omx_file_path, ))
+
+
+def use_lazy_skims():
+    """
+        True if skims should be loaded from omx on first access rather than all loaded up front
+    """
+
+    if not config.setting('lazy_load_skims'):
+        return False
+
+    if config.setting('read_skim_cache') or config.setting('write_skim_cache'):
+        # skim cache files hold all skims
+        logger.warning("lazy_load_skims ignored since read_skim_cache or write_skim_cache is set")
+        return False
+
+    return True
+
+
+def lazy_skim_preload_keys(skim_info):
+    """
+        keys of skims listed in skim_usage_manifest (if any) to load before the first model runs
+
+        The manifest is a list of omx matrix names, one per line, as written to
+        skim_usage_manifest.txt by the track_skim_usage step of a prior run.
+    """
+
+    manifest_file_name = config.setting('skim_usage_manifest')
+    if not manifest_file_name:
+        return set()
+
+    manifest_file_path = config.data_file_path(manifest_file_name)
+    with open(manifest_file_path) as manifest_file:
+        omx_names = {line.strip() for line in manifest_file if line.strip()}
+
+    preload_keys = {k for k, omx_key in skim_info['omx_keys'].items() if omx_key in omx_names}
+
+    logger.info(f"preloading {len(preload_keys)} of {skim_info['num_skims']} skims "
+                f"listed in skim_usage_manifest {manifest_file_path}")
+
+    return preload_keys
+
+
+def omx_skim_loader(omx_file_path, skim_info):
+    """
+        return skim_loader function to lazily read skims from omx file (see SkimDict)
+    """
+
+    omx_keys = skim_info['omx_keys']
+
+    def skim_loader(skim_key, data):
+        omx_key = omx_keys[skim_key]
+        with omx.open_file(omx_file_path) as omx_file:
+            omx_data = omx_file[omx_key]
+            assert np.issubdtype(omx_data.dtype, np.floating)
+            data[:] = quantize_skim(omx_data[:], data.dtype, skim_key)
+
+    return skim_loader
 
 
 def load_skims(omx_file_path, skim_info, skim_buffers):
@@ -319,6 +486,10 @@ def load_skims(omx_file_path, skim_info, skim_buffers):
     if read_cache:
         read_skim_cache(skim_info, skim_data)
         t0 = tracing.print_elapsed_time("read_skim_cache", t0)
+    elif use_lazy_skims():
+        # remaining skims are read by skim_dict skim_loader on first access
+        read_skims_from_omx(skim_info, skim_data, omx_file_path, skim_keys=lazy_skim_preload_keys(skim_info))
+        t0 = tracing.print_elapsed_time("read_skims_from_omx (preload)", t0)
     else:
         read_skims_from_omx(skim_info, skim_data, omx_file_path)
         t0 = tracing.print_elapsed_time("read_skims_from_omx", t0)
@@ -339,16 +510,20 @@ def skim_dict(settings):
     # select the skims to load
     skim_info = get_skim_info(omx_file_path, tags_to_load)
 
-    logger.debug("omx_shape %s skim_dtype %s" % (skim_info['omx_shape'], skim_info['dtype']))
+    logger.debug("omx_shape %s skim_dtypes %s" % (skim_info['omx_shape'], set(skim_info['block_dtypes'].values())))
 
-    skim_buffers = inject.get_injectable('data_buffers', None)
-    if skim_buffers:
-        logger.info('Using existing skim_buffers for skims')
+    if use_memmap_skim_cache():
+        # zero-copy: skims are paged in from cache files on demand (and shared with other processes)
+        skim_data = memmap_skim_cache(skim_info)
     else:
-        skim_buffers = buffers_for_skims(skim_info, shared=False)
-        load_skims(omx_file_path, skim_info, skim_buffers)
+        skim_buffers = inject.get_injectable('data_buffers', None)
+        if skim_buffers:
+            logger.info('Using existing skim_buffers for skims')
+        else:
+            skim_buffers = buffers_for_skims(skim_info, shared=False)
+            load_skims(omx_file_path, skim_info, skim_buffers)
 
-    skim_data = skim_data_from_buffers(skim_buffers, skim_info)
+        skim_data = skim_data_from_buffers(skim_buffers, skim_info)
 
     block_names = list(skim_info['blocks'].keys())
     for i in range(len(skim_data)):
@@ -358,7 +533,13 @@ def skim_dict(settings):
                     (block_name, block_data.nbytes, util.GB(block_data.nbytes)))
 
     # create skim dict
-    skim_dict = skim.SkimDict(skim_data, skim_info)
+    if use_lazy_skims():
+        # skims preloaded by load_skims (either here or in mp_setup_skims) are already in skim_data
+        skim_dict = skim.SkimDict(skim_data, skim_info,
+                                  skim_loader=omx_skim_loader(omx_file_path, skim_info),
+                                  loaded_keys=lazy_skim_preload_keys(skim_info))
+    else:
+        skim_dict = skim.SkimDict(skim_data, skim_info)
 
     offset_map = skim_info['offset_map']
     if offset_map is not None:
@@ -2,8 +2,10 @@ from collections import OrderedDict
 
 
 import numpy as np
+import openmatrix as omx
 import pytest
 
+from activitysim.core import inject
 from activitysim.abm.tables import skims
 
 
@@ -65,3 +67,56 @@ def test_multiple_large_floats():
     calculated_value = skims.multiply_large_numbers([6205.1, 5423.2, 932.4, 15.4])
     actual_value = 483200518316.9472
     assert abs(calculated_value - actual_value) < 0.0001
+
+
+@pytest.fixture
+def skims_file(tmpdir):
+
+    data_dir = tmpdir.mkdir('data')
+    inject.add_injectable('data_dir', str(data_dir))
+    inject.add_injectable('output_dir', str(tmpdir.mkdir('output')))
+
+    rng = np.random.RandomState(0)
+    with omx.open_file(str(data_dir.join('skims.omx')), 'w') as omx_file:
+        omx_file['DIST'] = rng.uniform(0, 50, (4, 4))
+        for period in ['AM', 'PM']:
+            omx_file['TIME__%s' % period] = rng.uniform(0, 90, (4, 4))
+            omx_file['BOARDS__%s' % period] = rng.randint(0, 4, (4, 4)).astype(np.float32)
+
+    yield 'skims.omx'
+
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def test_memmap_skim_cache(skims_file):
+
+    settings = {
+        'skims_file': skims_file,
+        'skim_time_periods': {'labels': ['AM', 'PM']},
+        'skim_dtypes': {'BOARDS': 'int8'},
+    }
+
+    def load_skim_dict(**cache_settings):
+        inject.add_injectable('settings', dict(settings, **cache_settings))
+        return skims.skim_dict(inject.get_injectable('settings'))
+
+    omx_skim_dict = load_skim_dict(write_skim_cache=True)
+    cached_skim_dict = load_skim_dict(read_skim_cache=True)
+    memmap_skim_dict = load_skim_dict(read_skim_cache=True, memmap_skim_cache=True)
+
+    assert not any(isinstance(data, np.memmap) for data in cached_skim_dict.skim_data)
+    assert all(isinstance(data, np.memmap) for data in memmap_skim_dict.skim_data)
+
+    # skims of each dtype are in their own block
+    assert sorted(str(data.dtype) for data in memmap_skim_dict.skim_data) == ['float32', 'int8']
+
+    orig = np.array([1, 2, 3, 4, 1])
+    dest = np.array([4, 3, 2, 1, 1])
+    for key in omx_skim_dict.skim_info['omx_keys']:
+        expected = cached_skim_dict.get(key)
+        skim = memmap_skim_dict.get(key)
+        assert skim.data.dtype == expected.data.dtype == omx_skim_dict.get(key).data.dtype
+        np.testing.assert_array_equal(skim.data, expected.data)
+        np.testing.assert_array_equal(skim.data, omx_skim_dict.get(key).data)
+        np.testing.assert_array_equal(skim.get(orig, dest), expected.get(orig, dest))
@@ -3,7 +3,10 @@
 from builtins import zip
 from builtins import object
 
+import ast
 import logging
+import re
+import sys
 from collections import OrderedDict
 
 import numpy as np
@@ -15,6 +18,64 @@ from activitysim.core import pipeline
 
 logger = logging.getLogger(__name__)
 
+# compiled code objects for python (@) expressions keyed by expression text
+COMPILED_EXPRESSIONS = {}
+
+# (compiled code object, column names) for simple DataFrame.eval expressions keyed by
+# expression text (or None if expression is not simple enough to evaluate as python)
+COMPILED_DF_EXPRESSIONS = {}
+
+# python < 3.8 parses constants as Num, Str and NameConstant nodes (and < 3.9 wraps subscripts in Index)
+if sys.version_info < (3, 8):
+    CONSTANT_NODES = (ast.Num, ast.Str, ast.NameConstant)
+else:
+    CONSTANT_NODES = (ast.Constant, )
+
+# node types allowed in a DataFrame.eval expression that we evaluate ourselves as python
+# (pandas elementwise 'and', 'or', 'in', and chained comparisons have no numpy equivalent)
+SIMPLE_EXPRESSION_NODES = CONSTANT_NODES + (
+    ast.Expression, ast.Name, ast.Load, ast.BinOp, ast.UnaryOp, ast.Compare,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr, ast.Invert, ast.USub, ast.UAdd,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+
+def constant_value(node):
+    """
+    Return value of constant (or constant subscript) node, or None if node isn't a constant
+    """
+    if sys.version_info < (3, 9) and isinstance(node, ast.Index):
+        node = node.value
+    if sys.version_info < (3, 8):
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, ast.Str):
+            return node.s
+    if isinstance(node, CONSTANT_NODES):
+        return node.value
+    return None
+
+
+def is_bitwise(node):
+    return isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr))
+
+
+def mixes_bitwise_and_compare(tree):
+    """
+    True if tree has a comparison operand of, or operated on by, elementwise '&' or '|'
+
+    DataFrame.eval gives '&' and '|' lower precedence than comparisons (as for 'and' and 'or'),
+    so 'a > 1 & b' is '(a > 1) & b' in pandas but 'a > (1 & b)' in python. Parentheses are
+    lost in the tree, so we can't tell which was meant and leave all such expressions to pandas.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Compare) and any(is_bitwise(n) for n in [node.left] + node.comparators):
+            return True
+        if is_bitwise(node) and any(isinstance(n, ast.Compare) for n in (node.left, node.right)):
+            return True
+    return False
+
 
 def uniquify_key(dict, key, template="{} ({})"):
     """
@@ -149,6 +210,102 @@ def local_utilities():
     return utility_dict
 
 
+def expression_tokens(expressions):
+    """
+    Return set of all identifier-like tokens (including those in quoted strings) in expressions
+
+    Used to (conservatively) determine which column names and locals spec expressions refer to.
+    """
+    return set(re.findall(r'[A-Za-z_]\w*', ' '.join(expressions)))
+
+
+def compile_expression(expression):
+    """
+    Return (cached) compiled code object for python expression
+
+    Spec files are read once but their expressions are evaluated for every chunk of every
+    model (and segment) that uses them, so we only want to parse each expression once.
+
+    Parameters
+    ----------
+    expression : str
+        python expression (without any leading '@')
+
+    Returns
+    -------
+    code object suitable for eval
+    """
+
+    code = COMPILED_EXPRESSIONS.get(expression)
+    if code is None:
+        # eval strips leading and trailing spaces and tabs from expression strings, compile doesn't
+        code = compile(expression.strip(' \t'), '<expression>', 'eval')
+        COMPILED_EXPRESSIONS[expression] = code
+    return code
+
+
+def compile_df_expression(expression):
+    """
+    Return (cached) code object and column names for simple DataFrame.eval expression
+
+    Simple expressions are elementwise arithmetic and single comparisons of columns and constants
+    (e.g. 'income_segment * other' or "(tour_type == 'social') * start") which evaluate the same
+    in numpy as they do with DataFrame.eval. Returns None for expressions that aren't simple.
+    """
+
+    if expression not in COMPILED_DF_EXPRESSIONS:
+        compiled = None
+        try:
+            tree = ast.parse(expression.strip(' \t'), mode='eval')
+        except SyntaxError:
+            tree = None
+        if tree is not None and \
+                all(isinstance(node, SIMPLE_EXPRESSION_NODES) for node in ast.walk(tree)) and \
+                all(len(node.ops) == 1 for node in ast.walk(tree) if isinstance(node, ast.Compare)) and \
+                not mixes_bitwise_and_compare(tree) and \
+                all(isinstance(constant_value(node), (int, float, str)) for node in ast.walk(tree)
+                    if isinstance(node, CONSTANT_NODES)):
+            names = set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+            compiled = (compile(tree, '<expression>', 'eval'), names)
+        COMPILED_DF_EXPRESSIONS[expression] = compiled
+
+    return COMPILED_DF_EXPRESSIONS[expression]
+
+
+def eval_df_expression(expression, df):
+    """
+    Evaluate DataFrame.eval expression in the context of df
+
+    Simple expressions (see compile_df_expression) over numpy numeric, boolean and object columns are
+    evaluated directly on the column arrays with a cached compiled code object, which avoids
+    the per-call parsing overhead of DataFrame.eval. Anything else is passed to df.eval
+
+    Returns
+    -------
+    pandas.Series with same index as df
+    """
+
+    compiled = compile_df_expression(expression)
+
+    if compiled is not None and df.columns.is_unique:
+        code, names = compiled
+        # extension dtypes (e.g. categorical or nullable Int64) are left to df.eval
+        if all(name in df.columns and isinstance(df[name].dtype, np.dtype) and
+               (np.issubdtype(df[name].dtype, np.number) or df[name].dtype in (np.bool_, np.object_))
+               for name in names):
+            try:
+                values = eval(code, {}, {name: df[name].values for name in names})
+            except Exception:
+                # e.g. numpy refuses integer to negative integer power - let pandas have a go
+                values = None
+            if values is not None:
+                if np.isscalar(values):
+                    values = np.full(len(df.index), values)
+                return pd.Series(values, index=df.index)
+
+    return df.eval(expression)
+
+
 def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, trace_rows=None):
     """
     Evaluate a set of variable expressions from a spec in the context
@@ -243,7 +400,7 @@ def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, tra
 
         if is_temp_scalar(target) or is_throwaway(target):
             try:
-                x = eval(expression, globals(), _locals_dict)
+                x = eval(compile_expression(expression), globals(), _locals_dict)
             except Exception as err:
                 logger.error("assign_variables error: %s: %s", type(err).__name__, str(err))
                 logger.error("assign_variables expression: %s = %s", str(target), str(expression))
@@ -265,7 +422,7 @@ def assign_variables(assignment_expressions, df, locals_dict, df_alias=None, tra
 
             # FIXME should whitelist globals for security?
             globals_dict = {}
-            expr_values = to_series(eval(expression, globals_dict, _locals_dict))
+            expr_values = to_series(eval(compile_expression(expression), globals_dict, _locals_dict))
 
             np.seterr(**save_err)
             np.seterrcall(saved_handler)
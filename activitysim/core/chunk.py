@@ -3,25 +3,74 @@
 from builtins import input
 
 import logging
-from collections import OrderedDict
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
 import pandas as pd
 
 from . import util
 from . import mem
+from . import config
+from . import inject
 
 logger = logging.getLogger(__name__)
 
-# dict of table_dicts keyed by trace_label
-# table_dicts are dicts tuples of {table_name: (elements, bytes, mem), ...}
-CHUNK_LOG = OrderedDict()
+"""
+Adaptive chunking (adaptive_chunking setting)
 
-# array of chunk_size active CHUNK_LOG
-CHUNK_SIZE = []
-EFFECTIVE_CHUNK_SIZE = []
+Rather than relying only on the row_size estimated by each model's rows_per_chunk calculator, the
+chunked_choosers generators measure the actual row size of each chunk (the high water mark of the
+elements logged by log_df, per chooser row) and size the following chunks to fit chunk_size.
 
-HWM = [{}]
+Until a row size has been measured for a chunker's trace_label, its first chunk is a small probe
+chunk (PROBE_FRACTION of the estimated rows_per_chunk). Measured row sizes are saved in output_dir
+(ROW_SIZES_FILE_NAME) when the pipeline is closed, and used by rows_per_chunk in subsequent runs.
+
+Chunk threads (chunk_threads setting)
+
+Models that run their choosers in chunks can run up to chunk_threads chunks concurrently in
+threads (see run_chunks), in which case the chunks share chunk_size. Each thread has its own chunk
+log STATE, so row sizes are only measured for adaptive chunking when chunks are run serially.
+"""
+
+ADAPTIVE = False
+
+# trace_label -> chunk_size elements per chooser row (measured by this or previous runs)
+ROW_SIZES = {}
+# trace_labels whose row size was measured by this run (and should be saved)
+MEASURED = set()
+ROW_SIZES_LOCK = threading.Lock()
+
+ROW_SIZES_FILE_NAME = 'chunk_row_sizes.csv'
+
+PROBE_FRACTION = 0.1
+
+
+class ChunkLogState(threading.local):
+    """
+    chunk log state is per thread, so that chunkers running concurrently in threads
+    (e.g. tour scheduling segments) each have their own stack of active chunkers
+    """
+
+    def __init__(self):
+        # dict of table_dicts keyed by trace_label
+        # table_dicts are dicts tuples of {table_name: (elements, bytes, mem), ...}
+        self.CHUNK_LOG = OrderedDict()
+
+        # array of chunk_size active CHUNK_LOG
+        self.CHUNK_SIZE = []
+        self.EFFECTIVE_CHUNK_SIZE = []
+
+        self.HWM = [{}]
+
+        # elements high water mark of base chunkers closed since chunk generator last yielded
+        self.LAST_CHUNK_ELEMENTS = None
+
+
+STATE = ChunkLogState()
 
 
 def GB(bytes):
@@ -48,36 +97,39 @@ def commas(x):
 def log_open(trace_label, chunk_size, effective_chunk_size):
 
     # nested chunkers should be unchunked
-    if len(CHUNK_LOG) > 0:
+    if len(STATE.CHUNK_LOG) > 0:
         assert chunk_size == 0
-        assert trace_label not in CHUNK_LOG
+        assert trace_label not in STATE.CHUNK_LOG
 
     logger.debug("log_open chunker %s chunk_size %s effective_chunk_size %s" %
                  (trace_label, commas(chunk_size), commas(effective_chunk_size)))
 
-    CHUNK_LOG[trace_label] = OrderedDict()
-    CHUNK_SIZE.append(chunk_size)
-    EFFECTIVE_CHUNK_SIZE.append(effective_chunk_size)
+    STATE.CHUNK_LOG[trace_label] = OrderedDict()
+    STATE.CHUNK_SIZE.append(chunk_size)
+    STATE.EFFECTIVE_CHUNK_SIZE.append(effective_chunk_size)
 
-    HWM.append({})
+    STATE.HWM.append({})
 
 
 def log_close(trace_label):
 
-    assert CHUNK_LOG and next(reversed(CHUNK_LOG)) == trace_label
+    assert STATE.CHUNK_LOG and next(reversed(STATE.CHUNK_LOG)) == trace_label
 
     logger.debug("log_close %s" % trace_label)
 
     # if we are closing base level chunker
-    if len(CHUNK_LOG) == 1:
+    if len(STATE.CHUNK_LOG) == 1:
         log_write_hwm()
 
-    label, _ = CHUNK_LOG.popitem(last=True)
+        elements = STATE.HWM[1].get('elements', {}).get('mark', 0)
+        STATE.LAST_CHUNK_ELEMENTS = max(STATE.LAST_CHUNK_ELEMENTS or 0, elements)
+
+    label, _ = STATE.CHUNK_LOG.popitem(last=True)
     assert label == trace_label
-    CHUNK_SIZE.pop()
-    EFFECTIVE_CHUNK_SIZE.pop()
+    STATE.CHUNK_SIZE.pop()
+    STATE.EFFECTIVE_CHUNK_SIZE.pop()
 
-    HWM.pop()
+    STATE.HWM.pop()
 
 
 def log_df(trace_label, table_name, df):
@@ -86,10 +138,10 @@ def log_df(trace_label, table_name, df):
         # FIXME force_garbage_collect on delete?
         mem.force_garbage_collect()
 
-    cur_chunker = next(reversed(CHUNK_LOG))
+    cur_chunker = next(reversed(STATE.CHUNK_LOG))
 
     if df is None:
-        CHUNK_LOG.get(cur_chunker).pop(table_name)
+        STATE.CHUNK_LOG.get(cur_chunker).pop(table_name)
         op = 'del'
 
         logger.debug("log_df del %s : %s " % (table_name, trace_label))
@@ -110,7 +162,7 @@ def log_df(trace_label, table_name, df):
             logger.error("log_df %s unknown type: %s" % (table_name, type(df)))
             assert False
 
-        CHUNK_LOG.get(cur_chunker)[table_name] = (elements, bytes)
+        STATE.CHUNK_LOG.get(cur_chunker)[table_name] = (elements, bytes)
 
         # log this df
         logger.debug("log_df add %s elements: %s bytes: %s shape: %s : %s " %
@@ -129,7 +181,7 @@ def log_df(trace_label, table_name, df):
 
     info = "elements: %s bytes: %s mem: %s chunk_size: %s effective_chunk_size: %s" % \
            (commas(total_elements), GB(total_bytes), GB(cur_mem),
-            commas(CHUNK_SIZE[0]), commas(EFFECTIVE_CHUNK_SIZE[0]))
+            commas(STATE.CHUNK_SIZE[0]), commas(STATE.EFFECTIVE_CHUNK_SIZE[0]))
 
     check_hwm('elements', total_elements, info, hwm_trace_label)
     check_hwm('bytes', total_bytes, info, hwm_trace_label)
@@ -140,8 +192,8 @@ def _chunk_totals():
 
     total_elements = 0
     total_bytes = 0
-    for label in CHUNK_LOG:
-        tables = CHUNK_LOG[label]
+    for label in STATE.CHUNK_LOG:
+        tables = STATE.CHUNK_LOG[label]
         for table_name in tables:
             elements, bytes = tables[table_name]
             total_elements += elements
@@ -152,7 +204,7 @@ def _chunk_totals():
 
 def check_hwm(tag, value, info, trace_label):
 
-    for d in HWM:
+    for d in STATE.HWM:
 
         hwm = d.setdefault(tag, {})
 
@@ -164,7 +216,7 @@ def check_hwm(tag, value, info, trace_label):
 
 def log_write_hwm():
 
-    d = HWM[0]
+    d = STATE.HWM[0]
     for tag in d:
         hwm = d[tag]
         logger.debug("#chunk_hwm high_water_mark %s: %s (%s) in %s" %
@@ -180,15 +232,85 @@ def log_write_hwm():
                           hwm['info'], hwm['trace_label']))
 
     # if we are in a chunker
-    if len(HWM) > 1 and HWM[1]:
-        assert 'elements' in HWM[1]  # expect an 'elements' hwm dict for base chunker
-        hwm = HWM[1].get('elements')
-        check_chunk_size(hwm, EFFECTIVE_CHUNK_SIZE[0],  'effective_chunk_size', max_leeway=1.1)
-        check_chunk_size(hwm, CHUNK_SIZE[0], 'chunk_size', max_leeway=1)
+    if len(STATE.HWM) > 1 and STATE.HWM[1]:
+        assert 'elements' in STATE.HWM[1]  # expect an 'elements' hwm dict for base chunker
+        hwm = STATE.HWM[1].get('elements')
+        check_chunk_size(hwm, STATE.EFFECTIVE_CHUNK_SIZE[0],  'effective_chunk_size', max_leeway=1.1)
+        check_chunk_size(hwm, STATE.CHUNK_SIZE[0], 'chunk_size', max_leeway=1)
+
+
+def set_adaptive(adaptive):
+    """
+    Turn adaptive chunking on or off (set from adaptive_chunking setting when pipeline is opened)
+    and load the row sizes measured by previous runs
+    """
+    global ADAPTIVE
+
+    ADAPTIVE = bool(adaptive)
+
+    with ROW_SIZES_LOCK:
+        ROW_SIZES.clear()
+        MEASURED.clear()
+
+        if ADAPTIVE:
+            file_path = config.output_file_path(ROW_SIZES_FILE_NAME)
+            if os.path.exists(file_path):
+                ROW_SIZES.update(pd.read_csv(file_path, index_col='trace_label').row_size.to_dict())
+                logger.info("adaptive chunking loaded %s row sizes from %s" % (len(ROW_SIZES), file_path))
+
+
+def save_row_sizes():
+    """
+    Save row sizes measured by this run (when pipeline is closed), keeping those of other
+    trace_labels saved by previous runs (or other processes)
+    """
+
+    with ROW_SIZES_LOCK:
+        if not (ADAPTIVE and MEASURED):
+            return
+
+        file_path = config.output_file_path(ROW_SIZES_FILE_NAME)
+
+        row_sizes = {}
+        if os.path.exists(file_path):
+            row_sizes = pd.read_csv(file_path, index_col='trace_label').row_size.to_dict()
+        row_sizes.update({trace_label: ROW_SIZES[trace_label] for trace_label in MEASURED})
+
+        df = pd.DataFrame({'row_size': pd.Series(row_sizes, dtype=float)}).sort_index()
+        df.index.name = 'trace_label'
+
+        # other processes may be saving at the same time, so replace file rather than writing it in place
+        tmp_file_path = "%s.%s.tmp" % (file_path, os.getpid())
+        df.to_csv(tmp_file_path)
+        os.replace(tmp_file_path, file_path)
+
+        logger.debug("adaptive chunking saved %s measured row sizes to %s" % (len(MEASURED), file_path))
+
+
+def measure_row_size(trace_label, elements, rows):
+    """
+    record row_size of chunk of rows in which chunker trace_label logged elements (high water mark)
+    and return the largest row size measured for trace_label by this run
+    """
+
+    row_size = elements / float(rows)
+
+    with ROW_SIZES_LOCK:
+        if trace_label in MEASURED:
+            row_size = max(row_size, ROW_SIZES[trace_label])
+        ROW_SIZES[trace_label] = row_size
+        MEASURED.add(trace_label)
+
+    return row_size
 
 
 def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
 
+    if ADAPTIVE and chunk_size > 0 and trace_label in ROW_SIZES:
+        logger.debug("#chunk_calc adaptive row_size: %s (estimated row_size: %s) : %s" %
+                     (ROW_SIZES[trace_label], row_size, trace_label))
+        row_size = ROW_SIZES[trace_label]
+
     if chunk_size > 0:
         # closest number of chooser rows to achieve chunk_size without exceeding
         max_rpc = int(chunk_size / float(row_size))
@@ -208,22 +330,199 @@ def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
     return rpc, effective_chunk_size
 
 
-def chunked_choosers(choosers, rows_per_chunk):
+def adaptive_chunks(num_choosers, rows_per_chunk, chunk_size=0, trace_label=None):
+    """
+    generator of (i, num_chunks, offset, rows) of successive chunks of num_choosers rows
 
-    assert choosers.shape[0] > 0
+    chunks have rows_per_chunk rows, unless adaptive chunking, in which case the first chunk of a
+    trace_label whose row size hasn't been measured yet is a small probe chunk, and the following
+    chunks are sized to fit chunk_size, based on the row size measured (by log_df) in each chunk
+    """
 
-    # generator to iterate over choosers in chunk_size chunks
-    num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    adaptive = ADAPTIVE and chunk_size > 0 and trace_label is not None
+
+    rows = rows_per_chunk
+    if adaptive and trace_label not in ROW_SIZES:
+        rows = max(int(rows_per_chunk * PROBE_FRACTION), 1)
+        logger.debug("#chunk_calc adaptive probe chunk rows: %s : %s" % (rows, trace_label))
 
     i = offset = 0
     while offset < num_choosers:
-        yield i+1, num_chunks, choosers.iloc[offset: offset+rows_per_chunk]
-        offset += rows_per_chunk
+
+        rows = min(rows, num_choosers - offset)
+        remaining = num_choosers - offset - rows
+        num_chunks = i + 1 + (remaining // rows_per_chunk) + (remaining % rows_per_chunk > 0)
+
+        STATE.LAST_CHUNK_ELEMENTS = None
+
+        yield i+1, num_chunks, offset, rows
+
+        offset += rows
         i += 1
 
+        if adaptive and STATE.LAST_CHUNK_ELEMENTS:
+            row_size = measure_row_size(trace_label, STATE.LAST_CHUNK_ELEMENTS, rows)
+            rows_per_chunk = max(int(chunk_size / row_size), 1)
+            logger.debug("#chunk_calc adaptive row_size: %s rows_per_chunk: %s : %s" %
+                         (row_size, rows_per_chunk, trace_label))
+
+        rows = rows_per_chunk
+
 
-def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+def chunk_threads(chunk_size, estimator=None):
+    """
+    number of chunks to run concurrently in threads (chunk_threads setting)
+
+    Chunks are run serially if not chunking (which includes chunkers nested in another chunker),
+    and, since tracing and estimation write to shared files and tables, when tracing or estimating.
+    """
+
+    num_threads = config.setting('chunk_threads', 1) or 1
+
+    if num_threads > 1:
+        if chunk_size == 0:
+            num_threads = 1
+        elif inject.get_injectable('trace_hh_id', None) is not None:
+            logger.debug("chunk_threads ignored since tracing")
+            num_threads = 1
+        elif estimator:
+            logger.debug("chunk_threads ignored since estimating")
+            num_threads = 1
+
+    return num_threads
+
+
+def run_chunks(chunks, run_chunk, num_threads=1, sink=None):
+    """
+    Append results of run_chunk(*chunk) for each chunk yielded by chunks generator to sink
+    (in chunk order) and return sink (a list of results if sink is None, or e.g. a ChunkSink)
+
+    If num_threads > 1, up to num_threads chunks are run concurrently in threads. The next chunk
+    is only taken from the generator when a thread is free, so no more than num_threads chunks
+    are sliced at a time, and results are appended as soon as all earlier chunks' results have
+    been. An exception raised by any chunk is raised once running chunks finish.
+    """
+
+    sink = [] if sink is None else sink
+
+    if num_threads <= 1:
+        for c in chunks:
+            sink.append(run_chunk(*c))
+        return sink
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for c in chunks:
+            running = [future for future in pending if not future.done()]
+            if len(running) >= num_threads:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # raise exception (if any) now rather than after all chunks are run
+                    future.result()
+            while pending and pending[0].done():
+                sink.append(pending.popleft().result())
+            pending.append(executor.submit(run_chunk, *c))
+
+        while pending:
+            sink.append(pending.popleft().result())
+
+    return sink
+
+
+class ChunkSink(object):
+    """
+    Sink for chunk results that writes each chunk's rows into output columns preallocated for
+    all choosers, rather than holding the results of all chunks until they are concatenated
+    (when both the chunk results and their concatenation are in memory at once).
+
+    Chunk results are Series or DataFrames with a row for each chooser in the chunk. Columns are
+    allocated (for every row of index) when the first chunk is appended, and their dtypes
+    promoted if a later chunk needs it. If ordered, chunks must be appended in index order (as
+    they are by chunked_choosers and run_chunks), otherwise rows are located by index.
+
+    Results with columns that aren't numpy arrays (e.g. categoricals) are concatenated instead,
+    and the result of a single chunk (of all choosers) is returned as is.
+    """
+
+    def __init__(self, index, ordered=True):
+        self.index = index
+        self.ordered = ordered
+
+        self.rows = 0
+        self.is_series = None
+        self.columns = None
+        self.parts = None
+
+    def append(self, result):
+
+        if self.parts is not None:
+            self.parts.append(result)
+            return
+
+        is_series = isinstance(result, pd.Series)
+        if is_series:
+            values = OrderedDict([(result.name, result.values)])
+        else:
+            assert result.columns.is_unique
+            values = OrderedDict([(c, result[c].values) for c in result.columns])
+
+        if self.columns is None:
+            if len(result.index) == len(self.index) or not all(isinstance(v, np.ndarray) for v in values.values()):
+                # nothing to gain from copying result of a single chunk
+                self.parts = [result]
+                return
+            self.is_series = is_series
+            self.columns = OrderedDict([(c, np.empty(len(self.index), dtype=v.dtype)) for c, v in values.items()])
+
+        assert is_series == self.is_series and list(values.keys()) == list(self.columns.keys())
+
+        num_rows = len(result.index)
+        if self.ordered:
+            assert self.rows + num_rows <= len(self.index)
+            positions = slice(self.rows, self.rows + num_rows)
+        else:
+            positions = self.index.get_indexer(result.index)
+            assert (positions >= 0).all()
+
+        for c, v in values.items():
+            column = self.columns[c]
+            dtype = np.result_type(column.dtype, v.dtype)
+            if dtype != column.dtype:
+                column = self.columns[c] = column.astype(dtype)
+            column[positions] = v
+
+        self.rows += num_rows
+
+    def result(self):
+        """
+        Return Series or DataFrame (as appended) of results of all chunks
+        """
+
+        if self.parts is not None:
+            return pd.concat(self.parts) if len(self.parts) > 1 else self.parts[0]
+
+        assert self.columns is not None, "no chunk results"
+        assert self.rows == len(self.index)
+
+        if self.is_series:
+            name, values = next(iter(self.columns.items()))
+            return pd.Series(values, index=self.index, name=name)
+
+        return pd.DataFrame(self.columns, index=self.index, copy=False)
+
+
+def chunked_choosers(choosers, rows_per_chunk, chunk_size=0, trace_label=None):
+
+    assert choosers.shape[0] > 0
+
+    # generator to iterate over choosers in chunk_size chunks
+    num_choosers = len(choosers.index)
+
+    for i, num_chunks, offset, rows in adaptive_chunks(num_choosers, rows_per_chunk, chunk_size, trace_label):
+        yield i, num_chunks, choosers.iloc[offset: offset+rows]
+
+
+def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk, chunk_size=0, trace_label=None):
     """
     generator to iterate over choosers and alternatives in chunk_size chunks
 
@@ -244,6 +543,10 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     alternatives : pandas DataFrame
         sample alternatives including pick_count column in same order as choosers
     rows_per_chunk : int
+    chunk_size : int
+        chunk_size (for adaptive chunking)
+    trace_label : str
+        trace_label passed to rows_per_chunk (for adaptive chunking)
 
     Yields
     -------
@@ -271,37 +574,28 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     assert 'pick_count' in alternatives.columns or choosers.index.name == alternatives.index.name
 
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
 
     assert choosers.index.name == alternatives.index.name
 
     # alt chunks boundaries are where index changes
     alt_ids = alternatives.index.values
-    alt_chunk_end = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
-    alt_chunk_end = np.append([0], alt_chunk_end)  # including the first...
-    alt_chunk_end = alt_chunk_end[rows_per_chunk::rows_per_chunk]
+    alt_offsets = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
+    alt_offsets = np.append([0], alt_offsets)  # including the first...
 
-    # add index to end of array to capture any final partial chunk
-    alt_chunk_end = np.append(alt_chunk_end, [len(alternatives.index)])
+    # add index to end of array to capture final chooser's alts
+    alt_offsets = np.append(alt_offsets, [len(alternatives.index)])
 
-    i = offset = alt_offset = 0
-    while offset < num_choosers:
+    for i, num_chunks, offset, rows in adaptive_chunks(num_choosers, rows_per_chunk, chunk_size, trace_label):
 
-        alt_end = alt_chunk_end[i]
-
-        chooser_chunk = choosers[offset: offset + rows_per_chunk]
-        alternative_chunk = alternatives[alt_offset: alt_end]
+        chooser_chunk = choosers[offset: offset + rows]
+        alternative_chunk = alternatives[alt_offsets[offset]: alt_offsets[offset + rows]]
 
         assert len(chooser_chunk.index) == len(np.unique(alternative_chunk.index.values))
 
-        yield i+1, num_chunks, chooser_chunk, alternative_chunk
-
-        i += 1
-        offset += rows_per_chunk
-        alt_offset = alt_end
+        yield i, num_chunks, chooser_chunk, alternative_chunk
 
 
-def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
+def chunked_choosers_by_chunk_id(choosers, rows_per_chunk, chunk_size=0, trace_label=None):
     # generator to iterate over choosers in chunk_size chunks
     # like chunked_choosers but based on chunk_id field rather than dataframe length
     # (the presumption is that choosers has multiple rows with the same chunk_id that
@@ -311,11 +605,7 @@ def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
     assert choosers.shape[0] > 0
 
     num_choosers = choosers['chunk_id'].max() + 1
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
 
-    i = offset = 0
-    while offset < num_choosers:
-        chooser_chunk = choosers[choosers['chunk_id'].between(offset, offset + rows_per_chunk - 1)]
-        yield i+1, num_chunks, chooser_chunk
-        offset += rows_per_chunk
-        i += 1
+    for i, num_chunks, offset, rows in adaptive_chunks(num_choosers, rows_per_chunk, chunk_size, trace_label):
+        chooser_chunk = choosers[choosers['chunk_id'].between(offset, offset + rows - 1)]
+        yield i, num_chunks, chooser_chunk
@@ -0,0 +1,275 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+"""
+Cache of spec expression values, so that the same expression evaluated on the same chooser
+columns (e.g. '@df.income_in_thousands' or "@odt_skims['SOV_TIME']") by several models or
+logsum passes within a model step is only computed once.
+
+Cached values are keyed by expression text and a version (dtype and content digest) of every
+column the expression reads, so values are reused across differently chunked or merged tables
+and never survive a change to the columns they were computed from. Digesting a column costs
+about as much as evaluating a simple expression on it, so each column is only digested once per
+spec evaluation. The least recently used values are evicted to stay within the memory budget
+given by the expression_cache_size setting (in bytes, zero disables the cache), and the cache
+is cleared at every checkpoint.
+
+Only expressions whose inputs can be fully determined from the expression text are cached:
+simple DataFrame.eval expressions and python (@) expressions that only refer to df columns
+(as df.col or df['col']), scalar locals (constants), np and pd, and skim wrappers.
+"""
+
+import ast
+import builtins
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from activitysim.core.skim import SkimDictWrapper, SkimStackWrapper
+
+logger = logging.getLogger(__name__)
+
+
+# expression_key -> (values, is_series, list of weakrefs to arrays and skims the key refers to)
+CACHE = OrderedDict()
+CACHE_SIZE = 0
+CACHE_BYTES = 0
+STATS = {'hits': 0, 'misses': 0}
+
+# guards CACHE and CACHE_BYTES (expressions may be evaluated concurrently, e.g. by scheduling threads)
+LOCK = threading.Lock()
+
+# expression text -> (df column names, local names) or None if expression is not cacheable
+ANALYSIS = {}
+
+MODULES = {'np': np, 'pd': pd}
+
+
+def set_cache_size(cache_size):
+    """
+    Set memory budget (bytes) for cached values (set from expression_cache_size setting when
+    pipeline is opened), zero disables caching.
+    """
+    global CACHE_SIZE
+
+    CACHE_SIZE = cache_size or 0
+    clear()
+
+
+def clear():
+    """
+    Drop all cached expression values (e.g. at checkpoint when table columns may have changed)
+    """
+    global CACHE_BYTES
+
+    with LOCK:
+        if CACHE:
+            logger.debug("expression_cache clear %s entries %s bytes (%s hits %s misses)" %
+                         (len(CACHE), CACHE_BYTES, STATS['hits'], STATS['misses']))
+
+        CACHE.clear()
+        CACHE_BYTES = 0
+        STATS['hits'] = STATS['misses'] = 0
+
+
+def analyze(expression):
+    """
+    Return (df column names, local names) referenced by expression, or None if not cacheable
+
+    expression is either a python expression (starting with '@') or a DataFrame.eval expression
+    """
+
+    if expression in ANALYSIS:
+        return ANALYSIS[expression]
+
+    # import here to avoid circular import (assign imports pipeline, which imports us)
+    from activitysim.core import assign
+
+    analysis = None
+    if expression.startswith('@'):
+        try:
+            tree = ast.parse(expression[1:].strip(' \t'), mode='eval')
+        except SyntaxError:
+            tree = None
+        if tree is not None:
+            parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+            columns = set()
+            local_names = set()
+            cacheable = True
+            for node in ast.walk(tree):
+                if isinstance(node, (ast.Lambda, ast.comprehension, getattr(ast, 'NamedExpr', ()))):
+                    cacheable = False
+                elif isinstance(node, ast.Name) and node.id == 'df':
+                    parent = parents.get(node)
+                    if isinstance(parent, ast.Attribute):
+                        columns.add(parent.attr)
+                    elif isinstance(parent, ast.Subscript) and isinstance(assign.constant_value(parent.slice), str):
+                        columns.add(assign.constant_value(parent.slice))
+                    else:
+                        # df used in some way we can't follow
+                        cacheable = False
+                elif isinstance(node, ast.Name):
+                    local_names.add(node.id)
+            if cacheable:
+                analysis = (frozenset(columns), frozenset(local_names))
+    else:
+        compiled = assign.compile_df_expression(expression)
+        if compiled is not None:
+            analysis = (frozenset(compiled[1]), frozenset())
+
+    ANALYSIS[expression] = analysis
+    return analysis
+
+
+def column_version(df, column_name, column_versions):
+    """
+    Return version (content digest) of df column, or None if column can't be versioned
+
+    column_versions is a dict memoizing versions of columns already digested by the caller
+    (so columns shared by many expressions in a spec are only digested once per evaluation)
+    """
+
+    memo_key = (id(df), column_name)
+    if memo_key in column_versions:
+        return column_versions[memo_key]
+
+    version = None
+    if column_name in df.columns and df.columns.is_unique:
+        values = df[column_name].values
+        # object columns hold pointers, not content, so can't be versioned by digest
+        if isinstance(values, np.ndarray) and values.dtype != np.object_:
+            digest = hashlib.sha1(np.ascontiguousarray(values).view(np.uint8)).hexdigest()
+            version = (column_name, values.dtype.str, digest)
+        elif isinstance(values, pd.Categorical):
+            # e.g. skim time period labels (categories are part of the version)
+            digest = hashlib.sha1(np.ascontiguousarray(values.codes).view(np.uint8))
+            digest.update(repr(values.categories.tolist()).encode())
+            version = (column_name, 'category', digest.hexdigest())
+
+    column_versions[memo_key] = version
+    return version
+
+
+def expression_key(expression, df, locals_d, column_versions):
+    """
+    Return (key, refs) for expression evaluated on df with locals_d, or None if not cacheable
+
+    refs is a list of weakrefs to the skims (if any) the key refers to by id
+    """
+
+    analysis = analyze(expression)
+    if analysis is None:
+        return None
+    columns, local_names = analysis
+
+    refs = []
+    key = [expression, len(df.index)]
+
+    for c in sorted(columns):
+        version = column_version(df, c, column_versions)
+        if version is None:
+            return None
+        key.append(version)
+
+    for name in sorted(local_names):
+        if not locals_d or name not in locals_d:
+            # globals np and pd, or builtins like abs and min
+            if name in MODULES or hasattr(builtins, name):
+                key.append(name)
+                continue
+            return None
+        v = locals_d[name]
+        if name in MODULES and v is MODULES[name]:
+            key.append(name)
+        elif isinstance(v, (SkimDictWrapper, SkimStackWrapper)):
+            if v.df is None or len(v.df.index) != len(df.index):
+                return None
+            skims = v.skim_dict if isinstance(v, SkimDictWrapper) else v.stack
+            refs.append(weakref.ref(skims))
+            key.append((name, id(skims)))
+            for c in [v.left_key, v.right_key, getattr(v, 'skim_key', None)]:
+                if c is not None:
+                    version = column_version(v.df, c, column_versions)
+                    if version is None:
+                        return None
+                    key.append(version)
+        elif v is None or isinstance(v, (str, bool, int, float, np.number)):
+            key.append((name, type(v).__name__, v))
+        else:
+            # functions, tables, rng, etc.
+            return None
+
+    return tuple(key), refs
+
+
+def eval_expression(expression, df, locals_d, eval_func, column_versions):
+    """
+    Return eval_func() (value of expression evaluated on df with locals_d), from cache if possible
+
+    Parameters
+    ----------
+    expression : str
+        spec expression (python expressions start with '@')
+    df : pandas.DataFrame
+        table expression is evaluated on
+    locals_d : dict
+        locals for python expressions
+    eval_func : function
+        called with no arguments to evaluate expression
+    column_versions : dict
+        memo of column versions, shared by all expressions evaluated on the same df and locals
+
+    Returns
+    -------
+    value of expression (cached values are returned as copies, as Series with df.index or as ndarray)
+    """
+    global CACHE_BYTES
+
+    budget = CACHE_SIZE
+    if not budget:
+        return eval_func()
+
+    key_refs = expression_key(expression, df, locals_d, column_versions)
+    if key_refs is None:
+        return eval_func()
+    key, refs = key_refs
+
+    with LOCK:
+        entry = CACHE.get(key)
+        if entry is not None:
+            values, is_series, entry_refs = entry
+            if all(ref() is not None for ref in entry_refs):
+                CACHE.move_to_end(key)
+                STATS['hits'] += 1
+                # hand out a copy, so callers can't change cached values in place
+                values = values.copy()
+                return pd.Series(values, index=df.index) if is_series else values
+            # skims were freed and their id may have been reused
+            del CACHE[key]
+            CACHE_BYTES -= values.nbytes
+
+        STATS['misses'] += 1
+
+    v = eval_func()
+
+    is_series = isinstance(v, pd.Series)
+    values = v.values if is_series else v
+    if isinstance(values, np.ndarray) and values.shape == (len(df.index),) and values.nbytes <= budget:
+        # don't share changes to (or hold on to memory of a df column viewed by) value we return
+        values = values.copy()
+        values.setflags(write=False)
+        with LOCK:
+            previous = CACHE.pop(key, None)
+            if previous is not None:
+                CACHE_BYTES -= previous[0].nbytes
+            CACHE[key] = (values, is_series, refs)
+            CACHE_BYTES += values.nbytes
+            while CACHE_BYTES > budget:
+                _, (evicted, _, _) = CACHE.popitem(last=False)
+                CACHE_BYTES -= evicted.nbytes
+
+    return v
@@ -7,6 +7,9 @@ from . import orca
 _DECORATED_STEPS = {}
 _DECORATED_TABLES = {}
 _DECORATED_COLUMNS = {}
+# reinject_decorated_tables(keep_cached_injectables=True) keeps the cached values of these, which
+# relies on none of the cached decorated injectables (settings, skim_dict, etc.) being computed
+# from tables, as those are reinjected and would leave them stale
 _DECORATED_INJECTABLES = {}
 
 
@@ -125,9 +128,12 @@ def remove_injectable(name):
     orca._INJECTABLES.pop(name, None)
 
 
-def reinject_decorated_tables():
+def reinject_decorated_tables(keep_cached_injectables=False):
     """
     reinject the decorated tables (and columns)
+
+    If keep_cached_injectables, keep cached values of decorated injectables (e.g. skim_dict)
+    none of which are computed from tables, so they don't go stale when tables are reinjected.
     """
 
     logger.info("reinject_decorated_tables")
@@ -149,7 +155,10 @@ def reinject_decorated_tables():
 
     for name, args in _DECORATED_INJECTABLES.items():
         logger.debug("reinject decorated injectable %s" % name)
+        cached = orca._INJECTABLE_CACHE.get(name) if keep_cached_injectables and args['cache'] else None
         orca.add_injectable(name, args['func'], cache=args['cache'])
+        if cached is not None:
+            orca._INJECTABLE_CACHE[name] = cached
 
 
 def clear_cache():
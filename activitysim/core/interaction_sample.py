@@ -1,6 +1,5 @@
 # ActivitySim
 # See full license in LICENSE.txt.
-from builtins import range
 
 import logging
 
@@ -12,8 +11,13 @@ from activitysim.core.mem import force_garbage_collect
 
 from . import logit
 from . import tracing
+from . import assign
 from . import chunk
+from . import config
+from . import simulate
+from . import expression_cache
 from .simulate import set_skim_wrapper_targets
+from .skim import SkimDictWrapper, SkimStackWrapper
 
 
 from .interaction_simulate import eval_interaction_utilities
@@ -24,6 +28,167 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
+def spec_expressions(spec):
+
+    if isinstance(spec.index, pd.MultiIndex):
+        return spec.index.get_level_values(simulate.SPEC_EXPRESSION_NAME)
+    return spec.index
+
+
+def split_spec_terms(spec, choosers, alternatives, locals_d):
+    """
+    Split spec into the terms that only depend on alternatives, those that only depend on choosers,
+    and those that depend on both
+
+    An expression depends only on the alternatives if it is not a temp assignment and does not
+    refer to a temp, a skim wrapper, or a chooser column (chooser columns also present in
+    alternatives are referred to with a '_chooser' suffix in the interaction dataset).
+    Likewise, an expression depends only on the choosers if it doesn't refer to a temp, a skim
+    wrapper, an alternatives column, or the (alternatives) index of the interaction dataset.
+    The utilities of these terms are the same for every chooser (or alternative), so they can be
+    evaluated once per alternative (or chooser) rather than once per row of the cross join.
+
+    Returns
+    -------
+    alt_spec : pandas.DataFrame
+        spec rows with alternative-only expressions
+    chooser_spec : pandas.DataFrame
+        spec rows with chooser-only expressions
+    interaction_spec : pandas.DataFrame
+        spec rows with all other expressions
+    """
+
+    chooser_tokens = set(c + '_chooser' if c in alternatives.columns else c
+                         for c in choosers.columns)
+    alt_tokens = set(alternatives.columns) | {'index'}
+
+    skim_tokens = set()
+    for k, v in (locals_d or {}).items():
+        if isinstance(v, dict):
+            v = list(v.values())
+        if not isinstance(v, list):
+            v = [v]
+        if any(isinstance(w, (SkimDictWrapper, SkimStackWrapper)) for w in v):
+            skim_tokens.add(k)
+
+    def term_type(expr):
+        tokens = assign.expression_tokens([expr])
+        if expr.startswith('_') or tokens & skim_tokens or any(t.startswith('_') for t in tokens):
+            return 'interaction'
+        if not tokens & chooser_tokens:
+            return 'alternative'
+        if not tokens & alt_tokens:
+            return 'chooser'
+        return 'interaction'
+
+    term_types = np.array([term_type(expr) for expr in spec_expressions(spec)])
+
+    return spec[term_types == 'alternative'], spec[term_types == 'chooser'], spec[term_types == 'interaction']
+
+
+def referenced_columns(spec, choosers, alternatives, skims):
+    """
+    Return lists of choosers and alternatives columns needed to evaluate spec on interaction dataset
+
+    Includes the orig, dest (and time period) key columns of any skim wrappers in skims,
+    and keeps alternatives columns that clash with a referenced chooser column so that the
+    chooser column is still renamed with a '_chooser' suffix in the interaction dataset.
+    """
+
+    tokens = assign.expression_tokens(spec_expressions(spec))
+
+    if skims is not None:
+        if isinstance(skims, dict):
+            skims = list(skims.values())
+        elif not isinstance(skims, list):
+            skims = [skims]
+        for skim in skims:
+            if isinstance(skim, (SkimDictWrapper, SkimStackWrapper)):
+                tokens.update([skim.left_key, skim.right_key, getattr(skim, 'skim_key', None)])
+
+    chooser_columns = [c for c in choosers.columns
+                       if (c + '_chooser' if c in alternatives.columns else c) in tokens]
+    alt_columns = [c for c in alternatives.columns
+                   if c in tokens or (c in choosers.columns and c + '_chooser' in tokens)]
+
+    return chooser_columns, alt_columns
+
+
+def referenced_columns_known(spec, choosers, alternatives):
+    """
+    Return True if the interaction dataset columns every spec expression refers to can be
+    determined from the expression text (so the spec can be evaluated on a slim interaction
+    dataset), or False if any python expression refers to df in a way we can't follow
+    (e.g. df[col_name] with a column name from a local, df.eval(...) or a function of df)
+    """
+
+    interaction_columns = set(alternatives.columns) | \
+        set(c + '_chooser' if c in alternatives.columns else c for c in choosers.columns)
+
+    for expr in spec_expressions(spec):
+        if expr.startswith('_'):
+            # temp assignment (e.g. '_d@df.distance') rhs is a python expression
+            expr = expr[expr.index('@'):]
+        if not expr.startswith('@'):
+            # DataFrame.eval expressions can only refer to columns by name
+            continue
+        analysis = expression_cache.analyze(expr)
+        if analysis is None or not analysis[0] <= interaction_columns:
+            return False
+
+    return True
+
+
+def sample_positions(cum_probs_arr, rands):
+    """
+    Vectorized inverse-cdf sampling of all samples for all choosers at once.
+
+    Returns the same positions as np.argmax(cum_probs_arr > r, axis=1) for each column r of
+    rands (i.e. the position of the first cum_prob greater than r, or zero if there is none)
+    but uses a single searchsorted over the flattened cum_probs of all choosers rather than
+    a full pass over the (choosers x alternatives) array for each sample.
+
+    Parameters
+    ----------
+    cum_probs_arr : 2-D ndarray
+        one row per chooser and one (non-decreasing) cumulative probability per alternative
+    rands : 2-D ndarray
+        one row per chooser and one rand in [0, 1) per sample
+
+    Returns
+    -------
+    positions : 2-D ndarray of int
+        same shape as rands, with position of chosen alternative in cum_probs_arr row
+    """
+
+    num_choosers, alternative_count = cum_probs_arr.shape
+
+    # shift each chooser's cum_probs (in [0, 1]) by a different integer so they can be
+    # concatenated into a single sorted array and searched in one call
+    shift = 2.0 * np.arange(num_choosers).reshape(-1, 1)
+    row_offsets = alternative_count * np.arange(num_choosers).reshape(-1, 1)
+
+    flat_cum_probs = (cum_probs_arr + shift).ravel()
+    positions = np.searchsorted(flat_cum_probs, rands + shift, side='right') - row_offsets
+    del flat_cum_probs
+
+    # argmax returns zero if no cum_prob is greater than rand (e.g. due to roundoff)
+    positions[positions == alternative_count] = 0
+
+    # shifting may round away tiny differences between a rand and neighboring cum_probs,
+    # so verify that the choice is exact and fall back to argmax for the (rare) rows that aren't
+    rows = np.arange(num_choosers).reshape(-1, 1)
+    chosen_cum_probs = cum_probs_arr[rows, positions]
+    prev_cum_probs = cum_probs_arr[rows, np.maximum(positions - 1, 0)]
+    exact = (chosen_cum_probs > rands) & ((positions == 0) | (prev_cum_probs <= rands))
+    exact |= (positions == 0) & (cum_probs_arr[:, -1:] <= rands)
+
+    for i, j in zip(*np.nonzero(~exact)):
+        positions[i, j] = np.argmax(cum_probs_arr[i] > rands[i, j])
+
+    return positions
+
+
 def make_sample_choices(
         choosers, probs,
         alternatives,
@@ -47,7 +212,9 @@ def make_sample_choices(
 
     Returns
     -------
-
+    choices_df : pandas.DataFrame
+        one row per unique (chooser, alternative) pick, ordered by chooser and first draw,
+        with columns alt_col_name, rand, prob, pick_count and choosers.index.name
     """
 
     assert isinstance(probs, pd.DataFrame)
@@ -59,7 +226,8 @@ def make_sample_choices(
     if allow_zero_probs:
         zero_probs = (probs.sum(axis=1) == 0)
         if zero_probs.all():
-            return pd.DataFrame(columns=[alt_col_name, 'rand', 'prob', choosers.index.name])
+            return pd.DataFrame(columns=[alt_col_name, 'rand', 'prob', 'pick_count',
+                                         choosers.index.name])
         if zero_probs.any():
             # remove from sample
             probs = probs[~zero_probs]
@@ -67,58 +235,46 @@ def make_sample_choices(
 
     cum_probs_arr = probs.values.cumsum(axis=1)
 
-    # alt probs in convenient layout to return prob of chose alternative
-    # (same layout as cum_probs_arr)
-    alt_probs_array = probs.values.flatten()
-
     # get sample_size rands for each chooser
-    # transform as we iterate over alternatives
-    # reshape so rands[i] is in broadcastable (2-D) shape for cum_probs_arr
-    # i.e rands[i] is a 2-D array of one alt choice rand for each chooser
     rands = pipeline.get_rn_generator().random_for_df(probs, n=sample_size)
-    rands = rands.T.reshape(sample_size, -1, 1)
-
-    # the alternative value chosen
-    choices_array = np.empty([sample_size, len(choosers)]).astype(int)
-
-    # the probability of the chosen alternative
-    choice_probs_array = np.empty([sample_size, len(choosers)])
-
-    alts = np.tile(alternatives.index.values, len(choosers))
-
-    # FIXME - do this all at once rather than iterate?
-    for i in range(sample_size):
-
-        # FIXME - do this in numpy, not pandas?
-
-        # rands for this alt in broadcastable shape
-        r = rands[i]
-
-        # position of first occurrence of positive value
-        positions = np.argmax(cum_probs_arr > r, axis=1)
-
-        # FIXME - leave positions as numpy array, not pandas series?
-        # positions is series with the chosen alternative represented as a column index in probs
-        # which is an integer between zero and num alternatives in the alternative sample
-        positions = pd.Series(positions, index=probs.index)
-
-        # need to get from an integer offset into the alternative sample to the alternative index
-        # that is, we want the index value of the row that is offset by <position> rows into the
-        # tranche of this choosers alternatives created by cross join of alternatives and choosers
-
-        # offsets is the offset into model_design df of first row of chooser alternatives
-        offsets = np.arange(len(positions)) * alternative_count
 
-        # choices and choice_probs have one element per chooser and is in same order as choosers
-        choices_array[i] = np.take(alts, positions + offsets)
-        choice_probs_array[i] = np.take(alt_probs_array, positions + offsets)
-
-    # explode to one row per chooser.index, alt_TAZ
+    # positions has one row per chooser and one column per sample,
+    # with the chosen alternative represented as a column index in probs
+    positions = sample_positions(cum_probs_arr, rands)
+    del cum_probs_arr
+
+    # sort each chooser's picks by position (stable, so first pick of duplicates comes first)
+    # so duplicate picks are adjacent and we can count them without a groupby
+    order = np.argsort(positions, axis=1, kind='mergesort')
+    positions = np.take_along_axis(positions, order, axis=1).ravel()
+    rands = np.take_along_axis(rands, order, axis=1).ravel()
+    chooser_idx = np.repeat(np.arange(len(choosers)), sample_size)
+
+    # first pick of each (chooser, alt) run
+    first_pick = np.ones(len(positions), dtype=bool)
+    first_pick[1:] = (positions[1:] != positions[:-1]) | (chooser_idx[1:] != chooser_idx[:-1])
+    first_pick = np.flatnonzero(first_pick)
+
+    # pick_count is number of duplicate picks (length of run)
+    pick_count = np.diff(np.append(first_pick, len(positions)))
+
+    # put unique picks back in the order they were first drawn, as downstream
+    # choice among the sampled alternatives depends on their order
+    draw_order = np.argsort(chooser_idx[first_pick] * sample_size + order.ravel()[first_pick])
+    first_pick = first_pick[draw_order]
+    pick_count = pick_count[draw_order]
+    del order
+
+    positions = positions[first_pick]
+    chooser_idx = chooser_idx[first_pick]
+
+    # one row per chooser.index, unique alt
     choices_df = pd.DataFrame(
-        {alt_col_name: choices_array.flatten(order='F'),
-         'rand': rands.flatten(order='F'),
-         'prob': choice_probs_array.flatten(order='F'),
-         choosers.index.name: np.repeat(np.asanyarray(choosers.index), sample_size)
+        {alt_col_name: alternatives.index.values[positions],
+         'rand': rands[first_pick],
+         'prob': probs.values[chooser_idx, positions],
+         'pick_count': pick_count,
+         choosers.index.name: choosers.index.values[chooser_idx]
          })
 
     return choices_df
@@ -205,58 +361,113 @@ def _interaction_sample(
     # for every chooser, there will be a row for each alternative
     # index values (non-unique) are from alternatives df
     alternative_count = alternatives.shape[0]
-    interaction_df = \
-        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
 
-    chunk.log_df(trace_label, 'interaction_df', interaction_df)
+    slim = config.setting('slim_interaction_sample', False)
+    if slim and not referenced_columns_known(spec, choosers, alternatives):
+        logger.debug("%s slim_interaction_sample ignored since spec refers to df columns indirectly" %
+                     trace_label)
+        slim = False
+
+    if slim:
+        # evaluate alternative-only terms once per alternative and chooser-only terms once per chooser
+        # (both broadcast to utilities below) and only repeat chooser and alternative columns actually
+        # referenced by the remaining terms (if any) in the interaction dataset
+        alt_spec, chooser_spec, spec = split_spec_terms(spec, choosers, alternatives, locals_d)
+        if spec.empty and not have_trace_targets:
+            interaction_df = None
+        else:
+            chooser_columns, alt_columns = referenced_columns(spec, choosers, alternatives, skims)
+            interaction_df = \
+                logit.interaction_dataset(choosers[chooser_columns], alternatives[alt_columns],
+                                          sample_size=alternative_count)
+    else:
+        alt_spec = chooser_spec = None
+        interaction_df = \
+            logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
 
-    assert alternative_count == len(interaction_df.index) / len(choosers.index)
+    if interaction_df is not None:
 
-    if skims is not None:
-        set_skim_wrapper_targets(interaction_df, skims)
+        chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
-    # evaluate expressions from the spec multiply by coefficients and sum
-    # spec is df with one row per spec expression and one col with utility coefficient
-    # column names of interaction_df match spec index values
-    # utilities has utility value for element in the cross product of choosers and alternatives
-    # interaction_utilities is a df with one utility column and one row per row in interaction_df
-    if have_trace_targets:
-        trace_rows, trace_ids \
-            = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
+        assert alternative_count == len(interaction_df.index) / len(choosers.index)
 
-        tracing.trace_df(interaction_df[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_df'),
-                         slicer='NONE', transpose=False)
-    else:
-        trace_rows = trace_ids = None
+        if skims is not None:
+            set_skim_wrapper_targets(interaction_df, skims)
 
-    # interaction_utilities is a df with one utility column and one row per interaction_df row
-    interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
-    chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
+        # evaluate expressions from the spec multiply by coefficients and sum
+        # spec is df with one row per spec expression and one col with utility coefficient
+        # column names of interaction_df match spec index values
+        # utilities has utility value for element in the cross product of choosers and alternatives
+        # interaction_utilities is a df with one utility column and one row per row in interaction_df
+        if have_trace_targets:
+            trace_rows, trace_ids \
+                = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
 
-    del interaction_df
-    chunk.log_df(trace_label, 'interaction_df', None)
+            tracing.trace_df(interaction_df[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_df'),
+                             slicer='NONE', transpose=False)
+        else:
+            trace_rows = trace_ids = None
 
-    if have_trace_targets:
-        tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
-                                               tracing.extend_trace_label(trace_label, 'eval'))
+        # interaction_utilities is a df with one utility column and one row per interaction_df row
+        interaction_utilities, trace_eval_results \
+            = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+        chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
 
-        tracing.trace_df(interaction_utilities[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_utilities'),
-                         slicer='NONE', transpose=False)
+        del interaction_df
+        chunk.log_df(trace_label, 'interaction_df', None)
 
-    tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+        if have_trace_targets:
+            tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
+                                                   tracing.extend_trace_label(trace_label, 'eval'))
 
-    # reshape utilities (one utility column and one row per row in interaction_utilities)
-    # to a dataframe with one row per chooser and one column per alternative
-    utilities = pd.DataFrame(
-        interaction_utilities.values.reshape(len(choosers), alternative_count),
-        index=choosers.index)
-    chunk.log_df(trace_label, 'utilities', utilities)
+            tracing.trace_df(interaction_utilities[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_utilities'),
+                             slicer='NONE', transpose=False)
 
-    del interaction_utilities
-    chunk.log_df(trace_label, 'interaction_utilities', None)
+        tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+
+        # reshape utilities (one utility column and one row per row in interaction_utilities)
+        # to a dataframe with one row per chooser and one column per alternative
+        utilities = interaction_utilities.values.reshape(len(choosers), alternative_count)
+
+        del interaction_utilities
+        chunk.log_df(trace_label, 'interaction_utilities', None)
+    else:
+        # every term depends only on the alternatives or only on the choosers, so no cross join
+        utilities = np.zeros((len(choosers), alternative_count))
+
+    if alt_spec is not None and not alt_spec.empty:
+        alt_utilities, _ = eval_interaction_utilities(alt_spec, alternatives, locals_d,
+                                                      trace_label, trace_rows=None)
+        alt_utilities = alt_utilities.utility.values
+
+        if have_trace_targets:
+            tracing.trace_df(pd.DataFrame({'alt_utility': alt_utilities}, index=alternatives.index),
+                             tracing.extend_trace_label(trace_label, 'alt_utilities'),
+                             slicer='NONE', transpose=False)
+
+        # add alternative-only utilities to every chooser's row
+        utilities = utilities + alt_utilities
+
+    if chooser_spec is not None and not chooser_spec.empty:
+        # chooser columns are named as in interaction dataset
+        chooser_columns, _ = referenced_columns(chooser_spec, choosers, alternatives, None)
+        chooser_df = choosers[chooser_columns].rename(
+            columns={c: c + '_chooser' for c in chooser_columns if c in alternatives.columns})
+        chooser_utilities, _ = eval_interaction_utilities(chooser_spec, chooser_df, locals_d,
+                                                          trace_label, trace_rows=None)
+        chooser_utilities = chooser_utilities.utility.values
+
+        if have_trace_targets:
+            tracing.trace_df(pd.DataFrame({'chooser_utility': chooser_utilities}, index=choosers.index),
+                             tracing.extend_trace_label(trace_label, 'chooser_utilities'))
+
+        # add chooser-only utilities to every alternative of chooser's row
+        utilities = utilities + chooser_utilities[:, np.newaxis]
+
+    utilities = pd.DataFrame(utilities, index=choosers.index)
+    chunk.log_df(trace_label, 'utilities', utilities)
 
     if have_trace_targets:
         tracing.trace_df(utilities, tracing.extend_trace_label(trace_label, 'utilities'),
@@ -305,24 +516,7 @@ def _interaction_sample(
     del probs
     chunk.log_df(trace_label, 'probs', None)
 
-    # pick_count and pick_dup
-    # pick_count is number of duplicate picks
-    # pick_dup flag is True for all but first of duplicates
-    pick_group = choices_df.groupby([choosers.index.name, alt_col_name])
-
-    # number each item in each group from 0 to the length of that group - 1.
-    choices_df['pick_count'] = pick_group.cumcount(ascending=True)
-    # flag duplicate rows after first
-    choices_df['pick_dup'] = choices_df['pick_count'] > 0
-    # add reverse cumcount to get total pick_count (conveniently faster than groupby.count + merge)
-    choices_df['pick_count'] += pick_group.cumcount(ascending=False) + 1
-
-    # drop the duplicates
-    choices_df = choices_df[~choices_df['pick_dup']]
-    del choices_df['pick_dup']
-    chunk.log_df(trace_label, 'choices_df', choices_df)
-
-    # set index after groupby so we can trace on it
+    # set index after choosing so we can trace on it
     choices_df.set_index(choosers.index.name, inplace=True)
 
     tracing.dump_df(DUMP, choices_df, trace_label, 'choices_df')
@@ -449,37 +643,47 @@ def interaction_sample(
 
     sample_size = min(sample_size, len(alternatives.index))
 
+    num_threads = chunk.chunk_threads(chunk_size)
+    if num_threads > 1:
+        # chunks run concurrently share chunk_size
+        chunk_size = max(chunk_size // num_threads, 1)
+
     rows_per_chunk, effective_chunk_size = \
         calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label)
 
-    result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            simulate.copy_skim_wrappers(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
 
         choices = _interaction_sample(chooser_chunk, alternatives,
                                       spec, sample_size, alt_col_name, allow_zero_probs,
-                                      skims, locals_d,
+                                      chunk_skims, chunk_locals_d,
                                       chunk_trace_label)
 
         chunk.log_close(chunk_trace_label)
 
-        if choices.shape[0] > 0:
-            # might not be any if allow_zero_probs
-            result_list.append(choices)
-
         force_garbage_collect()
 
+        return choices
+
+    chunk_choices = chunk.run_chunks(
+        chunk.chunked_choosers(choosers, rows_per_chunk, chunk_size, trace_label), run_chunk, num_threads)
+
+    # might not be any choices in a chunk if allow_zero_probs
+    result_list = [choices for choices in chunk_choices if choices.shape[0] > 0] or chunk_choices[-1:]
+
     # FIXME: this will require 2X RAM
     # if necessary, could append to hdf5 store on disk:
     # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    choices = pd.concat(result_list) if len(result_list) > 1 else result_list[0]
 
     assert allow_zero_probs or (len(choosers.index) == len(np.unique(choices.index.values)))
 
@@ -13,6 +13,7 @@ from . import chunk
 from . import util
 from . import mem
 from .simulate import set_skim_wrapper_targets
+from .simulate import copy_skim_wrappers
 
 from activitysim.core.mem import force_garbage_collect
 from .interaction_simulate import eval_interaction_utilities
@@ -366,38 +367,44 @@ def interaction_sample_simulate(
 
     trace_label = tracing.extend_trace_label(trace_label, 'interaction_sample_simulate')
 
+    num_threads = chunk.chunk_threads(chunk_size, estimator)
+    if num_threads > 1:
+        # chunks run concurrently share chunk_size
+        chunk_size = max(chunk_size // num_threads, 1)
+
     rows_per_chunk, effective_chunk_size = \
         calc_rows_per_chunk(chunk_size, choosers, alternatives, spec=spec, trace_label=trace_label)
 
-    result_list = []
-    for i, num_chunks, chooser_chunk, alternative_chunk \
-            in chunk.chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk, alternative_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            copy_skim_wrappers(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
 
         choices = _interaction_sample_simulate(
             chooser_chunk, alternative_chunk, spec, choice_column,
             allow_zero_probs, zero_prob_choice_val, want_logsums,
-            skims, locals_d,
+            chunk_skims, chunk_locals_d,
             chunk_trace_label, trace_choice_name,
             estimator)
 
         chunk.log_close(chunk_trace_label)
 
-        result_list.append(choices)
-
         force_garbage_collect()
 
-    # FIXME: this will require 2X RAM
-    # if necessary, could append to hdf5 store on disk:
-    # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+        return choices
+
+    # chunk choices are written into choices preallocated for all choosers
+    choices = chunk.run_chunks(
+        chunk.chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk, chunk_size, trace_label),
+        run_chunk, num_threads,
+        sink=chunk.ChunkSink(choosers.index)).result()
 
     assert len(choices.index == len(choosers.index))
 
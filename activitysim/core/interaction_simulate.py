@@ -15,6 +15,8 @@ from .simulate import set_skim_wrapper_targets
 from . import chunk
 
 from . import simulate
+from . import assign
+from . import expression_cache
 
 from activitysim.core.mem import force_garbage_collect
 
@@ -90,9 +92,14 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
     # need to be able to identify which variables causes an error, which keeps
     # this from being expressed more parsimoniously
 
-    utilities = pd.DataFrame({'utility': 0.0}, index=df.index)
+    # accumulate partial utilities in place, reusing a single buffer for each partial utility
+    utility = np.zeros(len(df.index))
+    partial_utility = np.empty(len(df.index))
     no_variability = has_missing_vals = 0
 
+    # versions of df columns used as expression_cache keys
+    column_versions = {}
+
     if estimator:
         # ensure alt_id from interaction_dataset is available in expression_values_df for
         # estimator.write_interaction_expression_values and eventual omnibus table assembly
@@ -126,7 +133,10 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
 
                 target = expr[:expr.index('@')]
                 rhs = expr[expr.index('@') + 1:]
-                v = to_series(eval(rhs, globals(), locals_d))
+                v = to_series(expression_cache.eval_expression(
+                    '@' + rhs, df, locals_d,
+                    lambda: eval(assign.compile_expression(rhs), globals(), locals_d),
+                    column_versions))
 
                 # update locals to allows us to ref previously assigned targets
                 locals_d[target] = v
@@ -138,9 +148,15 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                 continue
 
             if expr.startswith('@'):
-                v = to_series(eval(expr[1:], globals(), locals_d))
+                v = to_series(expression_cache.eval_expression(
+                    expr, df, locals_d,
+                    lambda: eval(assign.compile_expression(expr[1:]), globals(), locals_d),
+                    column_versions))
             else:
-                v = df.eval(expr)
+                v = expression_cache.eval_expression(
+                    expr, df, locals_d,
+                    lambda: assign.eval_df_expression(expr, df),
+                    column_versions)
 
             if check_for_variability and v.std() == 0:
                 logger.info("%s: no variability (%s) in: %s" % (trace_label, v.iloc[0], expr))
@@ -157,7 +173,12 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                 expression_values_df.insert(loc=len(expression_values_df.columns), column=label,
                                             value=v.values if isinstance(v, pd.Series) else v)
 
-            utilities.utility += (v * coefficient).astype('float')
+            if isinstance(v, pd.Series):
+                assert v.index is df.index or v.index.equals(df.index)
+                np.multiply(v.values, coefficient, out=partial_utility)
+            else:
+                np.multiply(v, coefficient, out=partial_utility)
+            utility += partial_utility
 
             if trace_eval_results is not None:
 
@@ -187,6 +208,9 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
     if has_missing_vals > 0:
         logger.warning("%s: %s columns have missing values" % (trace_label, has_missing_vals))
 
+    del partial_utility
+    utilities = pd.DataFrame({'utility': utility}, index=df.index)
+
     if trace_eval_results is not None:
         trace_eval_results['total utility'] = utilities.utility[trace_rows]
 
@@ -450,38 +474,44 @@ def interaction_simulate(
 
     assert len(choosers) > 0
 
+    num_threads = chunk.chunk_threads(chunk_size, estimator)
+    if num_threads > 1:
+        # chunks run concurrently share chunk_size
+        chunk_size = max(chunk_size // num_threads, 1)
+
     rows_per_chunk, effective_chunk_size = \
         calc_rows_per_chunk(chunk_size, choosers, alternatives=alternatives,
                             sample_size=sample_size, skims=skims,
                             trace_label=trace_label)
 
-    result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            simulate.copy_skim_wrappers(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
 
         choices = _interaction_simulate(chooser_chunk, alternatives, spec,
-                                        skims, locals_d, sample_size,
+                                        chunk_skims, chunk_locals_d, sample_size,
                                         chunk_trace_label,
                                         trace_choice_name,
                                         estimator)
 
         chunk.log_close(chunk_trace_label)
 
-        result_list.append(choices)
-
         force_garbage_collect()
 
-    # FIXME: this will require 2X RAM
-    # if necessary, could append to hdf5 store on disk:
-    # http://pandas.pydata.org/pandas-docs/stable/io.html#id2
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+        return choices
+
+    # chunk choices are written into choices preallocated for all choosers
+    choices = chunk.run_chunks(
+        chunk.chunked_choosers(choosers, rows_per_chunk, chunk_size, trace_label), run_chunk, num_threads,
+        sink=chunk.ChunkSink(choosers.index)).result()
 
     assert len(choices.index == len(choosers.index))
 
@@ -462,3 +462,162 @@ def count_nests(nest_spec):
             return 1
 
     return count_each_nest(nest_spec, 0) if nest_spec is not None else 0
+
+
+class NestTree(object):
+    """
+    Nest spec compiled into index arrays, to compute nested logit exponentiated utilities,
+    logsums and probabilities for a whole chunk of choosers with a few numpy operations per node
+    rather than a DataFrame column per nest.
+
+    Nests (leaves and nodes) are numbered in post order (alternatives before the node that nests
+    them, root last), which is the column order of the 2-D exp_utilities and probabilities arrays.
+    """
+
+    def __init__(self, nest_spec):
+
+        nests = list(each_nest(nest_spec, post_order=True))
+
+        self.names = [nest.name for nest in nests]
+        self.root = len(nests) - 1
+
+        positions = {name: i for i, name in enumerate(self.names)}
+
+        self.leaves = np.array([i for i, nest in enumerate(nests) if nest.is_leaf])
+        self.leaf_names = [self.names[i] for i in self.leaves]
+        self.leaf_product_of_coefficients = \
+            np.array([float(nest.product_of_coefficients) for nest in nests if nest.is_leaf])
+
+        # (position, coefficient, positions of alternatives) of each node, in post order
+        nodes = {nest.name: (positions[nest.name], nest.coefficient,
+                             np.array([positions[a] for a in nest.alternatives]))
+                 for nest in nests if not nest.is_leaf}
+        self.post_order_nodes = [nodes[nest.name] for nest in nests if not nest.is_leaf]
+        self.pre_order_nodes = [nodes[nest.name] for nest in each_nest(nest_spec, type='node')]
+
+        # nested probabilities are listed by node (in pre order), as the root has no probability
+        self.probability_positions = np.concatenate([alts for _, _, alts in self.pre_order_nodes])
+        self.probability_names = [self.names[i] for i in self.probability_positions]
+
+    def exp_utilities(self, raw_utilities):
+        """
+        compute exponentiated utilities of all leaves and nodes, and logsum of root
+
+        leaf <- exp( raw_utility / product_of_coefficients )
+        node <- exp( ln(sum of exponentiated utilities of alternatives) * nest_coefficient)
+
+        Parameters
+        ----------
+        raw_utilities : pandas.DataFrame
+            raw alternative utilities, with a column for each leaf
+
+        Returns
+        -------
+        exp_utilities : 2-D numpy.ndarray
+            exponentiated utilities of each chooser (row) for each nest (column, in post order)
+        logsums : numpy.ndarray
+            logsum of root (log of its exponentiated utility) for each chooser
+        """
+
+        leaf_columns = raw_utilities.columns.get_indexer(self.leaf_names)
+        assert (leaf_columns >= 0).all(), "nest spec leaves not all in utilities columns"
+
+        exp_utilities = np.empty((len(raw_utilities.index), len(self.names)))
+        exp_utilities[:, self.leaves] = \
+            np.exp(raw_utilities.values[:, leaf_columns].astype(float) / self.leaf_product_of_coefficients)
+
+        # the alternatives of each node will already have been computed due to post order
+        for position, coefficient, alternatives in self.post_order_nodes:
+            # this would RuntimeWarning: divide by zero encountered in log
+            # if all nest alternative utilities are zero
+            # but the resulting -inf logsum will become 0 when exp is applied
+            with np.errstate(divide='ignore'):
+                logsums = coefficient * np.log(exp_utilities[:, alternatives].sum(axis=1))
+            exp_utilities[:, position] = np.exp(logsums)
+
+        # root is last in post order
+        return exp_utilities, logsums
+
+    def nested_probabilities(self, exp_utilities, index, trace_label=None):
+        """
+        compute probabilities of each leaf and node relative to its siblings in the same nest
+
+        like utils_to_probs(exponentiated=True, allow_zero_probs=True) for the alternatives of
+        each node, so nests whose alternatives all have zero exponentiated utility have zero
+        probabilities
+
+        Parameters
+        ----------
+        exp_utilities : 2-D numpy.ndarray
+            from exp_utilities
+        index : pandas.Index
+            chooser index (to report bad choosers)
+        trace_label : str
+
+        Returns
+        -------
+        probabilities : 2-D numpy.ndarray
+            probability of each nest (column, in post order) within its parent nest (root is 1)
+        """
+
+        trace_label = tracing.extend_trace_label(trace_label, 'nested_probabilities')
+
+        probabilities = np.empty_like(exp_utilities)
+        probabilities[:, self.root] = 1.0
+
+        for _, _, alternatives in self.pre_order_nodes:
+
+            utils_arr = np.clip(exp_utilities[:, alternatives], EXP_UTIL_MIN, EXP_UTIL_MAX)
+            utils_arr[utils_arr == EXP_UTIL_MIN] = 0.0
+
+            arr_sum = utils_arr.sum(axis=1)
+
+            inf_utils = np.isinf(arr_sum)
+            if inf_utils.any():
+                utils = pd.DataFrame(exp_utilities[:, alternatives], index=index,
+                                     columns=[self.names[i] for i in alternatives])
+                report_bad_choices(inf_utils, utils,
+                                   trace_label=tracing.extend_trace_label(trace_label, 'inf_exp_utils'),
+                                   msg="infinite exponentiated utilities")
+
+            # rows of nests whose alternatives all have zero utility have zero probabilities
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.divide(utils_arr, arr_sum.reshape(len(utils_arr), 1), out=utils_arr)
+            utils_arr[np.isnan(utils_arr)] = PROB_MIN
+
+            np.clip(utils_arr, PROB_MIN, PROB_MAX, out=utils_arr)
+
+            probabilities[:, alternatives] = utils_arr
+
+        return probabilities
+
+    def base_probabilities(self, probabilities, alternatives):
+        """
+        compute base probabilities of leaves (product of the nested probabilities of the leaf and
+        all its ancestors except root), which sum to 1 for each chooser
+
+        probabilities is overwritten in place with the product of the nested probabilities of each
+        nest and its ancestors
+
+        Parameters
+        ----------
+        probabilities : 2-D numpy.ndarray
+            from nested_probabilities
+        alternatives : list of str
+            names of leaf alternatives in the order of the columns to return (e.g. spec columns)
+
+        Returns
+        -------
+        base_probabilities : 2-D numpy.ndarray
+            base probability of each chooser (row) for each alternative (column)
+        """
+
+        assert set(alternatives) == set(self.leaf_names)
+
+        # parent probability will already have been multiplied by its ancestors' due to pre order
+        for position, _, nest_alternatives in self.pre_order_nodes:
+            if position != self.root:
+                probabilities[:, nest_alternatives] *= probabilities[:, [position]]
+
+        positions = {name: i for i, name in enumerate(self.names)}
+        return probabilities[:, [positions[a] for a in alternatives]]
@@ -20,8 +20,10 @@ from activitysim.core import config
 
 from activitysim.core import chunk
 from activitysim.core import mem
+from activitysim.core import shared_tables
 
 from activitysim.core.config import setting
+from activitysim.core.pipeline_store import open_store, remove_store
 
 # activitysim.abm imported for its side-effects (dependency injection)
 from activitysim import abm
@@ -201,7 +203,7 @@ think that the existence of such a lock would make shared access pretty straight
 this is not the case as the level of locking is very low, reportedly not very performant, and
 essentially useless in any event since we want to use numpy.frombuffer to wrap and handle them
 as numpy arrays. The Lock is a convenient bundled locking primative, but shadow_pricing rolls
-its own semaphore system using the Lock.
+its own semaphore system using the Lock (a multiprocessing.Condition so processes can wait on it).
 
 FIXME - The code below knows that it need to allocate skim and shadow price buffers by calling
 the appropriate methods in abm.tables.skims and abm.tables.shadow_pricing to allocate shared
@@ -271,7 +273,7 @@ def pipeline_table_keys(pipeline_store):
     return dict of current (as of last checkpoint) pipeline tables
     and their checkpoint-specific hdf5_keys
 
-    This facilitates reading pipeline tables directly from a 'raw' open pandas.HDFStore without
+    This facilitates reading pipeline tables directly from a 'raw' open pipeline store without
     opening it as a pipeline (e.g. when apportioning and coalescing pipelines)
 
     We currently only ever need to do this from the last checkpoint, so the ability to specify
@@ -279,7 +281,7 @@ def pipeline_table_keys(pipeline_store):
 
     Parameters
     ----------
-    pipeline_store : open hdf5 pipeline_store
+    pipeline_store : open pipeline_store
 
     Returns
     -------
@@ -323,6 +325,7 @@ def build_slice_rules(slice_info, pipeline_tables):
     slice_info is a dict with two well-known keys:
         'tables': required list of table names (order matters!)
         'except': optional list of tables not to slice even if they have a sliceable index name
+        'weight': optional column of primary table estimating the relative cost of each row
 
     Note: tables listed in slice_info must appear in same order and before any others in tables dict
 
@@ -423,8 +426,8 @@ def build_slice_rules(slice_info, pipeline_tables):
 
         rule = {}
         if table_name == primary_slicer:
-            # slice primary apportion table
-            rule = {'slice_by': 'primary'}
+            # slice primary apportion table (optionally weighted by estimated cost of each row)
+            rule = {'slice_by': 'primary', 'weight': slice_info.get('weight')}
         elif table_name in slicer_table_exceptions:
             rule['slice_by'] = None
         else:
@@ -457,25 +460,85 @@ def build_slice_rules(slice_info, pipeline_tables):
     return slice_rules
 
 
-def apportion_pipeline(sub_proc_names, slice_info):
+def apportion_rows(tables, slice_rules, num_sub_procs):
     """
-    apportion pipeline for multiprocessing step
-
-    create pipeline files for sub_procs, apportioning data based on slice_rules
-
-    Called at the beginning of a multiprocess step prior to launching the sub-processes
-    Pipeline files have well known names (pipeline file name prefixed by subjob name)
+    Return the row positions of each table that are apportioned to each sub_proc
 
     Parameters
     ----------
-    sub_proc_names : list of str
-        names of the sub processes to apportion
-    slice_info : dict
-        slice_info from multiprocess_steps
+    tables : dict {<table_name>: pandas.DataFrame}
+    slice_rules : dict
+        slice_rules from build_slice_rules
+    num_sub_procs : int
 
     Returns
     -------
-    creates apportioned pipeline files for each sub job
+    rows : dict {<table_name>: list of numpy array of int (one per sub_proc) or None if not sliced}
+    """
+
+    rows = {}
+    # sliced index of each sliced table for each sub_proc, so we can cascade slicing to other tables
+    sliced_indexes = {}
+
+    for table_name, rule in slice_rules.items():
+
+        df = tables[table_name]
+
+        if rule['slice_by'] == 'primary':
+            positions = np.arange(df.shape[0])
+            if rule.get('weight'):
+                # cut primary apportion table into num_sub_procs runs of rows with equal total weight
+                # (e.g. weight hhsize so slices of large households have fewer of them)
+                if rule['weight'] not in df.columns:
+                    raise RuntimeError("slice weight column '%s' not in primary slice table %s" %
+                                       (rule['weight'], table_name))
+                weights = df[rule['weight']].to_numpy(dtype=np.float64)
+                # weight of rows preceding each row
+                preceding = np.cumsum(weights) - weights
+                total = weights.sum()
+                if total > 0:
+                    slice_nums = np.minimum((preceding * num_sub_procs / total).astype(int), num_sub_procs - 1)
+                else:
+                    slice_nums = positions % num_sub_procs
+                table_rows = [positions[slice_nums == i] for i in range(num_sub_procs)]
+            else:
+                # slice primary apportion table by num_sub_procs strides
+                # this hopefully yields a more random distribution
+                # (e.g.) households are ordered by size in input store
+                table_rows = [positions[positions % num_sub_procs == i] for i in range(num_sub_procs)]
+        elif rule['slice_by'] == 'index':
+            # slice a table with same index name as a known slicer
+            table_rows = [df.index.get_indexer(source_index) for source_index in sliced_indexes[rule['source']]]
+            if any((r < 0).any() for r in table_rows):
+                raise RuntimeError("table %s index missing values in slicer table %s index" %
+                                   (table_name, rule['source']))
+        elif rule['slice_by'] == 'column':
+            # slice a table with a recognized slicer_column
+            table_rows = [np.flatnonzero(df[rule['column']].isin(source_index))
+                          for source_index in sliced_indexes[rule['source']]]
+        elif rule['slice_by'] is None:
+            # don't slice mirrored tables
+            rows[table_name] = None
+            continue
+        else:
+            raise RuntimeError("Unrecognized slice rule '%s' for table %s" %
+                               (rule['slice_by'], table_name))
+
+        rows[table_name] = table_rows
+        sliced_indexes[table_name] = [df.index[r] for r in table_rows]
+
+    return rows
+
+
+def read_apportion_tables(slice_info):
+    """
+    Read the tables to apportion from the last checkpoint of the pipeline
+
+    Returns
+    -------
+    checkpoints_df : pandas.DataFrame
+        single row checkpoints table for apportioned pipelines (all tables in last checkpoint)
+    tables : dict {<table_name>: pandas.DataFrame}
     """
 
     pipeline_file_name = inject.get_injectable('pipeline_file_name')
@@ -487,7 +550,7 @@ def apportion_pipeline(sub_proc_names, slice_info):
 
     # - load all tables from pipeline
     tables = {}
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    with open_store(pipeline_path, mode='r') as pipeline_store:
 
         checkpoints_df = pipeline_store[pipeline.CHECKPOINT_TABLE_NAME]
 
@@ -512,11 +575,43 @@ def apportion_pipeline(sub_proc_names, slice_info):
     checkpoints_df = checkpoints_df.tail(1).copy()
     checkpoints_df[list(tables.keys())] = checkpoint_name
 
+    return checkpoints_df, tables
+
+
+def apportion_pipeline(sub_proc_names, slice_info):
+    """
+    apportion pipeline for multiprocessing step
+
+    create pipeline files for sub_procs, apportioning data based on slice_rules
+
+    Called at the beginning of a multiprocess step prior to launching the sub-processes
+    Pipeline files have well known names (pipeline file name prefixed by subjob name)
+
+    Parameters
+    ----------
+    sub_proc_names : list of str
+        names of the sub processes to apportion
+    slice_info : dict
+        slice_info from multiprocess_steps
+
+    Returns
+    -------
+    creates apportioned pipeline files for each sub job
+    """
+
+    pipeline_file_name = inject.get_injectable('pipeline_file_name')
+
+    checkpoints_df, tables = read_apportion_tables(slice_info)
+    checkpoint_name = checkpoints_df[pipeline.CHECKPOINT_NAME].iloc[-1]
+
     # - build slice rules for loaded tables
     slice_rules = build_slice_rules(slice_info, tables)
 
-    # - allocate sliced tables for each sub_proc
+    # - apportion rows of sliced tables to each sub_proc
     num_sub_procs = len(sub_proc_names)
+    rows = apportion_rows(tables, slice_rules, num_sub_procs)
+
+    # - allocate sliced tables for each sub_proc
     for i in range(num_sub_procs):
 
         # use well-known pipeline file name
@@ -525,51 +620,71 @@ def apportion_pipeline(sub_proc_names, slice_info):
 
         # remove existing file
         try:
-            os.unlink(pipeline_path)
+            remove_store(pipeline_path)
         except OSError:
             pass
 
-        with pd.HDFStore(pipeline_path, mode='a') as pipeline_store:
-
-            # remember sliced_tables so we can cascade slicing to other tables
-            sliced_tables = {}
+        with open_store(pipeline_path, mode='a') as pipeline_store:
 
             # - for each table in pipeline
-            for table_name, rule in slice_rules.items():
+            for table_name in slice_rules:
 
                 df = tables[table_name]
-
-                if rule['slice_by'] == 'primary':
-                    # slice primary apportion table by num_sub_procs strides
-                    # this hopefully yields a more random distribution
-                    # (e.g.) households are ordered by size in input store
-                    primary_df = df[np.asanyarray(list(range(df.shape[0]))) % num_sub_procs == i]
-                    sliced_tables[table_name] = primary_df
-                elif rule['slice_by'] == 'index':
-                    # slice a table with same index name as a known slicer
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df.loc[source_df.index]
-                elif rule['slice_by'] == 'column':
-                    # slice a table with a recognized slicer_column
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df[df[rule['column']].isin(source_df.index)]
-                elif rule['slice_by'] is None:
-                    # don't slice mirrored tables
-                    sliced_tables[table_name] = df
-                else:
-                    raise RuntimeError("Unrecognized slice rule '%s' for table %s" %
-                                       (rule['slice_by'], table_name))
+                if rows[table_name] is not None:
+                    df = df.iloc[rows[table_name][i]]
 
                 # - write table to pipeline
                 hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
-                pipeline_store[hdf5_key] = sliced_tables[table_name]
+                pipeline_store[hdf5_key] = df
 
             debug(f"writing checkpoints ({checkpoints_df.shape}) "
                   f"to {pipeline.CHECKPOINT_TABLE_NAME} in {pipeline_path}")
             pipeline_store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints_df
 
 
-def coalesce_pipelines(sub_proc_names, slice_info):
+def read_sub_proc_tables(process_name, returned_tables=None, table_names=None):
+    """
+    Read last checkpoint tables of sub_proc, from shared memory if the sub_proc returned them
+    there (see return_shared_tables) or else from its pipeline file
+
+    Parameters
+    ----------
+    process_name : str
+    returned_tables : dict {<process_name>: tables_info} or None
+        tables returned by sub_procs in shared memory
+    table_names : list of str or None
+        names of tables to read (all tables in last checkpoint if None)
+
+    Returns
+    -------
+    checkpoint_name : str
+    tables : dict {<table_name>: pandas.DataFrame}
+    """
+
+    if returned_tables and process_name in returned_tables:
+        tables_info = returned_tables[process_name]
+        debug(f"reading {process_name} tables from shared memory block {tables_info['block']}")
+        return tables_info['checkpoint_name'], shared_tables.read_shared_tables(tables_info, table_names=table_names)
+
+    pipeline_file_name = inject.get_injectable('pipeline_file_name')
+    pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
+    logger.info(f"coalesce pipeline {pipeline_path}")
+
+    tables = {}
+    with open_store(pipeline_path, mode='r') as pipeline_store:
+
+        # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
+        checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
+
+        for table_name, hdf5_key in hdf5_keys.items():
+            if table_names is None or table_name in table_names:
+                debug(f"loading table {table_name} {hdf5_key}")
+                tables[table_name] = pipeline_store[hdf5_key]
+
+    return checkpoint_name, tables
+
+
+def coalesce_pipelines(sub_proc_names, slice_info, returned_tables=None):
     """
     Coalesce the data in the sub_processes apportioned pipelines back into a single pipeline
 
@@ -583,6 +698,8 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     sub_proc_names : list of str
     slice_info : dict
         slice_info from multiprocess_steps
+    returned_tables : dict {<process_name>: tables_info} or None
+        tables returned by sub_procs in shared memory (read from pipeline files if not returned)
 
     Returns
     -------
@@ -594,38 +711,27 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     debug(f"coalesce_pipelines to: {pipeline_file_name}")
 
     # - read all tables from first process pipeline
-    tables = {}
-    pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=sub_proc_names[0])
-
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
-
-        # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
-        checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
-
-        for table_name, hdf5_key in hdf5_keys.items():
-            debug(f"loading table {table_name} {hdf5_key}")
-            tables[table_name] = pipeline_store[hdf5_key]
+    checkpoint_name, tables = read_sub_proc_tables(sub_proc_names[0], returned_tables)
 
     # - use slice rules followed by apportion_pipeline to identify mirrored tables
     # (tables that are identical in every pipeline and so don't need to be concatenated)
     slice_rules = build_slice_rules(slice_info, tables)
     mirrored_table_names = [t for t, rule in slice_rules.items() if rule['slice_by'] is None]
     mirrored_tables = {t: tables[t] for t in mirrored_table_names}
-    omnibus_keys = {t: k for t, k in hdf5_keys.items() if t not in mirrored_table_names}
+    omnibus_table_names = [t for t in tables if t not in mirrored_table_names]
 
     debug(f"coalesce_pipelines to: {pipeline_file_name}")
     debug(f"mirrored_table_names: {mirrored_table_names}")
-    debug(f"omnibus_keys: {omnibus_keys}")
+    debug(f"omnibus_table_names: {omnibus_table_names}")
 
     # assemble lists of omnibus tables from all sub_processes
-    omnibus_tables = {table_name: [] for table_name in omnibus_keys}
-    for process_name in sub_proc_names:
-        pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
-        logger.info(f"coalesce pipeline {pipeline_path}")
-
-        with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
-            for table_name, hdf5_key in omnibus_keys.items():
-                omnibus_tables[table_name].append(pipeline_store[hdf5_key])
+    omnibus_tables = {table_name: [tables[table_name]] for table_name in omnibus_table_names}
+    del tables
+    for process_name in sub_proc_names[1:]:
+        _, tables = read_sub_proc_tables(process_name, returned_tables, table_names=omnibus_table_names)
+        for table_name in omnibus_table_names:
+            omnibus_tables[table_name].append(tables[table_name])
+        del tables
 
     pipeline.open_pipeline()
 
@@ -689,7 +795,65 @@ def setup_injectables_and_logging(injectables, locutor=True):
         raise e
 
 
-def run_simulation(queue, step_info, resume_after, shared_data_buffer):
+def apportioned_tables(apportioned):
+    """
+    Read this sub_proc's slice of the tables apportioned in shared memory by parent process
+
+    Parameters
+    ----------
+    apportioned : dict
+        checkpoints table and tables_info of shared tables and of this sub_proc's rows of each table
+        (see SharedTablesHandoff.apportion)
+
+    Returns
+    -------
+    tables : dict {<table_name>: pandas.DataFrame}
+        checkpoints table and sliced tables to open pipeline with
+    """
+
+    rows = {table_name: df['row'].values
+            for table_name, df in shared_tables.read_shared_tables(apportioned['rows']).items()}
+
+    tables = shared_tables.read_shared_tables(apportioned['tables'], rows=rows)
+    tables[pipeline.CHECKPOINT_TABLE_NAME] = apportioned['checkpoints']
+
+    return tables
+
+
+def return_shared_tables(queue, handoff):
+    """
+    Return the tables in the last checkpoint to parent process in shared memory (for coalesce_pipelines)
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        queue to send tables_info of shared tables to parent
+    handoff : dict
+        handoff from parent (see SharedTablesHandoff.sub_proc_args) with name of the (batch) pipeline
+        and this sub process's returned event, set by parent once it has attached to shared memory block
+    """
+
+    tables = {table_name: pipeline.get_table(table_name) for table_name in pipeline.checkpointed_tables()}
+
+    block, tables_info = shared_tables.share_tables(tables)
+    del tables
+
+    tables_info['checkpoint_name'] = pipeline.last_checkpoint()
+
+    # parent will release block
+    shared_tables.disown(block)
+
+    try:
+        queue.put({'tables': tables_info, 'name': handoff['name']})
+        # wait for parent to attach, since block is freed once no process has it open on windows
+        handoff['returned'].wait()
+        # clear it for the next tables this sub process returns
+        handoff['returned'].clear()
+    finally:
+        block.close()
+
+
+def run_simulation(queue, step_info, resume_after, shared_data_buffer, handoff=None):
     """
     run step models as subtask
 
@@ -706,6 +870,9 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
     resume_after : str or None
     shared_data_buffer : dict
         dict of shared data (e.g. skims and shadow_pricing)
+    handoff : dict or None
+        if mp_shared_memory_tables, apportioned tables (or None if not apportioned in this run)
+        (see SharedTablesHandoff.sub_proc_args) and event for returning tables in shared memory
     """
 
     models = step_info['models']
@@ -717,17 +884,23 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
     inject.add_injectable("chunk_size", chunk_size)
     inject.add_injectable("num_processes", num_processes)
 
-    if resume_after:
-        info(f"resume_after {resume_after}")
+    if handoff and handoff['apportioned']:
+        # new pipeline with our slice of tables apportioned in shared memory
+        info("open_pipeline with tables apportioned in shared memory")
+        pipeline.open_pipeline(tables=apportioned_tables(handoff['apportioned']))
+    else:
+        if resume_after:
+            info(f"resume_after {resume_after}")
+
+            # if they specified a resume_after model, check to make sure it is checkpointed
+            if resume_after != LAST_CHECKPOINT and \
+                    resume_after not in pipeline.get_checkpoints()[pipeline.CHECKPOINT_NAME].values:
+                # if not checkpointed, then fall back to last checkpoint
+                info(f"resume_after checkpoint '{resume_after}' not in pipeline.")
+                resume_after = LAST_CHECKPOINT
 
-        # if they specified a resume_after model, check to make sure it is checkpointed
-        if resume_after != LAST_CHECKPOINT and \
-                resume_after not in pipeline.get_checkpoints()[pipeline.CHECKPOINT_NAME].values:
-            # if not checkpointed, then fall back to last checkpoint
-            info(f"resume_after checkpoint '{resume_after}' not in pipeline.")
-            resume_after = LAST_CHECKPOINT
+        pipeline.open_pipeline(resume_after)
 
-    pipeline.open_pipeline(resume_after)
     last_checkpoint = pipeline.last_checkpoint()
 
     if last_checkpoint in models:
@@ -752,17 +925,137 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
 
     tracing.print_elapsed_time("run (%s models)" % len(models), t0)
 
+    if handoff:
+        return_shared_tables(queue, handoff)
+
     pipeline.close_pipeline()
 
 
+def reset_sub_proc_injectables(injectables, locutor):
+    """
+    Restore orca tables, columns and injectables to their state in a newly launched sub process
+
+    So a sub process running models on one pipeline after another (see run_batches and mp_worker)
+    doesn't see tables created or cached values computed for the previous one. Persistent workers
+    (mp_persistent_workers setting) keep cached values of decorated injectables (e.g. settings and
+    skims) warm, as these don't depend on tables. Otherwise all cached values are cleared, as they
+    would be in a newly launched sub process.
+
+    Parameters
+    ----------
+    injectables : dict {<injectable_name>: <value>}
+        dict of injectables passed by parent process
+    locutor : bool
+        is this sub process the designated spokesperson
+    """
+
+    if pipeline.is_open():
+        # left open by a model run that raised an error
+        pipeline.close_pipeline()
+
+    keep_cached_injectables = setting('mp_persistent_workers', False)
+    if not keep_cached_injectables:
+        inject.clear_cache()
+    inject.reinject_decorated_tables(keep_cached_injectables=keep_cached_injectables)
+
+    # reinject_decorated_tables reinjected the decorated defaults of any we had overridden
+    for k, v in injectables.items():
+        inject.add_injectable(k, v)
+    inject.add_injectable("locutor", locutor)
+
+    inject.remove_injectable("pipeline_file_prefix")
+
+
+def run_batches(queue, batches, injectables, locutor, step_info, resume_after, shared_data_buffer,
+                handoff=None, returned=None):
+    """
+    run step models on batches of apportioned tables taken from batches queue until it is drained
+
+    Each batch is apportioned its own pipeline (named for the batch) which the step models are run
+    on just as run_simulation runs them on a sub_proc's pipeline, so results are the same however
+    the households are batched, and whichever sub process runs a batch.
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+        queue for messages to parent (including {'batch': <batch_name>} as each batch completes)
+    batches : multiprocessing.Queue
+        queue of names of batches to run, with a None for each sub process once all are taken
+    injectables : dict
+        dict of injectables passed by parent process
+    locutor : bool
+    step_info : dict
+    resume_after : str or None
+    shared_data_buffer : dict
+    handoff : dict {<batch_name>: <handoff>} or None
+        if mp_shared_memory_tables, shared memory tables handoff for each batch
+    returned : multiprocessing.Event or None
+        set by parent when it has attached to tables this sub process returned in shared memory
+    """
+
+    while True:
+
+        batch_name = batches.get()
+        if batch_name is None:
+            break
+
+        t0 = time.time()
+        info(f"running batch {batch_name}")
+
+        inject.add_injectable("pipeline_file_prefix", batch_name)
+        run_simulation(queue, step_info, resume_after, shared_data_buffer,
+                       dict(handoff[batch_name], returned=returned) if handoff else None)
+
+        queue.put({'batch': batch_name, 'time': time.time() - t0})
+
+        reset_sub_proc_injectables(injectables, locutor)
+
+
+def run_sub_proc(queue, process_name, injectables, locutor, step_info, resume_after, shared_data_buffer,
+                 handoff=None, batches=None, returned=None):
+    """
+    run step models on the process_name sub_proc's apportioned pipeline (or on batches if batches)
+
+    Parameters
+    ----------
+    queue : multiprocessing.Queue
+    process_name : str
+        name of sub_proc (whose pipeline the models are run on if step has num_processes > 1)
+    injectables : dict
+    locutor : bool
+    step_info : dict
+    resume_after : str or None
+    shared_data_buffer : dict
+    handoff : dict or None
+        shared memory tables handoff (see SharedTablesHandoff.sub_proc_args)
+        or dict of handoffs keyed by batch name if batches
+    batches : multiprocessing.Queue or None
+        queue of names of batches to run (see run_batches) or None if not run in batches
+    returned : multiprocessing.Event or None
+        set by parent when it has attached to tables this sub process returned in shared memory
+    """
+
+    if batches is not None:
+        run_batches(queue, batches, injectables, locutor, step_info, resume_after, shared_data_buffer,
+                    handoff, returned)
+    else:
+        if step_info['num_processes'] > 1:
+            logger.debug(f"injecting pipeline_file_prefix '{process_name}'")
+            inject.add_injectable("pipeline_file_prefix", process_name)
+
+        run_simulation(queue, step_info, resume_after, shared_data_buffer,
+                       dict(handoff, returned=returned) if handoff else None)
+
+
 """
 ### multiprocessing sub-process entry points
 """
 
 
-def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kwargs):
+def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, handoff, batches, returned,
+                      **kwargs):
     """
-    mp entry point for run_simulation
+    mp entry point for run_simulation (or run_batches if step is run in batches)
 
     Parameters
     ----------
@@ -771,6 +1064,13 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
     injectables
     step_info
     resume_after : bool
+    handoff : dict or None
+        shared memory tables handoff (see SharedTablesHandoff.sub_proc_args)
+        or dict of handoffs keyed by batch name if batches
+    batches : multiprocessing.Queue or None
+        queue of names of batches to run (see run_batches) or None if not run in batches
+    returned : multiprocessing.Event
+        set by parent when it has attached to tables this sub process returned in shared memory
     kwargs : dict
         shared_data_buffers passed as kwargs to avoid picking dict
     """
@@ -787,13 +1087,9 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
     try:
         mem.init_trace(setting('mem_tick'))
 
-        if step_info['num_processes'] > 1:
-            pipeline_prefix = multiprocessing.current_process().name
-            logger.debug(f"injecting pipeline_file_prefix '{pipeline_prefix}'")
-            inject.add_injectable("pipeline_file_prefix", pipeline_prefix)
-
         shared_data_buffer = kwargs
-        run_simulation(queue, step_info, resume_after, shared_data_buffer)
+        run_sub_proc(queue, multiprocessing.current_process().name, injectables, locutor,
+                     step_info, resume_after, shared_data_buffer, handoff, batches, returned)
 
         chunk.log_write_hwm()
         mem.log_hwm()
@@ -803,6 +1099,67 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
         raise e
 
 
+def mp_worker(locutor, tasks, queue, batches, returned, injectables, **kwargs):
+    """
+    mp entry point for persistent worker (see WorkerPool)
+
+    Runs the sub_procs of multiprocess steps sent by parent on the tasks queue (as run_sub_proc)
+    until it gets None, reporting {'done': <process_name>} or {'failed': <process_name>} as each
+    finishes.
+
+    Parameters
+    ----------
+    locutor : bool
+    tasks : multiprocessing.Queue
+        dicts with process_name, step_info, resume_after and handoff of sub_proc to run (and whether
+        it runs batches from batches queue)
+    queue : multiprocessing.Queue
+        queue for messages to parent
+    batches : multiprocessing.Queue
+        queue of names of batches to run (shared by all workers in pool)
+    returned : multiprocessing.Event
+        set by parent when it has attached to tables this worker returned in shared memory
+    injectables : dict
+    kwargs : dict
+        shared_data_buffers passed as kwargs to avoid picking dict
+    """
+
+    setup_injectables_and_logging(injectables, locutor=locutor)
+
+    try:
+        mem.init_trace(setting('mem_tick'))
+
+        shared_data_buffer = kwargs
+
+        while True:
+
+            task = tasks.get()
+            if task is None:
+                break
+
+            process_name = task['process_name']
+            info(f"running {process_name}")
+
+            try:
+                run_sub_proc(queue, process_name, injectables, locutor,
+                             task['step_info'], task['resume_after'], shared_data_buffer,
+                             task['handoff'], batches if task['batches'] else None, returned)
+            except Exception as e:
+                exception(f"{type(e).__name__} exception running {process_name}: {str(e)}")
+                queue.put({'failed': process_name})
+            else:
+                queue.put({'done': process_name})
+
+            reset_sub_proc_injectables(injectables, locutor)
+
+        chunk.log_write_hwm()
+        mem.log_hwm()
+
+    except Exception as e:
+        exception(f"{type(e).__name__} exception caught in mp_worker: {str(e)}")
+        raise e
+
+
 def mp_apportion_pipeline(injectables, sub_proc_names, slice_info):
     """
     mp entry point for apportion_pipeline
@@ -859,7 +1216,7 @@ def mp_setup_skims(injectables, **kwargs):
         raise e
 
 
-def mp_coalesce_pipelines(injectables, sub_proc_names, slice_info):
+def mp_coalesce_pipelines(injectables, sub_proc_names, slice_info, returned_tables=None):
     """
     mp entry point for coalesce_pipeline
 
@@ -871,12 +1228,14 @@ def mp_coalesce_pipelines(injectables, sub_proc_names, slice_info):
         names of the sub processes to apportion
     slice_info : dict
         slice_info from multiprocess_steps
+    returned_tables : dict {<process_name>: tables_info} or None
+        tables returned by sub processes in shared memory
     """
 
     setup_injectables_and_logging(injectables)
 
     try:
-        coalesce_pipelines(sub_proc_names, slice_info)
+        coalesce_pipelines(sub_proc_names, slice_info, returned_tables)
     except Exception as e:
         exception(f"{type(e).__name__} exception caught in coalesce_pipelines: {str(e)}")
         raise e
@@ -927,11 +1286,159 @@ def allocate_shared_shadow_pricing_buffers():
     return shadow_pricing_buffers
 
 
+class SharedTablesHandoff(object):
+    """
+    Hand off tables to and from the sub-processes of a multiprocess step in shared memory
+    (mp_shared_memory_tables setting) instead of through apportioned and sub-process pipeline files.
+
+    The parent process reads the pipeline tables once and publishes them, and each sub_proc's row
+    positions of the sliced tables, in shared memory blocks (apportion). Sub-processes read their
+    slices directly from shared memory (apportioned_tables) and return their final tables in shared
+    memory blocks (return_shared_tables), which the parent keeps alive (receive) until they have
+    been coalesced.
+
+    Sub-processes still write checkpoints to their own pipeline files, so a run can be resumed as
+    usual, and coalesce_pipelines falls back to pipeline files for sub-processes that didn't run.
+    """
+
+    def __init__(self):
+        # apportioned tables handoff for each sub_proc (empty if not apportioned in this run)
+        self.apportioned = {}
+        self.apportioned_blocks = []
+        # tables_info of tables returned by each sub_proc
+        self.returned_tables = {}
+        self.returned_blocks = []
+
+    def apportion(self, sub_proc_names, slice_info):
+        """
+        alternative to apportion_pipeline that publishes the apportioned tables in shared memory
+        """
+
+        t0 = tracing.print_elapsed_time()
+
+        checkpoints_df, tables = read_apportion_tables(slice_info)
+
+        slice_rules = build_slice_rules(slice_info, tables)
+        rows = apportion_rows(tables, slice_rules, len(sub_proc_names))
+
+        block, tables_info = shared_tables.share_tables({t: tables[t] for t in slice_rules})
+        self.apportioned_blocks.append(block)
+        del tables
+
+        for i, process_name in enumerate(sub_proc_names):
+            block, rows_info = shared_tables.share_tables(
+                {t: pd.DataFrame({'row': r[i]}) for t, r in rows.items() if r is not None})
+            self.apportioned_blocks.append(block)
+            self.apportioned[process_name] = {
+                'checkpoints': checkpoints_df,
+                'tables': tables_info,
+                'rows': rows_info,
+            }
+
+        tracing.print_elapsed_time("apportion shared memory tables", t0)
+
+    def sub_proc_args(self, process_name):
+        """
+        return (picklable) handoff arg for sub_proc (see run_simulation)
+        """
+        return {'name': process_name,
+                'apportioned': self.apportioned.get(process_name)}
+
+    def receive(self, process_name, tables_info, returned):
+        """
+        attach to tables returned by sub_proc, and let the sub process that returned them
+        know (by setting its returned event) that it can close its shared memory block
+        """
+        try:
+            self.returned_blocks.append(shared_tables.attach(tables_info))
+            self.returned_tables[process_name] = tables_info
+        finally:
+            returned.set()
+
+    def release_apportioned(self):
+        shared_tables.release(self.apportioned_blocks)
+        self.apportioned_blocks = []
+
+    def release(self):
+        self.release_apportioned()
+        shared_tables.release(self.returned_blocks)
+        self.returned_blocks = []
+        self.returned_tables = {}
+
+
+class WorkerPool(object):
+    """
+    Long-lived sub processes that run the sub_procs of every multiprocess step in turn
+    (mp_persistent_workers setting) rather than launching new sub processes for each step.
+
+    Workers are launched once, with the shared data buffers, and then import activitysim, read
+    settings and wrap skims just once rather than once per step. Each worker has its own tasks
+    queue, on which the parent sends it the sub_procs to run (see mp_worker), its own queue for
+    messages to the parent, and its own returned event (see return_shared_tables). Batches of
+    steps run in batches are taken from a batches queue shared by all workers.
+    """
+
+    def __init__(self, num_workers, injectables, shared_data_buffers):
+
+        self.tasks = []
+        self.queues = []
+        self.returned = []
+        self.procs = []
+
+        # batches queue (see run_batches) has to be shared with workers when they are launched
+        self.batches = multiprocessing.Queue()
+
+        for i in range(num_workers):
+            tasks = multiprocessing.Queue()
+            queue = multiprocessing.Queue()
+            returned = multiprocessing.Event()
+            locutor = (i == 0)
+            p = multiprocessing.Process(target=mp_worker, name="mp_worker_%s" % i,
+                                        args=(locutor, tasks, queue, self.batches, returned, injectables),
+                                        kwargs=shared_data_buffers)
+            self.tasks.append(tasks)
+            self.queues.append(queue)
+            self.returned.append(returned)
+            self.procs.append(p)
+
+        for p in self.procs:
+            info(f"start worker process {p.name}")
+            p.start()
+            # see note on windows mmap in run_sub_simulations
+            if sys.platform == 'win32':
+                time.sleep(1)
+            mem.trace_memory_info("%s.start" % p.name)
+
+    def close(self):
+        """
+        stop workers once they have finished their current tasks
+        """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for p in self.procs:
+            p.join()
+            info(f"worker process {p.name} exited with exitcode {p.exitcode}")
+
+    def terminate(self):
+        """
+        terminate any workers still running (e.g. if run failed)
+        """
+        for p in self.procs:
+            if p.exitcode is None:
+                try:
+                    info(f"terminating worker process {p.name}")
+                    p.terminate()
+                    p.join()
+                except Exception as e:
+                    info(f"error terminating worker process {p.name}: {e}")
+
+
 def run_sub_simulations(
         injectables,
         shared_data_buffers,
         step_info, process_names,
-        resume_after, previously_completed, fail_fast):
+        resume_after, previously_completed, fail_fast,
+        handoff=None, pool=None):
     """
     Launch sub processes to run models in step according to specification in step_info.
 
@@ -944,6 +1451,14 @@ def run_sub_simulations(
 
     Wait for all sub-processes to terminate and return list of those that completed successfully.
 
+    If the step is run in batches (num_batches in step_info), process_names are the names of the
+    batches, and num_processes sub-processes take batches from a shared queue as they become free
+    (see run_batches) so faster sub-processes don't sit idle waiting for slower ones. Batches are
+    'completed' as the sub-processes report them.
+
+    If pool, the sub-processes are run by the pool's persistent workers instead of newly launched
+    sub processes, and complete (or fail) as the workers report them.
+
     Parameters
     ----------
     injectables : dict
@@ -953,56 +1468,97 @@ def run_sub_simulations(
     step_info : dict
         step_info from run_list
     process_names : list of str
-        list of sub process names to in parallel
+        list of sub process names to in parallel (or of batch names if step is run in batches)
     resume_after : str or None
         name of simulation to resume after, or LAST_CHECKPOINT to resume where previous run left off
     previously_completed : list of str
         names of processes that successfully completed in previous run
     fail_fast : bool
         whether to raise error if a sub process terminates with nonzero exitcode
+    handoff : SharedTablesHandoff or None
+        if mp_shared_memory_tables, handoff of tables to and from sub processes in shared memory
+    pool : WorkerPool or None
+        if mp_persistent_workers, pool of workers to run sub processes
 
     Returns
     -------
     completed : list of str
-        names of sub_processes that completed successfully
+        names of sub_processes (or batches) that completed successfully
 
     """
     def log_queued_messages():
-        for process, queue in zip(procs, queues):
+        for process, queue, event in zip(procs, queues, returned):
             while not queue.empty():
                 msg = queue.get(block=False)
-                info(f"{process.name} {msg['model']} : {tracing.format_elapsed_time(msg['time'])}")
-                mem.trace_memory_info("%s.%s.completed" % (process.name, msg['model']))
+                if 'tables' in msg:
+                    handoff.receive(msg['name'], msg['tables'], event)
+                elif 'batch' in msg:
+                    info(f"{process.name} batch {msg['batch']} : {tracing.format_elapsed_time(msg['time'])}")
+                    completed.add(msg['batch'])
+                    drop_breadcrumb(step_name, 'completed', list(completed))
+                elif 'done' in msg:
+                    # pool worker finished running sub_proc
+                    del running[process.name]
+                    sub_proc_completed(msg['done'])
+                elif 'failed' in msg:
+                    del running[process.name]
+                    sub_proc_failed(msg['failed'], f"in worker {process.name}")
+                else:
+                    info(f"{process.name} {msg['model']} : {tracing.format_elapsed_time(msg['time'])}")
+                    mem.trace_memory_info("%s.%s.completed" % (process.name, msg['model']))
+
+    def sub_proc_completed(name):
+        info(f"process {name} completed")
+        exited.add(name)
+        if batches is None:
+            completed.add(name)
+            drop_breadcrumb(step_name, 'completed', list(completed))
+        mem.trace_memory_info("%s.completed" % name)
+
+    def sub_proc_failed(name, reason):
+        warning(f"process {name} failed {reason}")
+        failed.add(name)
+        mem.trace_memory_info("%s.failed" % name)
+        if fail_fast:
+            warning(f"fail_fast terminating remaining running processes")
+            for op in procs:
+                if op.exitcode is None:
+                    try:
+                        info(f"terminating process {op.name}")
+                        op.terminate()
+                    except Exception as e:
+                        info(f"error terminating process {op.name}: {e}")
+            raise RuntimeError("Process %s failed" % (name,))
 
     def check_proc_status():
         # we want to drop 'completed' breadcrumb when it happens, lest we terminate
         # if fail_fast flag is set raise
         for p in procs:
-            if p.exitcode is None:
+            if pool is not None:
+                # pool workers report completion of their sub_procs, so we only need to know if they died
+                if p.name in running and p.exitcode is not None:
+                    sub_proc_failed(running.pop(p.name), f"when worker {p.name} exited with exitcode {p.exitcode}")
+            elif p.exitcode is None:
                 pass  # still running
             elif p.exitcode == 0:
                 # completed successfully
-                if p.name not in completed:
-                    info(f"process {p.name} completed")
-                    completed.add(p.name)
-                    drop_breadcrumb(step_name, 'completed', list(completed))
-                    mem.trace_memory_info("%s.completed" % p.name)
+                if p.name not in exited:
+                    sub_proc_completed(p.name)
             else:
                 # process failed
                 if p.name not in failed:
-                    warning(f"process {p.name} failed with exitcode {p.exitcode}")
-                    failed.add(p.name)
-                    mem.trace_memory_info("%s.failed" % p.name)
-                    if fail_fast:
-                        warning(f"fail_fast terminating remaining running processes")
-                        for op in procs:
-                            if op.exitcode is None:
-                                try:
-                                    info(f"terminating process {op.name}")
-                                    op.terminate()
-                                except Exception as e:
-                                    info(f"error terminating process {op.name}: {e}")
-                        raise RuntimeError("Process %s failed" % (p.name,))
+                    sub_proc_failed(p.name, f"with exitcode {p.exitcode}")
+
+    def sub_proc_handoff(process_name):
+        if batches is not None:
+            # all batches' handoffs, since we don't know which sub processes will run which batches
+            return batch_handoff
+        return handoff.sub_proc_args(process_name) if handoff else None
+
+    def still_running():
+        if pool is not None:
+            return bool(running)
+        return bool(multiprocessing.active_children())
 
     def idle(seconds):
         # idle for specified number of seconds, monitoring message queue and sub process status
@@ -1041,77 +1597,129 @@ def run_sub_simulations(
     if resume_after is None and step_info['step_num'] > 0:
         resume_after = LAST_CHECKPOINT
 
-    num_simulations = len(process_names)
     procs = []
     queues = []
+    returned = []
 
     completed = set(previously_completed)
     failed = set([])  # so we can log process failure first time it happens
+    exited = set([])  # so we can log process completion first time it happens
+    running = {}  # names of sub_procs being run by pool workers, keyed by worker name
     drop_breadcrumb(step_name, 'completed', list(completed))
 
-    for i, process_name in enumerate(process_names):
-        q = multiprocessing.Queue()
-        spokesman = (i == 0)
-
-        args = OrderedDict(spokesman=spokesman,
-                           queue=q,
-                           injectables=injectables,
-                           step_info=step_info,
-                           resume_after=resume_after)
-
-        debug(f"create_process {process_name} target={mp_run_simulation}")
-        for k in args:
-            debug(f"create_process {process_name} arg {k}={args[k]}")
-        for k in shared_data_buffers:
-            debug(f"create_process {process_name} shared_data_buffers {k}={shared_data_buffers[k]}")
-
-        p = multiprocessing.Process(target=mp_run_simulation, name=process_name,
-                                    args=(spokesman, q, injectables, step_info, resume_after,),
-                                    kwargs=shared_data_buffers)
-
-        procs.append(p)
-        queues.append(q)
-
-    # - start processes
-    for i, p in zip(list(range(num_simulations)), procs):
-        info(f"start process {p.name}")
-        p.start()
-
-        """
-        windows mmap does not handle multiple simultaneous calls from different processes for the same tagname.
-        Process start causes a call to mmap to initialize the wrapper for the anonymous shared memory arrays
-        in the shared_data_buffers kwargs. some of the processses fail with WinError 1450 (or similar error)
-        OSError: [WinError 1450] Insufficient system resources exist to complete the requested service.
-        Judging by the commented-out assert, this (or a related) issue may have been around in some form for a while.
-
-        def __setstate__(self, state):
-            self.size, self.name = self._state = state
-            # Reopen existing mmap
-            self.buffer = mmap.mmap(-1, self.size, tagname=self.name)
-            # XXX Temporarily preventing buildbot failures while determining
-            # XXX the correct long-term fix. See issue 23060
-            #assert _winapi.GetLastError() == _winapi.ERROR_ALREADY_EXISTS
-        """
-        if sys.platform == 'win32':
-            time.sleep(1)
-
-        mem.trace_memory_info("%s.start" % p.name)
+    if step_info.get('num_batches'):
+        # queue batches for num_processes sub-processes to take as they become free
+        batches = pool.batches if pool is not None else multiprocessing.Queue()
+        for batch_name in process_names:
+            batches.put(batch_name)
+        batch_handoff = {batch_name: handoff.sub_proc_args(batch_name) for batch_name in process_names} \
+            if handoff else None
+
+        info(f"step {step_name}: running {len(process_names)} batches in {step_info['num_processes']} processes")
+
+        num_simulations = min(step_info['num_processes'], len(process_names))
+        process_names = ["%s_worker_%s" % (step_name, i) for i in range(num_simulations)]
+        for _ in process_names:
+            batches.put(None)
+    else:
+        batches = None
+        num_simulations = len(process_names)
+
+    if pool is not None:
+        assert num_simulations <= len(pool.procs)
+
+        # - send sub_procs to pool workers
+        for i, process_name in enumerate(process_names):
+            p = pool.procs[i]
+            task = {'process_name': process_name,
+                    'step_info': step_info,
+                    'resume_after': resume_after,
+                    'handoff': sub_proc_handoff(process_name),
+                    'batches': batches is not None}
+            debug(f"run {process_name} on worker {p.name}")
+            pool.tasks[i].put(task)
+            running[p.name] = process_name
+
+            procs.append(p)
+            queues.append(pool.queues[i])
+            returned.append(pool.returned[i])
+    else:
+        for i, process_name in enumerate(process_names):
+            q = multiprocessing.Queue()
+            event = multiprocessing.Event()
+            spokesman = (i == 0)
+            process_handoff = sub_proc_handoff(process_name)
+
+            args = OrderedDict(spokesman=spokesman,
+                               queue=q,
+                               injectables=injectables,
+                               step_info=step_info,
+                               resume_after=resume_after,
+                               handoff=process_handoff,
+                               batches=batches,
+                               returned=event)
+
+            debug(f"create_process {process_name} target={mp_run_simulation}")
+            for k in args:
+                debug(f"create_process {process_name} arg {k}={args[k]}")
+            for k in shared_data_buffers:
+                debug(f"create_process {process_name} shared_data_buffers {k}={shared_data_buffers[k]}")
+
+            p = multiprocessing.Process(target=mp_run_simulation, name=process_name,
+                                        args=(spokesman, q, injectables, step_info, resume_after, process_handoff,
+                                              batches, event),
+                                        kwargs=shared_data_buffers)
+
+            procs.append(p)
+            queues.append(q)
+            returned.append(event)
+
+        # - start processes
+        for i, p in zip(list(range(num_simulations)), procs):
+            info(f"start process {p.name}")
+            p.start()
+
+            """
+            windows mmap does not handle multiple simultaneous calls from different processes for the same tagname.
+            Process start causes a call to mmap to initialize the wrapper for the anonymous shared memory arrays
+            in the shared_data_buffers kwargs. some of the processses fail with WinError 1450 (or similar error)
+            OSError: [WinError 1450] Insufficient system resources exist to complete the requested service.
+            Judging by the commented-out assert, this (or a related) issue may have been around in some form
+            for a while.
+
+            def __setstate__(self, state):
+                self.size, self.name = self._state = state
+                # Reopen existing mmap
+                self.buffer = mmap.mmap(-1, self.size, tagname=self.name)
+                # XXX Temporarily preventing buildbot failures while determining
+                # XXX the correct long-term fix. See issue 23060
+                #assert _winapi.GetLastError() == _winapi.ERROR_ALREADY_EXISTS
+            """
+            if sys.platform == 'win32':
+                time.sleep(1)
+
+            mem.trace_memory_info("%s.start" % p.name)
 
     # - idle logging queued messages and proc completion
-    while multiprocessing.active_children():
+    while still_running():
         idle(seconds=1)
     idle(seconds=0)
 
     # no need to join() explicitly since multiprocessing.active_children joins completed procs
 
-    for p in procs:
-        assert p.exitcode is not None
-        if p.exitcode:
-            error(f"Process %s failed with exitcode {p.exitcode}")
-            assert p.name in failed
-        else:
-            info(f"Process {p.name} completed with exitcode {p.exitcode}")
-            assert p.name in completed
+    if pool is None:
+        for p in procs:
+            assert p.exitcode is not None
+            if p.exitcode:
+                error(f"Process %s failed with exitcode {p.exitcode}")
+                assert p.name in failed
+            else:
+                info(f"Process {p.name} completed with exitcode {p.exitcode}")
+                assert p.name in exited
+
+        if batches is not None:
+            # don't wait to flush batch names left in queue (if sub-processes failed) when we exit
+            batches.cancel_join_thread()
 
     t0 = tracing.print_elapsed_time('run_sub_simulations step %s' % step_name, t0)
 
@@ -1135,11 +1743,12 @@ def run_sub_task(p):
     t0 = tracing.print_elapsed_time()
     p.start()
 
-    while multiprocessing.active_children():
+    # not multiprocessing.active_children, which includes any persistent WorkerPool workers
+    while p.is_alive():
         mem.trace_memory_info()
         time.sleep(1)
 
-    # no need to join explicitly since multiprocessing.active_children joins completed procs
+    # no need to join explicitly since is_alive reaps completed proc
     # p.join()
 
     t0 = tracing.print_elapsed_time('sub_process %s' % p.name, t0)
@@ -1226,13 +1835,23 @@ def run_multiprocess(run_list, injectables):
     def find_breadcrumb(crumb, default=None):
         return old_breadcrumbs.get(step_name, {}).get(crumb, default)
 
+    # hand off tables to and from multiprocess step sub-processes in shared memory
+    shared_memory_tables = setting('mp_shared_memory_tables', False)
+    info(f"run_multiprocess mp_shared_memory_tables: {shared_memory_tables}")
+
     # - allocate shared data
     shared_data_buffers = {}
 
+    # memmapped skim cache files are shared by sub-processes via the os page cache
+    memmap_skims = skims.use_memmap_skim_cache()
+
     t0 = tracing.print_elapsed_time()
-    shared_data_buffers.update(allocate_shared_skim_buffers())
-    t0 = tracing.print_elapsed_time('allocate shared skim buffer', t0)
-    mem.trace_memory_info("allocate_shared_skim_buffer.completed")
+    if memmap_skims:
+        info("run_multiprocess memmap_skim_cache: skipping allocate_shared_skim_buffers")
+    else:
+        shared_data_buffers.update(allocate_shared_skim_buffers())
+        t0 = tracing.print_elapsed_time('allocate shared skim buffer', t0)
+        mem.trace_memory_info("allocate_shared_skim_buffer.completed")
 
     # combine shared_skim_buffer and shared_shadow_pricing_buffer in shared_data_buffer
     t0 = tracing.print_elapsed_time()
@@ -1241,60 +1860,101 @@ def run_multiprocess(run_list, injectables):
     mem.trace_memory_info("allocate_shared_shadow_pricing_buffers.completed")
 
     # - mp_setup_skims
-    run_sub_task(
-        multiprocessing.Process(
-            target=mp_setup_skims, name='mp_setup_skims', args=(injectables,),
-            kwargs=shared_data_buffers)
-    )
-    t0 = tracing.print_elapsed_time('setup skims', t0)
+    if not memmap_skims:
+        run_sub_task(
+            multiprocessing.Process(
+                target=mp_setup_skims, name='mp_setup_skims', args=(injectables,),
+                kwargs=shared_data_buffers)
+        )
+        t0 = tracing.print_elapsed_time('setup skims', t0)
+
+    # - start persistent workers to run the sub-processes of every step
+    pool = None
+    if setting('mp_persistent_workers', False):
+        num_workers = max(step_info['num_processes'] for step_info in run_list['multiprocess_steps'])
+        info(f"run_multiprocess mp_persistent_workers: starting {num_workers} workers")
+        pool = WorkerPool(num_workers, injectables, shared_data_buffers)
 
-    # - for each step in run list
-    for step_info in run_list['multiprocess_steps']:
+    try:
+        # - for each step in run list
+        for step_info in run_list['multiprocess_steps']:
 
-        step_name = step_info['name']
+            step_name = step_info['name']
 
-        num_processes = step_info['num_processes']
-        slice_info = step_info.get('slice', None)
+            num_processes = step_info['num_processes']
+            num_batches = step_info.get('num_batches', 0)
+            slice_info = step_info.get('slice', None)
 
-        if num_processes == 1:
-            sub_proc_names = [step_name]
-        else:
-            sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_processes)]
-
-        # - mp_apportion_pipeline
-        if not skip_phase('apportion') and num_processes > 1:
-            run_sub_task(
-                multiprocessing.Process(
-                    target=mp_apportion_pipeline, name='%s_apportion' % step_name,
-                    args=(injectables, sub_proc_names, slice_info))
-            )
-        drop_breadcrumb(step_name, 'apportion')
-
-        # - run_sub_simulations
-        if not skip_phase('simulate'):
-            resume_after = step_info.get('resume_after', None)
-
-            previously_completed = find_breadcrumb('completed', default=[])
-
-            completed = run_sub_simulations(injectables,
-                                            shared_data_buffers,
-                                            step_info,
-                                            sub_proc_names,
-                                            resume_after, previously_completed, fail_fast)
-
-            if len(completed) != num_processes:
-                raise RuntimeError("%s processes failed in step %s" %
-                                   (num_processes - len(completed), step_name))
-        drop_breadcrumb(step_name, 'simulate')
-
-        # - mp_coalesce_pipelines
-        if not skip_phase('coalesce') and num_processes > 1:
-            run_sub_task(
-                multiprocessing.Process(
-                    target=mp_coalesce_pipelines, name='%s_coalesce' % step_name,
-                    args=(injectables, sub_proc_names, slice_info))
-            )
-        drop_breadcrumb(step_name, 'coalesce')
+            if num_batches:
+                # sub-processes run batches (each with its own apportioned pipeline) as they become free
+                sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_batches)]
+            elif num_processes == 1:
+                sub_proc_names = [step_name]
+            else:
+                sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_processes)]
+
+            num_sub_procs = len(sub_proc_names)
+
+            # tables handed off to and from sub processes in shared memory rather than pipeline files
+            handoff = SharedTablesHandoff() if shared_memory_tables and num_sub_procs > 1 else None
+
+            try:
+                # - mp_apportion_pipeline
+                if not skip_phase('apportion') and num_sub_procs > 1:
+                    if handoff:
+                        handoff.apportion(sub_proc_names, slice_info)
+                    else:
+                        run_sub_task(
+                            multiprocessing.Process(
+                                target=mp_apportion_pipeline, name='%s_apportion' % step_name,
+                                args=(injectables, sub_proc_names, slice_info))
+                        )
+
+                # tables apportioned in shared memory aren't in sub_proc pipelines until they have run
+                if not (handoff and handoff.apportioned):
+                    drop_breadcrumb(step_name, 'apportion')
+
+                # - run_sub_simulations
+                if not skip_phase('simulate'):
+                    resume_after = step_info.get('resume_after', None)
+
+                    previously_completed = find_breadcrumb('completed', default=[])
+
+                    completed = run_sub_simulations(injectables,
+                                                    shared_data_buffers,
+                                                    step_info,
+                                                    sub_proc_names,
+                                                    resume_after, previously_completed, fail_fast,
+                                                    handoff=handoff, pool=pool)
+
+                    if len(completed) != num_sub_procs:
+                        raise RuntimeError("%s %s failed in step %s" %
+                                           (num_sub_procs - len(completed),
+                                            'batches' if num_batches else 'processes', step_name))
+                if handoff:
+                    handoff.release_apportioned()
+                drop_breadcrumb(step_name, 'apportion')
+                drop_breadcrumb(step_name, 'simulate')
+
+                # - mp_coalesce_pipelines
+                if not skip_phase('coalesce') and num_sub_procs > 1:
+                    run_sub_task(
+                        multiprocessing.Process(
+                            target=mp_coalesce_pipelines, name='%s_coalesce' % step_name,
+                            args=(injectables, sub_proc_names, slice_info,
+                                  handoff.returned_tables if handoff else None))
+                    )
+                drop_breadcrumb(step_name, 'coalesce')
+
+            finally:
+                if handoff:
+                    handoff.release()
+
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     mem.log_hwm()
 
@@ -1493,6 +2153,19 @@ def get_run_list():
                     raise RuntimeError("num_processes > 1 but no slice info for step %s"
                                        " in multiprocess_steps" % name)
 
+            # - validate num_batches (step run in batches taken by sub-processes as they become free)
+            num_batches = step.get('num_batches', 0)
+            if num_batches:
+                if not isinstance(num_batches, int) or num_batches < 2:
+                    raise RuntimeError("bad value (%s) for num_batches for step %s"
+                                       " in multiprocess_steps" % (num_batches, name))
+                if 'slice' not in step:
+                    raise RuntimeError("num_batches but no slice info for step %s"
+                                       " in multiprocess_steps" % name)
+                if num_processes > num_batches:
+                    info(f"Setting num_processes = {num_batches} (num_batches) for step {name}")
+                    num_processes = num_batches
+
             multiprocess_steps[istep]['num_processes'] = num_processes
 
             # - validate chunk_size and assign default
@@ -1552,6 +2225,17 @@ def get_run_list():
 
             multiprocess_steps[istep]['models'] = step_models
 
+            # shadow priced models synchronize choices across all of the step's sub-processes
+            # so they can't be run in batches, which aren't all run at the same time
+            if multiprocess_steps[istep].get('num_batches'):
+                shadow_pricing_models = \
+                    config.read_model_settings('shadow_pricing.yaml').get('shadow_pricing_models') or {}
+                batched_models = [m.split('.', 1)[0].lstrip(pipeline.NO_CHECKPOINT_PREFIX) for m in step_models]
+                shadow_priced = [m for m in shadow_pricing_models.values() if m in batched_models]
+                if shadow_priced:
+                    raise RuntimeError("shadow priced models %s in step %s can't be run with num_batches" %
+                                       (shadow_priced, multiprocess_steps[istep]['name']))
+
         run_list['multiprocess_steps'] = multiprocess_steps
 
         # - add resume breadcrumbs
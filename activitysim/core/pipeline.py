@@ -7,6 +7,8 @@ from builtins import object
 import os
 import logging
 import datetime as dt
+import queue
+import threading
 
 import pandas as pd
 
@@ -16,6 +18,9 @@ from . import config
 from . import random
 from . import tracing
 from . import mem
+from . import expression_cache
+from . import chunk
+from . import pipeline_store
 
 from . import util
 from .tracing import print_elapsed_time
@@ -62,6 +67,9 @@ class Pipeline(object):
 
         self.pipeline_store = None
 
+        # background thread writing checkpoints (if checkpoint_write_queue_size setting)
+        self.checkpoint_writer = None
+
         self.is_open = False
 
     def rng(self):
@@ -72,6 +80,73 @@ class Pipeline(object):
 _PIPELINE = Pipeline()
 
 
+class CheckpointWriter(object):
+    """
+    Background thread that writes checkpoints to the pipeline store, so the next model can run
+    while the previous checkpoint is written.
+
+    Only used with the parquet pipeline store, since hdf5 files can't safely be written in the
+    background while models do their own hdf5 I/O in the main thread.
+
+    Checkpoints are queued as (checkpoint_name, tables, checkpoints_df) with snapshots of the
+    changed tables, and written in order. As with synchronous writes, the checkpoints table is only
+    written once all of the checkpoint's tables have been written, so a checkpoint in the store's
+    checkpoints table always has its data.
+
+    The queue is bounded, so add_checkpoint blocks if the writer falls more than queue_size
+    checkpoints behind (rather than holding an unbounded number of table snapshots in memory).
+    """
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # don't write any later checkpoints once one has failed
+                if self.error is None:
+                    write_checkpoint(*item)
+            except Exception as e:
+                logger.exception("checkpoint_writer error writing checkpoint '%s'" % item[0])
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("checkpoint_writer failed: %s" % self.error) from self.error
+
+    def put(self, checkpoint_name, tables, checkpoints):
+        self.check()
+        self.queue.put((checkpoint_name, tables, checkpoints))
+
+    def wait(self):
+        """
+        wait for all queued checkpoints to be written
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        wait for all queued checkpoints to be written and stop writer thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+def is_open():
+
+    return _PIPELINE.is_open
+
+
 def be_open():
 
     if not _PIPELINE.is_open:
@@ -100,7 +175,7 @@ def close_open_files():
 
 def open_pipeline_store(overwrite=False):
     """
-    Open the pipeline checkpoint store
+    Open the pipeline checkpoint store (of format specified by pipeline_store_format setting)
 
     Parameters
     ----------
@@ -115,25 +190,44 @@ def open_pipeline_store(overwrite=False):
 
     if overwrite:
         try:
-            if os.path.isfile(pipeline_file_path):
+            if os.path.exists(pipeline_file_path):
                 logger.debug("removing pipeline store: %s" % pipeline_file_path)
-                os.unlink(pipeline_file_path)
+                pipeline_store.remove_store(pipeline_file_path)
         except Exception as e:
             print(e)
             logger.warning("Error removing %s: %s" % (pipeline_file_path, e))
 
-    _PIPELINE.pipeline_store = pd.HDFStore(pipeline_file_path, mode='a')
+    queue_size = config.setting('checkpoint_write_queue_size', 0)
+    if queue_size and pipeline_store.store_format_setting() == pipeline_store.HDF5:
+        # PyTables/HDF5 aren't thread safe, and models read (e.g. skims and input tables) and write
+        # hdf5 files in the main thread while the background writer would be writing the pipeline
+        raise RuntimeError("checkpoint_write_queue_size requires pipeline_store_format %s (not %s)" %
+                           (pipeline_store.PARQUET, pipeline_store.HDF5))
+
+    _PIPELINE.pipeline_store = pipeline_store.open_store(pipeline_file_path, mode='a')
+
+    if queue_size:
+        logger.info("writing checkpoints in background (checkpoint_write_queue_size %s)" % queue_size)
+        _PIPELINE.checkpoint_writer = CheckpointWriter(queue_size)
 
     logger.debug("opened pipeline_store")
 
 
 def get_pipeline_store():
     """
-    Return the open pipeline hdf5 checkpoint store or return None if it not been opened
+    Return the open pipeline checkpoint store or return None if it not been opened
     """
     return _PIPELINE.pipeline_store
 
 
+def wait_for_checkpoint_writes():
+    """
+    Wait for any checkpoints being written in the background to be written to the pipeline store
+    """
+    if _PIPELINE.checkpoint_writer is not None:
+        _PIPELINE.checkpoint_writer.wait()
+
+
 def get_rn_generator():
     """
     Return the singleton random number object
@@ -145,7 +239,7 @@ def get_rn_generator():
     return _PIPELINE.rng()
 
 
-def read_df(table_name, checkpoint_name=None):
+def read_df(table_name, checkpoint_name=None, columns=None):
     """
     Read a pandas dataframe from the pipeline store.
 
@@ -154,12 +248,14 @@ def read_df(table_name, checkpoint_name=None):
 
     The only exception is the checkpoints dataframe, which just has a table_name
 
-    An error will be raised by HDFStore if the table is not found
+    A KeyError will be raised by the pipeline store if the table is not found
 
     Parameters
     ----------
     table_name : str
     checkpoint_name : str
+    columns : list of str or None
+        columns to read (all columns if None)
 
     Returns
     -------
@@ -168,13 +264,16 @@ def read_df(table_name, checkpoint_name=None):
 
     """
 
+    # background writer could be writing the table (and pipeline stores aren't thread safe)
+    wait_for_checkpoint_writes()
+
     store = get_pipeline_store()
-    df = store[pipeline_table_key(table_name, checkpoint_name)]
+    df = store.read_df(table_name, checkpoint_name, columns=columns)
 
     return df
 
 
-def write_df(df, table_name, checkpoint_name=None):
+def write_df(df, table_name, checkpoint_name=None, base_checkpoint_name=None, flush=True):
     """
     Write a pandas dataframe to the pipeline store.
 
@@ -191,6 +290,11 @@ def write_df(df, table_name, checkpoint_name=None):
         also conventionally the orca table name
     checkpoint_name : str
         the checkpoint at which the table was created/modified
+    base_checkpoint_name : str or None
+        checkpoint of the previously written version of the table
+        (stores that support column deltas only write columns that changed since then)
+    flush : bool
+        flush store after writing (write_checkpoint flushes once after writing all its tables)
     """
 
     # coerce column names to str as unicode names will cause PyTables to pickle them
@@ -198,9 +302,10 @@ def write_df(df, table_name, checkpoint_name=None):
 
     store = get_pipeline_store()
 
-    store[pipeline_table_key(table_name, checkpoint_name)] = df
+    store.write_df(df, table_name, checkpoint_name, base_checkpoint_name=base_checkpoint_name)
 
-    store.flush()
+    if flush:
+        store.flush()
 
 
 def rewrap(table_name, df=None):
@@ -264,6 +369,9 @@ def add_checkpoint(checkpoint_name):
     Detect any changed tables , re-wrap them and write the current version to the pipeline store.
     Write the current state of the random number generator.
 
+    If checkpoint_write_queue_size setting, snapshots of the changed tables are queued to be
+    written by the background checkpoint_writer instead.
+
     Parameters
     ----------
     checkpoint_name : str
@@ -272,6 +380,13 @@ def add_checkpoint(checkpoint_name):
 
     logger.debug("add_checkpoint %s timestamp %s" % (checkpoint_name, timestamp))
 
+    # expression values are only cached between checkpoints
+    expression_cache.clear()
+
+    writer = _PIPELINE.checkpoint_writer
+
+    # list of (table_name, df, base_checkpoint_name) to write
+    tables = []
     for table_name in orca_dataframe_tables():
 
         # if we have not already checkpointed it or it has changed
@@ -279,14 +394,19 @@ def add_checkpoint(checkpoint_name):
         if len(orca.list_columns_for_table(table_name)):
             # rewrap the changed orca table as a unitary DataFrame-backed DataFrameWrapper table
             df = rewrap(table_name)
+            if writer is not None:
+                # snapshot, since models may modify the rewrapped table in place while it is being written
+                df = df.copy()
         elif table_name not in _PIPELINE.last_checkpoint or table_name in _PIPELINE.replaced_tables:
+            # to_frame returns a copy
             df = orca.get_table(table_name).to_frame()
         else:
             continue
 
         logger.debug("add_checkpoint '%s' table '%s' %s" %
                      (checkpoint_name, table_name, util.df_size(df)))
-        write_df(df, table_name, checkpoint_name)
+
+        tables.append((table_name, df, _PIPELINE.last_checkpoint.get(table_name) or None))
 
         # remember which checkpoint it was last written
         _PIPELINE.last_checkpoint[table_name] = checkpoint_name
@@ -307,8 +427,34 @@ def add_checkpoint(checkpoint_name):
     for c in checkpoints.columns:
         checkpoints[c] = checkpoints[c].fillna('')
 
+    if writer is not None:
+        writer.put(checkpoint_name, tables, checkpoints)
+    else:
+        write_checkpoint(checkpoint_name, tables, checkpoints)
+
+
+def write_checkpoint(checkpoint_name, tables, checkpoints):
+    """
+    Write checkpoint tables and then the checkpoints table to the pipeline store
+
+    The checkpoints table is written last, so the checkpoint is only recorded in the store once
+    all its data has been written.
+
+    Parameters
+    ----------
+    checkpoint_name : str
+    tables : list of (table_name, df, base_checkpoint_name)
+    checkpoints : pandas.DataFrame
+        checkpoints table (with row for checkpoint_name)
+    """
+
+    for table_name, df, base_checkpoint_name in tables:
+        write_df(df, table_name, checkpoint_name, base_checkpoint_name=base_checkpoint_name, flush=False)
+
     # write it to the store, overwriting any previous version (no way to simply extend)
-    write_df(checkpoints, CHECKPOINT_TABLE_NAME)
+    write_df(checkpoints, CHECKPOINT_TABLE_NAME, flush=False)
+
+    get_pipeline_store().flush()
 
 
 def orca_dataframe_tables():
@@ -327,7 +473,7 @@ def checkpointed_tables():
             if checkpoint_name and name not in NON_TABLE_COLUMNS]
 
 
-def load_checkpoint(checkpoint_name):
+def load_checkpoint(checkpoint_name, tables=None):
     """
     Load dataframes and restore random number channel state from pipeline hdf5 file.
     This restores the pipeline state that existed at the specified checkpoint in a prior simulation.
@@ -337,11 +483,20 @@ def load_checkpoint(checkpoint_name):
     ----------
     checkpoint_name : str
         model_name of checkpoint to load (resume_after argument to open_pipeline)
+    tables : dict {<table_name>: pandas.DataFrame} or None
+        checkpoints table and last checkpoint's tables already in memory (see open_pipeline)
+        to load instead of reading them from the pipeline store
     """
 
     logger.info("load_checkpoint %s" % (checkpoint_name))
 
-    checkpoints = read_df(CHECKPOINT_TABLE_NAME)
+    # any checkpoints still being written by background checkpoint_writer
+    wait_for_checkpoint_writes()
+
+    if tables is not None:
+        checkpoints = tables[CHECKPOINT_TABLE_NAME]
+    else:
+        checkpoints = read_df(CHECKPOINT_TABLE_NAME)
 
     if checkpoint_name == LAST_CHECKPOINT:
         checkpoint_name = checkpoints[CHECKPOINT_NAME].iloc[-1]
@@ -376,12 +531,13 @@ def load_checkpoint(checkpoint_name):
     logger.info("load_checkpoint %s timestamp %s"
                 % (checkpoint_name, _PIPELINE.last_checkpoint['timestamp']))
 
-    tables = checkpointed_tables()
-
     loaded_tables = {}
-    for table_name in tables:
-        # read dataframe from pipeline store
-        df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name])
+    for table_name in checkpointed_tables():
+        if tables is not None:
+            df = tables[table_name]
+        else:
+            # read dataframe from pipeline store
+            df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name])
         logger.info("load_checkpoint table %s %s" % (table_name, df.shape))
         # register it as an orca table
         rewrap(table_name, df)
@@ -475,17 +631,23 @@ def run_model(model_name):
         logger.info("##### skipping %s checkpoint for %s" % (step_name, model_name))
 
 
-def open_pipeline(resume_after=None):
+def open_pipeline(resume_after=None, tables=None):
     """
     Start pipeline, either for a new run or, if resume_after, loading checkpoint from pipeline.
 
     If resume_after, then we expect the pipeline hdf5 file to exist and contain
     checkpoints from a previous run, including a checkpoint with name specified in resume_after
 
+    If tables, start from the last checkpoint of tables handed off in memory (e.g. tables sliced
+    for a multiprocessing sub-process) rather than from the pipeline store. They are written to a
+    new pipeline store (so the run can be resumed as usual) but not read back.
+
     Parameters
     ----------
     resume_after : str or None
         name of checkpoint to load from pipeline store
+    tables : dict {<table_name>: pandas.DataFrame} or None
+        checkpoints table (with last checkpoint as last row) and the tables in last checkpoint
     """
 
     logger.info("open_pipeline")
@@ -497,8 +659,23 @@ def open_pipeline(resume_after=None):
     _PIPELINE.is_open = True
 
     get_rn_generator().set_base_seed(inject.get_injectable('rng_base_seed', 0))
+    get_rn_generator().set_channel_type(config.setting('rng_channel_type', random.SIMPLE_CHANNEL))
+    expression_cache.set_cache_size(config.setting('expression_cache_size', 0))
+    chunk.set_adaptive(config.setting('adaptive_chunking', False))
 
-    if resume_after:
+    if tables is not None:
+        # new pipeline with tables handed off in memory
+        logger.debug("open_pipeline - new pipeline with %s tables" % len(tables))
+        open_pipeline_store(overwrite=True)
+        checkpoints = tables[CHECKPOINT_TABLE_NAME]
+        checkpoint_name = checkpoints[CHECKPOINT_NAME].iloc[-1]
+        # snapshot tables if background writer, since they will be registered (and modified) as orca tables
+        copy = _PIPELINE.checkpoint_writer is not None
+        checkpoint_tables = [(table_name, df.copy() if copy else df, None)
+                             for table_name, df in tables.items() if table_name != CHECKPOINT_TABLE_NAME]
+        write_checkpoint(checkpoint_name, checkpoint_tables, checkpoints)
+        load_checkpoint(checkpoint_name, tables)
+    elif resume_after:
         # open existing pipeline
         logger.debug("open_pipeline - open existing pipeline")
         open_pipeline_store(overwrite=False)
@@ -539,7 +716,14 @@ def close_pipeline():
 
     close_open_files()
 
-    _PIPELINE.pipeline_store.close()
+    try:
+        if _PIPELINE.checkpoint_writer is not None:
+            # wait for pending checkpoint writes
+            _PIPELINE.checkpoint_writer.close()
+    finally:
+        _PIPELINE.pipeline_store.close()
+
+    chunk.save_row_sizes()
 
     _PIPELINE.init_state()
 
@@ -593,7 +777,19 @@ def run(models, resume_after=None):
     # don't close the pipeline, as the user may want to read intermediate results from the store
 
 
-def get_table(table_name, checkpoint_name=None):
+def current_table(table_name, columns=None):
+    """
+    Return current version of orca table (only specified columns, in order, if columns is not None)
+    """
+
+    if columns is None:
+        return orca.get_table(table_name).to_frame()
+
+    columns = list(columns)
+    return orca.get_table(table_name).to_frame(columns)[columns]
+
+
+def get_table(table_name, checkpoint_name=None, columns=None):
     """
     Return pandas dataframe corresponding to table_name
 
@@ -603,10 +799,13 @@ def get_table(table_name, checkpoint_name=None):
     if checkpoint_name is specified, return table as it was at that checkpoint
     (the most recently checkpointed version of the table at or before checkpoint_name)
 
+    if columns is specified, only those columns are returned (and read from the pipeline store)
+
     Parameters
     ----------
     table_name : str
     checkpoint_name : str or None
+    columns : list of str or None
 
     Returns
     -------
@@ -621,7 +820,7 @@ def get_table(table_name, checkpoint_name=None):
             raise RuntimeError("get_table: checkpoint_name ('%s') not supported"
                                "for non-checkpointed table '%s'" % (checkpoint_name, table_name))
 
-        return orca.get_table(table_name).to_frame()
+        return current_table(table_name, columns)
 
     # if they want current version of table, no need to read from pipeline store
     if checkpoint_name is None:
@@ -633,7 +832,7 @@ def get_table(table_name, checkpoint_name=None):
             raise RuntimeError("table '%s' was dropped." % table_name)
 
         # return orca.get_table(table_name).local
-        return orca.get_table(table_name).to_frame()
+        return current_table(table_name, columns)
 
     # find the requested checkpoint
     checkpoint = \
@@ -649,9 +848,9 @@ def get_table(table_name, checkpoint_name=None):
 
     # if this version of table is same as current
     if _PIPELINE.last_checkpoint.get(table_name, None) == last_checkpoint_name:
-        return orca.get_table(table_name).to_frame()
+        return current_table(table_name, columns)
 
-    return read_df(table_name, last_checkpoint_name)
+    return read_df(table_name, last_checkpoint_name, columns=columns)
 
 
 def get_checkpoints():
@@ -669,10 +868,12 @@ def get_checkpoints():
     store = get_pipeline_store()
 
     if store is not None:
-        df = store[CHECKPOINT_TABLE_NAME]
+        wait_for_checkpoint_writes()
+        df = store.read_df(CHECKPOINT_TABLE_NAME)
     else:
         pipeline_file_path = config.pipeline_file_path(orca.get_injectable('pipeline_file_name'))
-        df = pd.read_hdf(pipeline_file_path, CHECKPOINT_TABLE_NAME)
+        with pipeline_store.open_store(pipeline_file_path, mode='r') as store:
+            df = store.read_df(CHECKPOINT_TABLE_NAME)
 
     # non-table columns first (column order in df is random because created from a dict)
     table_names = [name for name in df.columns.values if name not in NON_TABLE_COLUMNS]
@@ -0,0 +1,313 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+"""
+Pipeline checkpoint stores
+
+The pipeline stores a version of each table for every checkpoint in which it changed, under
+the key '<table_name>/<checkpoint_name>' (and the checkpoints table under 'checkpoints').
+
+HdfPipelineStore keeps each version of a table in a single pandas.HDFStore file (the default).
+
+ParquetPipelineStore keeps a directory per checkpoint, with a parquet file for each table version
+holding only the columns that are new or changed since the version it is based on, and a json
+manifest listing the (checkpoint) file in which each column of the version is stored. Unchanged
+columns are referenced rather than copied, and reading a subset of columns only reads those.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from activitysim.core import config
+
+logger = logging.getLogger(__name__)
+
+HDF5 = 'hdf5'
+PARQUET = 'parquet'
+STORE_FORMATS = [HDF5, PARQUET]
+
+
+def split_key(key):
+    """
+    split pipeline store key into (table_name, checkpoint_name), checkpoint_name None if no checkpoint
+    """
+    table_name, _, checkpoint_name = key.strip('/').partition('/')
+    return table_name, checkpoint_name or None
+
+
+class HdfPipelineStore(object):
+    """
+    Pipeline store with each table version stored whole in a single pandas.HDFStore file
+    """
+
+    def __init__(self, file_path, mode='a'):
+        self.file_path = file_path
+        self.store = pd.HDFStore(file_path, mode=mode)
+
+    def read_df(self, table_name, checkpoint_name=None, columns=None):
+        key = table_name if checkpoint_name is None else "%s/%s" % (table_name, checkpoint_name)
+        df = self.store[key]
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    def write_df(self, df, table_name, checkpoint_name=None, base_checkpoint_name=None):
+        # whole table is written, so base_checkpoint_name isn't needed
+        key = table_name if checkpoint_name is None else "%s/%s" % (table_name, checkpoint_name)
+        self.store[key] = df
+
+    def __getitem__(self, key):
+        return self.read_df(*split_key(key))
+
+    def __setitem__(self, key, df):
+        self.write_df(df, *split_key(key))
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def column_digest(values):
+    """
+    Return digest of content and dtype of column or index values (to detect unchanged columns)
+    """
+
+    if isinstance(values, (pd.Index, pd.MultiIndex)):
+        names = str(list(values.names))
+    else:
+        names = ''
+
+    data = values.values if isinstance(values, pd.Series) else values
+    if isinstance(data, np.ndarray) and data.dtype != np.object_:
+        # fast path for numeric columns
+        data = np.ascontiguousarray(data).view(np.uint8)
+    else:
+        # object, categorical and extension types (and MultiIndex)
+        data = pd.util.hash_pandas_object(values, index=False).values
+
+    digest = hashlib.sha1(data)
+    digest.update(("%s %s" % (values.dtype, names)).encode())
+
+    return digest.hexdigest()
+
+
+class ParquetPipelineStore(object):
+    """
+    Pipeline store with a directory per checkpoint and column-level checkpoint deltas
+
+    ::
+
+      <store_dir>/checkpoints.parquet
+      <store_dir>/<checkpoint_name>/<table_name>.parquet        (new or changed columns)
+      <store_dir>/<checkpoint_name>/<table_name>.manifest.json  ({'index': [checkpoint, digest],
+                                                                  'columns': [[column, checkpoint, digest]]})
+
+    The manifest is written after the parquet file, so a table version only exists once its data does.
+    """
+
+    MANIFEST_SUFFIX = '.manifest.json'
+
+    def __init__(self, file_path, mode='a'):
+
+        if mode not in ['a', 'r']:
+            raise RuntimeError("ParquetPipelineStore unsupported mode '%s'" % mode)
+
+        if mode == 'r' and not os.path.isdir(file_path):
+            raise FileNotFoundError("pipeline store directory '%s' does not exist" % file_path)
+
+        self.file_path = file_path
+        self.mode = mode
+        self.manifests = {}
+
+        if mode == 'a':
+            os.makedirs(file_path, exist_ok=True)
+
+    def table_path(self, table_name, checkpoint_name, suffix='.parquet'):
+        if checkpoint_name is None:
+            return os.path.join(self.file_path, table_name + suffix)
+        return os.path.join(self.file_path, checkpoint_name, table_name + suffix)
+
+    def read_manifest(self, table_name, checkpoint_name):
+
+        key = (table_name, checkpoint_name)
+        if key not in self.manifests:
+            manifest_path = self.table_path(table_name, checkpoint_name, suffix=self.MANIFEST_SUFFIX)
+            if not os.path.isfile(manifest_path):
+                raise KeyError("table '%s' not found in checkpoint '%s' of pipeline store %s" %
+                               (table_name, checkpoint_name, self.file_path))
+            with open(manifest_path) as f:
+                self.manifests[key] = json.load(f)
+        return self.manifests[key]
+
+    def read_df(self, table_name, checkpoint_name=None, columns=None):
+        """
+        Read table version (only the specified columns, if columns is not None)
+        """
+
+        if checkpoint_name is None:
+            file_path = self.table_path(table_name, None)
+            if not os.path.isfile(file_path):
+                raise KeyError("table '%s' not found in pipeline store %s" % (table_name, self.file_path))
+            return pd.read_parquet(file_path, columns=columns)
+
+        manifest = self.read_manifest(table_name, checkpoint_name)
+        column_sources = {c: source for c, source, _ in manifest['columns']}
+
+        if columns is None:
+            columns = [c for c, _, _ in manifest['columns']]
+        else:
+            columns = list(columns)
+            missing = [c for c in columns if c not in column_sources]
+            if missing:
+                raise KeyError("columns %s not in table '%s' checkpoint '%s'" %
+                               (missing, table_name, checkpoint_name))
+
+        # group columns by the checkpoint file they were written to
+        sources = {}
+        for c in columns:
+            sources.setdefault(column_sources[c], []).append(c)
+
+        if not sources:
+            # just the index
+            sources[manifest['index'][0]] = []
+
+        dfs = [pd.read_parquet(self.table_path(table_name, source), columns=source_columns)
+               for source, source_columns in sources.items()]
+
+        if len(dfs) == 1:
+            df = dfs[0]
+        else:
+            index = dfs[0].index
+            for df in dfs[1:]:
+                df.index = index
+            df = pd.concat(dfs, axis=1)
+
+        return df[columns]
+
+    def write_df(self, df, table_name, checkpoint_name=None, base_checkpoint_name=None):
+        """
+        Write table version, only writing the columns that differ from base_checkpoint_name version
+        """
+
+        if self.mode == 'r':
+            raise RuntimeError("pipeline store %s is read only" % self.file_path)
+
+        if df.columns.duplicated().any():
+            raise RuntimeError("pipeline store can't write table '%s' with duplicate columns" % table_name)
+
+        if checkpoint_name is None:
+            # not checkpointed (e.g. checkpoints table) is written whole, replacing any previous version
+            file_path = self.table_path(table_name, None)
+            df.to_parquet(file_path + '.tmp')
+            os.replace(file_path + '.tmp', file_path)
+            return
+
+        base = None
+        if base_checkpoint_name is not None:
+            try:
+                base = self.read_manifest(table_name, base_checkpoint_name)
+            except KeyError:
+                logger.warning("pipeline store base version of table '%s' not found in checkpoint '%s'" %
+                               (table_name, base_checkpoint_name))
+
+        index_digest = column_digest(df.index)
+
+        # columns are only shared with base if it has the same index
+        if base is not None and base['index'][1] == index_digest:
+            base_columns = {c: (source, digest) for c, source, digest in base['columns']}
+            index_source = base['index'][0]
+        else:
+            base_columns = {}
+            index_source = checkpoint_name
+
+        manifest_columns = []
+        changed_columns = []
+        for c in df.columns:
+            digest = column_digest(df[c])
+            source, base_digest = base_columns.get(c, (None, None))
+            if digest != base_digest:
+                source = checkpoint_name
+                changed_columns.append(c)
+            manifest_columns.append([c, source, digest])
+
+        if changed_columns or index_source == checkpoint_name:
+            os.makedirs(os.path.join(self.file_path, checkpoint_name), exist_ok=True)
+            df[changed_columns].to_parquet(self.table_path(table_name, checkpoint_name))
+
+        logger.debug("pipeline store write table '%s' checkpoint '%s' wrote %s of %s columns" %
+                     (table_name, checkpoint_name, len(changed_columns), len(df.columns)))
+
+        manifest = {'index': [index_source, index_digest], 'columns': manifest_columns}
+
+        os.makedirs(os.path.join(self.file_path, checkpoint_name), exist_ok=True)
+        manifest_path = self.table_path(table_name, checkpoint_name, suffix=self.MANIFEST_SUFFIX)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        self.manifests[(table_name, checkpoint_name)] = manifest
+
+    def __getitem__(self, key):
+        return self.read_df(*split_key(key))
+
+    def __setitem__(self, key, df):
+        self.write_df(df, *split_key(key))
+
+    def flush(self):
+        # files are complete when written
+        pass
+
+    def close(self):
+        self.manifests.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def store_format_setting():
+    """
+    pipeline store format from pipeline_store_format setting (defaults to hdf5)
+    """
+    return config.setting('pipeline_store_format', HDF5)
+
+
+def open_store(file_path, mode='a', store_format=None):
+    """
+    Open pipeline store of the specified format (one of STORE_FORMATS, default from settings)
+    """
+
+    store_format = store_format or store_format_setting()
+
+    if store_format == HDF5:
+        return HdfPipelineStore(file_path, mode=mode)
+    if store_format == PARQUET:
+        return ParquetPipelineStore(file_path, mode=mode)
+
+    raise RuntimeError("unknown pipeline_store_format '%s' (expected one of %s)" % (store_format, STORE_FORMATS))
+
+
+def remove_store(file_path):
+    """
+    delete pipeline store file (hdf5) or directory (parquet) if it exists
+    """
+
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    elif os.path.isfile(file_path):
+        os.unlink(file_path)
@@ -20,6 +20,19 @@ logger = logging.getLogger(__name__)
 _MAX_SEED = (1 << 32)
 _SEED_MASK = 0xffffffff
 
+# channel types (as specified by rng_channel_type setting)
+SIMPLE_CHANNEL = 'simple'
+COUNTER_CHANNEL = 'counter'
+
+# splitmix64 constants for counter-based channels
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_MULT_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_MULT_2 = np.uint64(0x94D049BB133111EB)
+
+# distinct row key salts so the two uniforms consumed by a box-muller normal are independent
+_NORMAL_SALT_1 = 1
+_NORMAL_SALT_2 = 2
+
 
 def hash32(s):
     """
@@ -37,6 +50,28 @@ def hash32(s):
     return int(h, base=16) & _SEED_MASK
 
 
+def mix64(x):
+    """
+    splitmix64 finalizer - a fast, well-distributed bijective hash of uint64 values
+
+    Parameters
+    ----------
+    x : numpy.ndarray of uint64
+
+    Returns
+    -------
+        numpy.ndarray of uint64 (integer overflow wraps, as intended)
+    """
+    with np.errstate(over='ignore'):
+        x = np.asanyarray(x, dtype=np.uint64)
+        x = x ^ (x >> np.uint64(30))
+        x = x * _MIX_MULT_1
+        x = x ^ (x >> np.uint64(27))
+        x = x * _MIX_MULT_2
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+
 class SimpleChannel(object):
     """
 
@@ -65,6 +100,11 @@ class SimpleChannel(object):
     We do read in the whole households and persons tables at start time, so we could note the
     max index values. But we might then want a way to ensure stability between the test, example,
     and full datasets. I am punting on this for now.
+
+    Row state (the number of rands consumed by each row in the current step) is held in numpy
+    arrays ordered by row id, so that looking up and updating the state for the rows of a df is
+    a vectorized searchsorted (or, when the row ids are dense, a simple subtraction) rather than
+    a label-based pandas lookup. Row seeds are computed on the fly from the row ids.
     """
 
     def __init__(self, channel_name, base_seed, domain_df, step_name):
@@ -77,45 +117,77 @@ class SimpleChannel(object):
 
         self.step_name = None
         self.step_seed = None
-        self.row_states = None
 
-        # create dataframe to hold state for every df row
+        # sorted row ids and corresponding number of rands pulled this step
+        self.row_ids = None
+        self.row_offsets = None
+
+        # first row id if row_ids are dense (contiguous) so positions are simply id - dense_base
+        self.dense_base = None
+
+        # create arrays to hold state for every df row
         self.extend_domain(domain_df)
-        assert self.row_states.shape[0] == domain_df.shape[0]
+        assert len(self.row_ids) == domain_df.shape[0]
 
         if step_name:
             self.begin_step(step_name)
 
-    def init_row_states_for_step(self, row_states):
+    def row_seeds(self, row_ids):
         """
-        initialize row states (in place) for new step
-
-        with stable, predictable, repeatable row_seeds for that domain_df index value
+        stable, predictable, repeatable row_seeds for the current step and row ids
 
         See notes on the seed generation strategy in class comment above.
 
         Parameters
         ----------
-        row_states
+        row_ids : numpy.ndarray of int
+
+        Returns
+        -------
+        row_seeds : numpy.ndarray of int
         """
 
         assert self.step_name
 
-        if self.step_name and not row_states.empty:
+        return (self.base_seed + self.channel_seed + self.step_seed + row_ids) % _MAX_SEED
+
+    def row_positions(self, df):
+        """
+        Return the positions in the row state arrays of the rows in df
+
+        Parameters
+        ----------
+        df : pandas.DataFrame or Series
+            df with index values for which random streams are to be generated
+
+        Returns
+        -------
+        positions : numpy.ndarray of int
+        """
+
+        # assert no dupes
+        assert df.index.is_unique
+
+        row_ids = df.index.values
 
-            row_states['row_seed'] = (self.base_seed +
-                                      self.channel_seed +
-                                      self.step_seed +
-                                      row_states.index) % _MAX_SEED
+        if self.dense_base is not None:
+            positions = row_ids - self.dense_base
+            in_domain = (positions >= 0) & (positions < len(self.row_ids))
+        else:
+            positions = np.searchsorted(self.row_ids, row_ids)
+            in_domain = positions < len(self.row_ids)
+            in_domain[in_domain] = self.row_ids[positions[in_domain]] == row_ids[in_domain]
 
-            # number of rands pulled this step
-            row_states['offset'] = 0
+        if not in_domain.all():
+            raise RuntimeError("channel %s has no row state for %s ids: %s" %
+                               (self.channel_name, (~in_domain).sum(),
+                                row_ids[~in_domain][:10]))
 
-        return row_states
+        return positions
 
     def extend_domain(self, domain_df):
         """
-        Extend or create row_state df by adding seed info for each row in domain_df
+        Extend or create row state arrays by adding a row for each row in domain_df
 
         If extending, the index values of new tables must be disjoint so
         there will be no ambiguity/collisions between rows
@@ -130,19 +202,28 @@ class SimpleChannel(object):
         if domain_df.empty:
             logger.warning("extend_domain for channel %s for empty domain_df" % self.channel_name)
 
-        # dataframe to hold state for every df row
-        row_states = pd.DataFrame(columns=['row_seed', 'offset'], index=domain_df.index)
+        row_ids = domain_df.index.values.astype(np.int64)
 
-        if self.step_name and not row_states.empty:
-            self.init_row_states_for_step(row_states)
+        if self.row_ids is not None:
+            # row state already exists, so we are extending
+            row_ids = np.concatenate([self.row_ids, row_ids])
 
-        if self.row_states is None:
-            self.row_states = row_states
+        # no rands pulled yet this step for new rows
+        row_offsets = np.zeros(len(row_ids), dtype=np.int64)
+        if self.row_offsets is not None:
+            row_offsets[:len(self.row_offsets)] = self.row_offsets
+
+        order = np.argsort(row_ids, kind='mergesort')
+        self.row_ids = row_ids[order]
+        self.row_offsets = row_offsets[order]
+
+        # if extending, these should be new rows, no intersection with existing rows
+        assert (np.diff(self.row_ids) > 0).all()
+
+        if len(self.row_ids) and (self.row_ids[-1] - self.row_ids[0] + 1 == len(self.row_ids)):
+            self.dense_base = self.row_ids[0]
         else:
-            # row_states already exists, so we are extending
-            # if extending, these should be new rows, no intersection with existing row_states
-            assert len(self.row_states.index.intersection(domain_df.index)) == 0
-            self.row_states = pd.concat([self.row_states, row_states])
+            self.dense_base = None
 
     def begin_step(self, step_name):
         """
@@ -159,7 +240,8 @@ class SimpleChannel(object):
         self.step_name = step_name
         self.step_seed = hash32(self.step_name)
 
-        self.init_row_states_for_step(self.row_states)
+        # number of rands pulled this step
+        self.row_offsets[:] = 0
 
         # standard constant to use for choice_for_df instead of fast-forwarding rand stream
         self.multi_choice_offset = None
@@ -170,10 +252,9 @@ class SimpleChannel(object):
 
         self.step_name = None
         self.step_seed = None
-        self.row_states['offset'] = 0
-        self.row_states['row_seed'] = 0
+        self.row_offsets[:] = 0
 
-    def _generators_for_df(self, df):
+    def _generators_for_df(self, df, positions):
         """
         Python generator function for iterating over numpy prngs (nomenclature collision!)
         seeded and fast-forwarded on-the-fly to the appropriate position in the channel's
@@ -189,21 +270,21 @@ class SimpleChannel(object):
         df : pandas.DataFrame
             dataframe with index values for which random streams are to be generated
             and well-known index name corresponding to the channel
+        positions : numpy.ndarray of int
+            positions of df rows in row state arrays (as returned by row_positions)
         """
 
-        # assert no dupes
-        assert len(df.index.unique()) == len(df.index)
-
-        df_row_states = self.row_states.loc[df.index]
+        row_seeds = self.row_seeds(df.index.values)
+        row_offsets = self.row_offsets[positions]
 
         prng = np.random.RandomState()
-        for row in df_row_states.itertuples():
+        for row_seed, offset in zip(row_seeds, row_offsets):
 
-            prng.seed(row.row_seed)
+            prng.seed(row_seed)
 
-            if row.offset:
+            if offset:
                 # consume rands
-                prng.rand(row.offset)
+                prng.rand(offset)
 
             yield prng
 
@@ -240,12 +321,14 @@ class SimpleChannel(object):
         assert self.step_name
         assert self.step_name == step_name
 
+        positions = self.row_positions(df)
+
         # - reminder: prng must be called when yielded as generated sequence, not serialized
-        generators = self._generators_for_df(df)
+        generators = self._generators_for_df(df, positions)
 
         rands = np.asanyarray([prng.rand(n) for prng in generators])
         # update offset for rows we handled
-        self.row_states.loc[df.index, 'offset'] += n
+        self.row_offsets[positions] += n
         return rands
 
     def normal_for_df(self, df, step_name, mu, sigma, lognormal=False):
@@ -288,8 +371,10 @@ class SimpleChannel(object):
                 return x.values
             return x
 
+        positions = self.row_positions(df)
+
         # - reminder: prng must be called when yielded as generated sequence, not serialized
-        generators = self._generators_for_df(df)
+        generators = self._generators_for_df(df, positions)
 
         mu = to_series(mu)
         sigma = to_series(sigma)
@@ -304,7 +389,7 @@ class SimpleChannel(object):
                                for i, prng in enumerate(generators)])
 
         # update offset for rows we handled
-        self.row_states.loc[df.index, 'offset'] += 1
+        self.row_offsets[positions] += 1
 
         return rands
 
@@ -326,7 +411,7 @@ class SimpleChannel(object):
             df with index name and values corresponding to a registered channel
 
         step_name : str
-            current step name so we can update row_states seed info
+            current step name so we can update row state offsets
 
         The remaining parameters are passed through as arguments to numpy.random.choice
 
@@ -347,8 +432,10 @@ class SimpleChannel(object):
         assert self.step_name
         assert self.step_name == step_name
 
+        positions = self.row_positions(df)
+
         # initialize the generator iterator
-        generators = self._generators_for_df(df)
+        generators = self._generators_for_df(df, positions)
 
         sample = np.concatenate(tuple(prng.choice(a, size, replace) for prng in generators))
 
@@ -357,11 +444,137 @@ class SimpleChannel(object):
             if replace:
                 logger.warning("choice_for_df MULTI_CHOICE_FF with replace")
             # update offset for rows we handled
-            self.row_states.loc[df.index, 'offset'] += size
+            self.row_offsets[positions] += size
 
         return sample
 
 
+class CounterChannel(SimpleChannel):
+    """
+    Counter-based alternative to SimpleChannel.
+
+    Rather than reseeding (and fast-forwarding) a numpy RandomState for every row, the n-th rand
+    for a row is computed directly as a keyed hash of (base_seed, channel_seed, step_seed,
+    row index, offset + n) so that rands for all the rows in a df are generated at once with
+    a handful of vectorized numpy operations.
+
+    Like SimpleChannel, the rands for a row depend only on its index value and the number of rands
+    previously consumed by that row in the current step, so results are repeatable regardless of
+    how choosers are sliced or ordered (e.g. when chunking or multiprocessing.)
+
+    The streams are NOT the same as those generated by SimpleChannel, so switching channel type
+    will change simulation results.
+    """
+
+    def begin_step(self, step_name):
+
+        super().begin_step(step_name)
+
+        # key for this channel and step, (the per-row key is derived from this and the row index)
+        key = mix64(np.uint64(self.base_seed) ^ _GOLDEN_GAMMA)
+        key = mix64(key ^ np.uint64(self.channel_seed))
+        self.step_key = mix64(key ^ np.uint64(self.step_seed))
+
+    def end_step(self, step_name):
+
+        super().end_step(step_name)
+        self.step_key = None
+
+    def _uniforms_for_df(self, df, positions, n, salt=0):
+        """
+        Return n uniform floats in range [0, 1) for each row in df
+        starting at the current offset of each row (but do not update offsets)
+
+        Returns
+        -------
+        rands : 2-D ndarray of shape (len(df), n)
+        """
+
+        offsets = self.row_offsets[positions].astype(np.uint64)
+
+        row_keys = mix64(self.step_key ^ mix64(df.index.values.astype(np.uint64)))
+        if salt:
+            row_keys = mix64(row_keys ^ np.uint64(salt))
+
+        counters = offsets.reshape(-1, 1) + np.arange(n, dtype=np.uint64)
+
+        with np.errstate(over='ignore'):
+            bits = mix64(row_keys.reshape(-1, 1) ^ mix64(counters * _GOLDEN_GAMMA))
+
+        # top 53 bits give a double in [0, 1) with full mantissa resolution
+        return (bits >> np.uint64(11)) * (1.0 / (1 << 53))
+
+    def random_for_df(self, df, step_name, n=1):
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        positions = self.row_positions(df)
+        rands = self._uniforms_for_df(df, positions, n)
+
+        # update offset for rows we handled
+        self.row_offsets[positions] += n
+        return rands
+
+    def normal_for_df(self, df, step_name, mu, sigma, lognormal=False):
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        if isinstance(mu, pd.Series):
+            mu = mu.values
+        if isinstance(sigma, pd.Series):
+            sigma = sigma.values
+
+        positions = self.row_positions(df)
+
+        # box-muller transform (1 - u so log argument is in (0, 1])
+        u1 = self._uniforms_for_df(df, positions, 1, salt=_NORMAL_SALT_1)[:, 0]
+        u2 = self._uniforms_for_df(df, positions, 1, salt=_NORMAL_SALT_2)[:, 0]
+        rands = np.sqrt(-2.0 * np.log(1.0 - u1)) * np.cos(2.0 * np.pi * u2)
+
+        rands = rands * sigma + mu
+
+        if lognormal:
+            rands = np.exp(rands)
+
+        # update offset for rows we handled
+        self.row_offsets[positions] += 1
+
+        return rands
+
+    def choice_for_df(self, df, step_name, a, size, replace):
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        a = np.arange(a) if np.isscalar(a) else np.asanyarray(a)
+
+        positions = self.row_positions(df)
+
+        if replace:
+            rands = self._uniforms_for_df(df, positions, size)
+            sample = a[(rands * len(a)).astype(np.int64)]
+            rands_consumed = size
+        else:
+            # take the first size elements of a random permutation of a for each row
+            rands = self._uniforms_for_df(df, positions, len(a))
+            sample = a[np.argsort(rands, axis=1)[:, :size]]
+            rands_consumed = len(a)
+
+        if not self.multi_choice_offset:
+            # update offset for rows we handled
+            self.row_offsets[positions] += rands_consumed
+
+        return sample.ravel()
+
+
+CHANNEL_TYPES = {
+    SIMPLE_CHANNEL: SimpleChannel,
+    COUNTER_CHANNEL: CounterChannel,
+}
+
+
 class Random(object):
 
     def __init__(self):
@@ -376,6 +589,8 @@ class Random(object):
         self.base_seed = 0
         self.global_rng = np.random.RandomState()
 
+        self.channel_type = SIMPLE_CHANNEL
+
     def get_channel_for_df(self, df):
         """
         Return the channel for this df. Channel should already have been loaded/added.
@@ -471,11 +686,10 @@ class Random(object):
         else:
             logger.debug("Adding channel '%s' %s ids" % (channel_name, len(domain_df.index)))
 
-            channel = SimpleChannel(channel_name,
-                                    self.base_seed,
-                                    domain_df,
-                                    self.step_name
-                                    )
+            channel = CHANNEL_TYPES[self.channel_type](channel_name,
+                                                       self.base_seed,
+                                                       domain_df,
+                                                       self.step_name)
 
             self.channels[channel_name] = channel
             self.index_to_channel[domain_df.index.name] = channel_name
@@ -527,6 +741,31 @@ class Random(object):
             logger.info("Set random seed base to %s" % seed)
             self.base_seed = seed
 
+    def set_channel_type(self, channel_type):
+        """
+        Select the type of channel used to generate per-row random streams.
+
+        SIMPLE_CHANNEL ('simple') reseeds a numpy RandomState for each row (the default)
+        COUNTER_CHANNEL ('counter') generates rands for all rows at once with a counter-based hash
+
+        Both are repeatable and independent of chunking and multiprocessing, but they produce
+        different streams. Must be called before first step (before any channels are added)
+
+        Parameters
+        ----------
+        channel_type : str
+        """
+
+        if self.step_name is not None or self.channels:
+            raise RuntimeError("Can only call set_channel_type before the first step.")
+
+        if channel_type not in CHANNEL_TYPES:
+            raise RuntimeError("Unrecognized rng channel type '%s'" % channel_type)
+
+        if channel_type != self.channel_type:
+            logger.info("Set rng channel type to %s" % channel_type)
+        self.channel_type = channel_type
+
     def get_global_rng(self):
         """
         Return a numpy random number generator for use within current step.
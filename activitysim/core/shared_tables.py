@@ -0,0 +1,224 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+"""
+Hand off pipeline tables between processes in shared memory (multiprocessing.shared_memory)
+
+share_tables copies a dict of DataFrames into a single new shared memory block, and returns the
+block (which the caller must keep open until the tables are no longer needed, and then release)
+together with a small picklable tables_info describing where each column is in the block.
+
+read_shared_tables attaches to the block by name in another process and returns copies of the
+tables (or of just the specified rows of each table, so a sub-process can take its slice of a
+table without first copying the whole thing).
+
+Numeric and bool columns (and the index) are stored as raw arrays and categoricals as codes.
+Anything else (e.g. str columns or MultiIndex) is pickled into the block.
+"""
+
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# byte alignment of arrays in shared memory block
+ALIGNMENT = 64
+
+
+def shared_memory_module():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("shared memory tables require python 3.8 or later (multiprocessing.shared_memory)")
+    return shared_memory
+
+
+def encode_values(values):
+    """
+    Return (info, ndarray) for series or index values
+
+    info is a dict describing how to reconstruct values from the ndarray stored in shared memory
+    """
+
+    if isinstance(values, pd.RangeIndex):
+        info = {'kind': 'range', 'start': values.start, 'stop': values.stop, 'step': values.step}
+        data = None
+    elif isinstance(values, pd.MultiIndex):
+        info = {'kind': 'pickle'}
+        data = np.frombuffer(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    elif isinstance(values.dtype, pd.CategoricalDtype):
+        info = {'kind': 'categorical', 'categories': values.dtype.categories, 'ordered': values.dtype.ordered}
+        data = np.ascontiguousarray(values.cat.codes if isinstance(values, pd.Series) else values.codes)
+    elif isinstance(values.dtype, np.dtype) and values.dtype != np.object_:
+        info = {'kind': 'array'}
+        data = np.ascontiguousarray(values)
+    else:
+        # object or extension values (pickle the array rather than the series, to omit its index)
+        values = values.values if isinstance(values, pd.Series) else values
+        info = {'kind': 'pickle'}
+        data = np.frombuffer(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+
+    if data is not None:
+        info.update({'dtype': data.dtype.str, 'length': len(data), 'nbytes': data.nbytes})
+
+    return info, data
+
+
+def decode_values(buf, info, rows):
+    """
+    Return copy of values (or of just the positions in rows, if rows is not None) stored in buf
+    """
+
+    kind = info['kind']
+
+    if kind == 'range':
+        values = pd.RangeIndex(info['start'], info['stop'], info['step'])
+        return values if rows is None else values[rows]
+
+    view = np.ndarray(shape=(info['length'],), dtype=np.dtype(info['dtype']), buffer=buf, offset=info['offset'])
+
+    if kind == 'pickle':
+        values = pickle.loads(view.tobytes())
+        return values if rows is None else values[rows]
+
+    values = view.copy() if rows is None else view[rows]
+    del view
+
+    if kind == 'categorical':
+        values = pd.Categorical.from_codes(values, categories=info['categories'], ordered=info['ordered'])
+
+    return values
+
+
+def share_tables(tables):
+    """
+    Copy tables into a new shared memory block
+
+    Parameters
+    ----------
+    tables : dict {<table_name>: pandas.DataFrame}
+
+    Returns
+    -------
+    block : multiprocessing.shared_memory.SharedMemory
+        the caller should close and unlink the block (see release) when tables are no longer needed
+    tables_info : dict
+        picklable description of the tables in the block, to pass to read_shared_tables
+    """
+
+    shared_memory = shared_memory_module()
+
+    arrays = []
+    offset = 0
+
+    def add(values):
+        nonlocal offset
+        info, data = encode_values(values)
+        if data is not None:
+            info['offset'] = offset
+            arrays.append((offset, data))
+            offset += -(-data.nbytes // ALIGNMENT) * ALIGNMENT
+        return info
+
+    tables_info = {'tables': {}}
+    for table_name, df in tables.items():
+        index_info = add(df.index)
+        index_info['name'] = df.index.name
+        tables_info['tables'][table_name] = {
+            'index': index_info,
+            'columns': [dict(add(df[c]), name=c) for c in df.columns],
+        }
+
+    block = shared_memory.SharedMemory(create=True, size=max(offset, ALIGNMENT))
+    tables_info['block'] = block.name
+
+    for data_offset, data in arrays:
+        block.buf[data_offset:data_offset + data.nbytes] = data.view(np.uint8).reshape(-1)
+
+    logger.debug("share_tables %s tables %s bytes in shared memory block %s" %
+                 (len(tables), offset, block.name))
+
+    return block, tables_info
+
+
+def read_shared_tables(tables_info, rows=None, table_names=None):
+    """
+    Return copies of tables from shared memory block described by tables_info
+
+    Parameters
+    ----------
+    tables_info : dict
+        tables_info returned by share_tables (in this or another process)
+    rows : dict {<table_name>: array of int or None} or None
+        row positions to read for each table (whole table if None)
+    table_names : list of str or None
+        names of tables to read (all tables if None)
+
+    Returns
+    -------
+    tables : dict {<table_name>: pandas.DataFrame}
+    """
+
+    shared_memory = shared_memory_module()
+
+    rows = rows or {}
+
+    block = shared_memory.SharedMemory(name=tables_info['block'])
+    try:
+        tables = {}
+        for table_name, table_info in tables_info['tables'].items():
+            if table_names is not None and table_name not in table_names:
+                continue
+            table_rows = rows.get(table_name)
+
+            index = decode_values(block.buf, table_info['index'], table_rows)
+            if not isinstance(index, pd.MultiIndex):
+                index = pd.Index(index, name=table_info['index']['name'])
+
+            tables[table_name] = pd.DataFrame(
+                {c['name']: decode_values(block.buf, c, table_rows) for c in table_info['columns']},
+                index=index,
+                columns=[c['name'] for c in table_info['columns']])
+    finally:
+        block.close()
+
+    return tables
+
+
+def release(blocks):
+    """
+    Close and unlink (free) shared memory blocks created by share_tables (or attached with attach)
+    """
+
+    for block in blocks:
+        block.close()
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def disown(block):
+    """
+    Stop this process's resource tracker from freeing block created by this process when it exits
+    (so the block outlives this process, and is released by another process that attached to it)
+    """
+
+    if os.name != 'posix':
+        # windows frees block when the last process with a handle to it closes it
+        return
+
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(getattr(block, '_name', block.name), 'shared_memory')
+
+
+def attach(tables_info):
+    """
+    Attach to shared memory block described by tables_info (e.g. to keep a block created by another
+    process alive until it has been released, which on windows is when the last process closes it)
+    """
+
+    return shared_memory_module().SharedMemory(name=tables_info['block'])
@@ -4,6 +4,7 @@
 from builtins import range
 
 import os
+import copy
 import logging
 from collections import OrderedDict
 
@@ -18,6 +19,7 @@ from . import config
 from . import util
 from . import assign
 from . import chunk
+from . import expression_cache
 
 logger = logging.getLogger(__name__)
 
@@ -293,8 +295,114 @@ def eval_coefficients(spec, coefficients, estimator):
     return spec
 
 
+def spec_chooser_columns(spec, choosers, locals_d, skims=None):
+    """
+    Return list of choosers columns that spec expressions (and any skim wrappers) refer to
+
+    Columns are referred to by name in expressions (as df.col or df['col'] in python expressions)
+    or as the keys of skim wrappers in locals_d or skims. Returns None if the expressions might
+    depend on anything other than the values of these columns (the chooser index, random numbers,
+    or df used in a way expression_cache.analyze can't follow, e.g. df[col_name] or f(df))
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+    choosers : pandas.DataFrame
+    locals_d : Dict or None
+    skims : SkimDictWrapper or SkimStackWrapper object, or a list or dict of skims, or None
+
+    Returns
+    -------
+    columns : list of str or None
+    """
+
+    if isinstance(spec.index, pd.MultiIndex):
+        exprs = spec.index.get_level_values(SPEC_EXPRESSION_NAME)
+    else:
+        exprs = spec.index
+
+    tokens = assign.expression_tokens(exprs)
+    if tokens & {'index', 'rng'}:
+        return None
+
+    for expr in exprs:
+        if expr.startswith('@'):
+            analysis = expression_cache.analyze(expr)
+            if analysis is None:
+                return None
+            tokens.update(analysis[0])
+
+    locals_d = locals_d or {}
+
+    if isinstance(skims, dict):
+        skims = list(skims.values())
+    elif skims is not None and not isinstance(skims, list):
+        skims = [skims]
+
+    for v in list(locals_d.values()) + (skims or []):
+        if isinstance(v, (SkimDictWrapper, SkimStackWrapper)):
+            tokens.update([v.left_key, v.right_key, getattr(v, 'skim_key', None)])
+
+    return [c for c in choosers.columns if c in tokens]
+
+
+def unique_rows(df, columns):
+    """
+    Find rows of df with unique combinations of values of columns
+
+    Returns
+    -------
+    first_rows : 1-D ndarray of int
+        positions of first row in df with each unique combination of column values
+    row_codes : 1-D ndarray of int
+        offset into first_rows of the unique combination for each row of df
+    """
+
+    row_codes = np.zeros(len(df.index), dtype=np.int64)
+    for c in columns:
+        col_codes, col_uniques = pd.factorize(df[c])
+        row_codes, _ = pd.factorize(row_codes * (len(col_uniques) + 1) + col_codes + 1)
+
+    # codes are numbered in order of first appearance
+    _, first_rows = np.unique(row_codes, return_index=True)
+
+    return first_rows, row_codes
+
+
+def dedupe_choosers(spec, choosers, locals_d, trace_label, skims=None):
+    """
+    Return choosers with unique values of the columns spec refers to, and offsets into them
+
+    Rows with the same values in all the columns referred to by spec expressions have the same
+    utilities, so they only need to be evaluated once.
+
+    Returns
+    -------
+    unique_choosers : pandas.DataFrame or None
+        first chooser with each unique combination of spec column values, or None if spec may
+        not only depend on column values or choosers are already unique
+    row_codes : 1-D ndarray of int
+        for each chooser, offset into unique_choosers of its unique combination of values
+    """
+
+    columns = spec_chooser_columns(spec, choosers, locals_d, skims)
+    if columns is None:
+        logger.debug("%s not deduping choosers since spec may not only depend on column values" % trace_label)
+        return None, None
+
+    first_rows, row_codes = unique_rows(choosers, columns)
+
+    logger.debug("%s dedupe %s choosers to %s unique on %s columns" %
+                 (trace_label, len(choosers.index), len(first_rows), len(columns)))
+
+    if len(first_rows) == len(choosers.index):
+        return None, None
+
+    return choosers.iloc[first_rows], row_codes
+
+
 def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
-                   have_trace_targets=False, estimator=None, alt_col_name=None):
+                   have_trace_targets=False, estimator=None, alt_col_name=None, dedupe=False):
     """
 
     Parameters
@@ -311,12 +419,38 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
     have_trace_targets
     estimator :
         called to report intermediate table results (used for estimation)
+    alt_col_name
+    dedupe : bool
+        evaluate utilities once for each unique combination of the values of the choosers
+        columns referred to by spec (and skim wrappers in locals_d) rather than for every chooser
+        (ignored when tracing or estimating)
 
     Returns
     -------
 
     """
 
+    if dedupe and not have_trace_targets and estimator is None:
+        unique_choosers, row_codes = dedupe_choosers(spec, choosers, locals_d, trace_label)
+        if unique_choosers is not None:
+
+            # point skim wrappers at unique_choosers while we evaluate, then restore them
+            skims = [v for v in (locals_d or {}).values()
+                     if isinstance(v, (SkimDictWrapper, SkimStackWrapper))]
+            skim_dfs = [skim.df for skim in skims]
+            try:
+                for skim in skims:
+                    skim.set_df(unique_choosers)
+
+                utilities = eval_utilities(spec, unique_choosers, locals_d, trace_label=trace_label,
+                                           alt_col_name=alt_col_name)
+            finally:
+                for skim, df in zip(skims, skim_dfs):
+                    skim.set_df(df)
+
+            return pd.DataFrame(data=utilities.values[row_codes], index=choosers.index,
+                                columns=utilities.columns)
+
     # fixme - restore tracing and _check_for_variability
 
     t0 = tracing.print_elapsed_time()
@@ -352,13 +486,22 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
     else:
         exprs = spec.index
 
+    # versions of choosers columns used as expression_cache keys
+    column_versions = {}
+
     expression_values = np.empty((spec.shape[0], choosers.shape[0]))
     for i, expr in enumerate(exprs):
         try:
             if expr.startswith('@'):
-                expression_values[i] = eval(expr[1:], globals_dict, locals_dict)
+                expression_values[i] = expression_cache.eval_expression(
+                    expr, choosers, locals_dict,
+                    lambda: eval(assign.compile_expression(expr[1:]), globals_dict, locals_dict),
+                    column_versions)
             else:
-                expression_values[i] = choosers.eval(expr)
+                expression_values[i] = expression_cache.eval_expression(
+                    expr, choosers, locals_dict,
+                    lambda: assign.eval_df_expression(expr, choosers),
+                    column_versions)
         except Exception as err:
             logger.exception("Variable evaluation failed for: %s" % str(expr))
             raise err
@@ -478,13 +621,22 @@ def eval_variables(exprs, df, locals_d=None):
 
         return a
 
+    # versions of df columns used as expression_cache keys
+    column_versions = {}
+
     values = OrderedDict()
     for expr in exprs:
         try:
             if expr.startswith('@'):
-                expr_values = to_array(eval(expr[1:], globals_dict, locals_dict))
+                expr_values = to_array(expression_cache.eval_expression(
+                    expr, df, locals_dict,
+                    lambda: eval(assign.compile_expression(expr[1:]), globals_dict, locals_dict),
+                    column_versions))
             else:
-                expr_values = to_array(df.eval(expr))
+                expr_values = to_array(expression_cache.eval_expression(
+                    expr, df, locals_dict,
+                    lambda: assign.eval_df_expression(expr, df),
+                    column_versions))
             # read model spec should ensure uniqueness, otherwise we should uniquify
             assert expr not in values
             values[expr] = expr_values
@@ -557,6 +709,46 @@ def set_skim_wrapper_targets(df, skims):
         skims.set_df(df)
 
 
+def copy_skim_wrappers(skims, locals_d):
+    """
+    Return shallow copies of skims and locals_d, with copies of the skim wrappers they contain
+
+    Chunks run concurrently (see chunk.run_chunks) each set their own skim wrapper targets, so
+    each needs its own copies of the (otherwise shared) skim wrappers.
+
+    Parameters
+    ----------
+    skims : SkimDictWrapper or SkimStackWrapper object, or a list or dict of skims, or None
+    locals_d : dict or None
+        locals for expressions, which may refer to the same skim wrappers as skims
+
+    Returns
+    -------
+    skims, locals_d
+    """
+
+    copies = {}
+
+    def copy_skim(skim):
+        if isinstance(skim, SkimDictWrapper) or isinstance(skim, SkimStackWrapper):
+            if id(skim) not in copies:
+                copies[id(skim)] = copy.copy(skim)
+            return copies[id(skim)]
+        return skim
+
+    if isinstance(skims, list):
+        skims = [copy_skim(skim) for skim in skims]
+    elif isinstance(skims, dict):
+        skims = {k: copy_skim(skim) for k, skim in skims.items()}
+    else:
+        skims = copy_skim(skims)
+
+    if locals_d is not None:
+        locals_d = {k: copy_skim(v) for k, v in locals_d.items()}
+
+    return skims, locals_d
+
+
 def _check_for_variability(expression_values, trace_label):
     """
     This is an internal method which checks for variability in each
@@ -615,31 +807,11 @@ def compute_nested_exp_utilities(raw_utilities, nest_spec):
     nested_utilities : pandas.DataFrame
         Will have the index of `raw_utilities` and columns for exponentiated leaf and node utilities
     """
-    nested_utilities = pd.DataFrame(index=raw_utilities.index)
-
-    for nest in logit.each_nest(nest_spec, post_order=True):
-
-        name = nest.name
-
-        if nest.is_leaf:
-            # leaf_utility = raw_utility / nest.product_of_coefficients
-            nested_utilities[name] = \
-                raw_utilities[name].astype(float) / nest.product_of_coefficients
-
-        else:
-            # nest node
-            # the alternative nested_utilities will already have been computed due to post_order
-            # this will RuntimeWarning: divide by zero encountered in log
-            # if all nest alternative utilities are zero
-            # but the resulting inf will become 0 when exp is applied below
-            with np.errstate(divide='ignore'):
-                nested_utilities[name] = \
-                    nest.coefficient * np.log(nested_utilities[nest.alternatives].sum(axis=1))
+    nest_tree = logit.NestTree(nest_spec)
 
-        # exponentiate the utility
-        nested_utilities[name] = np.exp(nested_utilities[name])
+    exp_utilities, _ = nest_tree.exp_utilities(raw_utilities)
 
-    return nested_utilities
+    return pd.DataFrame(exp_utilities, index=raw_utilities.index, columns=nest_tree.names)
 
 
 def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
@@ -662,18 +834,13 @@ def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
         Will have the index of `nested_exp_utilities` and columns for leaf and node probabilities
     """
 
-    nested_probabilities = pd.DataFrame(index=nested_exp_utilities.index)
+    nest_tree = logit.NestTree(nest_spec)
 
-    for nest in logit.each_nest(nest_spec, type='node', post_order=False):
+    probabilities = nest_tree.nested_probabilities(nested_exp_utilities[nest_tree.names].values,
+                                                   nested_exp_utilities.index, trace_label=trace_label)
 
-        probs = logit.utils_to_probs(nested_exp_utilities[nest.alternatives],
-                                     trace_label=trace_label,
-                                     exponentiated=True,
-                                     allow_zero_probs=True)
-
-        nested_probabilities = pd.concat([nested_probabilities, probs], axis=1)
-
-    return nested_probabilities
+    return pd.DataFrame(probabilities[:, nest_tree.probability_positions],
+                        index=nested_exp_utilities.index, columns=nest_tree.probability_names)
 
 
 def compute_base_probabilities(nested_probabilities, nests, spec):
@@ -697,21 +864,17 @@ def compute_base_probabilities(nested_probabilities, nests, spec):
         Will have the index of `nested_probabilities` and columns for leaf base probabilities
     """
 
-    base_probabilities = pd.DataFrame(index=nested_probabilities.index)
-
-    for nest in logit.each_nest(nests, type='leaf', post_order=False):
+    nest_tree = logit.NestTree(nests)
 
-        # skip root: it has a prob of 1 but we didn't compute a nested probability column for it
-        ancestors = nest.ancestors[1:]
+    # root has a prob of 1 but there is no nested probability column for it
+    probabilities = np.ones((len(nested_probabilities.index), len(nest_tree.names)))
+    probabilities[:, nest_tree.probability_positions] = nested_probabilities[nest_tree.probability_names].values
 
-        base_probabilities[nest.name] = nested_probabilities[ancestors].prod(axis=1)
-
-    # reorder alternative columns to match spec
+    # alternative columns in spec order
     # since these are alternatives chosen by column index, order of columns matters
-    assert(set(base_probabilities.columns) == set(spec.columns))
-    base_probabilities = base_probabilities[spec.columns]
+    base_probabilities = nest_tree.base_probabilities(probabilities, spec.columns)
 
-    return base_probabilities
+    return pd.DataFrame(base_probabilities, index=nested_probabilities.index, columns=spec.columns)
 
 
 def eval_mnl(choosers, spec, locals_d, custom_chooser, estimator,
@@ -858,36 +1021,42 @@ def eval_nl(choosers, spec, nest_spec, locals_d, custom_chooser, estimator,
         tracing.trace_df(raw_utilities, '%s.raw_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
-    # exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    nest_tree = logit.NestTree(nest_spec)
+
+    # exponentiated utilities of leaves and nests (and logsum of nest root)
+    nested_exp_utilities, logsums = nest_tree.exp_utilities(raw_utilities)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
+        tracing.trace_df(pd.DataFrame(nested_exp_utilities, index=choosers.index, columns=nest_tree.names),
+                         '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
     # probabilities of alternatives relative to siblings sharing the same nest
     nested_probabilities = \
-        compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label=trace_label)
+        nest_tree.nested_probabilities(nested_exp_utilities, choosers.index, trace_label=trace_label)
     chunk.log_df(trace_label, "nested_probabilities", nested_probabilities)
 
     if want_logsums:
-        # logsum of nest root
-        logsums = pd.Series(np.log(nested_exp_utilities.root), index=choosers.index)
+        logsums = pd.Series(logsums, index=choosers.index)
         chunk.log_df(trace_label, "logsums", logsums)
 
     del nested_exp_utilities
     chunk.log_df(trace_label, 'nested_exp_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_probabilities, '%s.nested_probabilities' % trace_label,
+        tracing.trace_df(pd.DataFrame(nested_probabilities[:, nest_tree.probability_positions],
+                                      index=choosers.index, columns=nest_tree.probability_names),
+                         '%s.nested_probabilities' % trace_label,
                          column_labels=['alternative', 'probability'])
 
     # global (flattened) leaf probabilities based on relative nest coefficients (in spec order)
-    base_probabilities = compute_base_probabilities(nested_probabilities, nest_spec, spec)
+    # since these are alternatives chosen by column index, order of columns matters
+    base_probabilities = pd.DataFrame(nest_tree.base_probabilities(nested_probabilities, spec.columns),
+                                      index=choosers.index, columns=spec.columns)
     chunk.log_df(trace_label, "base_probabilities", base_probabilities)
 
     del nested_probabilities
@@ -900,7 +1069,7 @@ def eval_nl(choosers, spec, nest_spec, locals_d, custom_chooser, estimator,
     # note base_probabilities could all be zero since we allowed all probs for nests to be zero
     # check here to print a clear message but make_choices will raise error if probs don't sum to 1
     BAD_PROB_THRESHOLD = 0.001
-    no_choices = (base_probabilities.sum(axis=1) - 1).abs() > BAD_PROB_THRESHOLD
+    no_choices = np.abs(base_probabilities.values.sum(axis=1) - 1) > BAD_PROB_THRESHOLD
 
     if no_choices.any():
 
@@ -1052,24 +1221,30 @@ def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
 
     assert len(choosers) > 0
 
+    num_threads = chunk.chunk_threads(chunk_size, estimator)
+    if num_threads > 1:
+        # chunks run concurrently share chunk_size
+        chunk_size = max(chunk_size // num_threads, 1)
+
     rows_per_chunk, effective_chunk_size = \
         simple_simulate_rpc(chunk_size, choosers, spec, nest_spec, trace_label)
 
-    result_list = []
-    # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            copy_skim_wrappers(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
 
         choices = _simple_simulate(
             chooser_chunk, spec, nest_spec,
-            skims=skims,
-            locals_d=locals_d,
+            skims=chunk_skims,
+            locals_d=chunk_locals_d,
             custom_chooser=custom_chooser,
             want_logsums=want_logsums,
             estimator=estimator,
@@ -1078,10 +1253,12 @@ def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
 
         chunk.log_close(chunk_trace_label)
 
-        result_list.append(choices)
+        return choices
 
-    if len(result_list) > 1:
-        choices = pd.concat(result_list)
+    # segment by person type and pick the right spec for each person type
+    choices = chunk.run_chunks(
+        chunk.chunked_choosers(choosers, rows_per_chunk, chunk_size, trace_label), run_chunk, num_threads,
+        sink=chunk.ChunkSink(choosers.index)).result()
 
     assert len(choices.index == len(choosers.index))
 
@@ -1158,20 +1335,22 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None, alt_c
         tracing.trace_df(raw_utilities, '%s.raw_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
-    # - exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    nest_tree = logit.NestTree(nest_spec)
+
+    # - exponentiated utilities of leaves and nests (and logsum of nest root)
+    nested_exp_utilities, logsums = nest_tree.exp_utilities(raw_utilities)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities  # done with raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     # - logsums
-    logsums = np.log(nested_exp_utilities.root)
     logsums = pd.Series(logsums, index=choosers.index)
     chunk.log_df(trace_label, "logsums", logsums)
 
     if have_trace_targets:
         # add logsum to nested_exp_utilities for tracing
+        nested_exp_utilities = pd.DataFrame(nested_exp_utilities, index=choosers.index, columns=nest_tree.names)
         nested_exp_utilities['logsum'] = logsums
         tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
@@ -1185,7 +1364,8 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None, alt_c
 
 
 def _simple_simulate_logsums(choosers, spec, nest_spec,
-                             skims=None, locals_d=None, trace_label=None, alt_col_name=None):
+                             skims=None, locals_d=None, trace_label=None, alt_col_name=None,
+                             dedupe=False):
     """
     like simple_simulate except return logsums instead of making choices
 
@@ -1195,6 +1375,13 @@ def _simple_simulate_logsums(choosers, spec, nest_spec,
         Index will be that of `choosers`, values will be nest logsum based on spec column values
     """
 
+    if dedupe and not tracing.has_trace_targets(choosers):
+        unique_choosers, row_codes = dedupe_choosers(spec, choosers, locals_d, trace_label, skims)
+        if unique_choosers is not None:
+            logsums = _simple_simulate_logsums(unique_choosers, spec, nest_spec,
+                                               skims, locals_d, trace_label, alt_col_name)
+            return pd.Series(logsums.values[row_codes], index=choosers.index, name=logsums.name)
+
     if skims is not None:
         set_skim_wrapper_targets(choosers, skims)
 
@@ -1243,10 +1430,13 @@ def simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_lab
 
 def simple_simulate_logsums(choosers, spec, nest_spec,
                             skims=None, locals_d=None, chunk_size=0,
-                            trace_label=None, alt_col_name=None):
+                            trace_label=None, alt_col_name=None, dedupe=False):
     """
     like simple_simulate except return logsums instead of making choices
 
+    if dedupe is True, logsums are only computed once for each unique combination of the values
+    of the choosers columns referred to by spec (and skims) and then broadcast to all choosers
+
     Returns
     -------
     logsums : pandas.Series
@@ -1257,31 +1447,39 @@ def simple_simulate_logsums(choosers, spec, nest_spec,
 
     assert len(choosers) > 0
 
+    num_threads = chunk.chunk_threads(chunk_size)
+    if num_threads > 1:
+        # chunks run concurrently share chunk_size
+        chunk_size = max(chunk_size // num_threads, 1)
+
     rows_per_chunk, effective_chunk_size = \
         simple_simulate_logsums_rpc(chunk_size, choosers, spec, nest_spec, trace_label)
 
-    result_list = []
-    # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    def run_chunk(i, num_chunks, chooser_chunk):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
         chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i) \
             if num_chunks > 1 else trace_label
 
+        chunk_skims, chunk_locals_d = \
+            copy_skim_wrappers(skims, locals_d) if num_threads > 1 else (skims, locals_d)
+
         chunk.log_open(chunk_trace_label, chunk_size, effective_chunk_size)
 
         logsums = _simple_simulate_logsums(
             chooser_chunk, spec, nest_spec,
-            skims, locals_d,
-            chunk_trace_label, alt_col_name)
+            chunk_skims, chunk_locals_d,
+            chunk_trace_label, alt_col_name, dedupe)
 
         chunk.log_close(chunk_trace_label)
 
-        result_list.append(logsums)
+        return logsums
 
-    if len(result_list) > 1:
-        logsums = pd.concat(result_list)
+    # segment by person type and pick the right spec for each person type
+    logsums = chunk.run_chunks(
+        chunk.chunked_choosers(choosers, rows_per_chunk, chunk_size, trace_label), run_chunk, num_threads,
+        sink=chunk.ChunkSink(choosers.index)).result()
 
     assert len(logsums.index == len(choosers.index))
 
@@ -5,6 +5,7 @@ from builtins import range
 from builtins import object
 
 import logging
+import threading
 
 from collections import OrderedDict
 
@@ -16,6 +17,87 @@ from activitysim.core.util import quick_loc_series
 
 logger = logging.getLogger(__name__)
 
+# serializes lazy loading of skims (chunks may be run concurrently in threads)
+LOAD_LOCK = threading.Lock()
+
+NOT_IN_SKIM = -1
+
+# largest zone id for which OffsetMapper maps zone ids to offsets with a dense lookup array
+DENSE_OFFSET_MAX_ID = 1 << 24
+
+
+def upcast(values):
+    """
+    Upcast reduced precision (e.g. int8, int16 or float16) skim values to float32 on lookup,
+    so that expression arithmetic on them does not overflow or lose precision.
+    """
+
+    if values.dtype.itemsize < 4:
+        return values.astype(np.float32)
+
+    return values
+
+
+def in_skim_offsets(offsets, size, not_in_skim=None):
+    """
+    Return (offsets, not_in_skim) with offsets not in a skim dimension of length size replaced by 0
+    (rather than letting negative offsets silently wrap around to the other end of the skim) and
+    not_in_skim a boolean mask of them, or'ed with not_in_skim (None if all offsets are in skim)
+    """
+
+    offsets = np.asanyarray(offsets)
+
+    if offsets.size and (offsets.min() < 0 or offsets.max() >= size):
+        mask = (offsets < 0) | (offsets >= size)
+        offsets = np.where(mask, 0, offsets)
+        not_in_skim = mask if not_in_skim is None else (not_in_skim | mask)
+
+    return offsets, not_in_skim
+
+
+def set_not_in_skim(values, not_in_skim):
+    """
+    Return skim values with NaN where not_in_skim (as returned by in_skim_offsets)
+    """
+
+    if not_in_skim is None:
+        return values
+
+    return np.where(not_in_skim, np.nan, values.astype(np.result_type(values.dtype, np.float32)))
+
+
+def map_keys(keys, keys_to_indexes):
+    """
+    Map keys (e.g. skim time period labels) to indexes (NOT_IN_SKIM for keys not in keys_to_indexes)
+
+    keys_to_indexes is only consulted once for each distinct key, rather than once per row, by
+    using the codes of categorical keys, or by factorizing other keys.
+
+    Parameters
+    ----------
+    keys : pandas.Series, pandas.Categorical or array-like
+    keys_to_indexes : dict
+
+    Returns
+    -------
+    indexes : 1-D ndarray of int
+        index of each key
+    """
+
+    if isinstance(keys, pd.Series) and isinstance(keys.dtype, pd.CategoricalDtype):
+        keys = keys.values
+
+    if isinstance(keys, pd.Categorical):
+        codes, uniques = keys.codes, keys.categories
+    else:
+        codes, uniques = pd.factorize(np.asanyarray(keys))
+
+    # NOT_IN_SKIM is appended so that missing values (code -1) map to NOT_IN_SKIM
+    unique_indexes = np.array([keys_to_indexes.get(k, NOT_IN_SKIM) for k in uniques] + [NOT_IN_SKIM],
+                              dtype=np.intp)
+
+    return unique_indexes[codes]
+
 
 class OffsetMapper(object):
     """
@@ -23,10 +105,14 @@ class OffsetMapper(object):
 
     Can map either by a fixed offset (e.g. -1 to map 1-based to 0-based)
     or by an explicit mapping of zone id to offset (slower but more flexible)
+
+    Explicit mappings of (non-negative) int zone ids up to DENSE_OFFSET_MAX_ID are looked up in
+    a dense array indexed by zone id, others with a pandas Series.
     """
 
     def __init__(self, offset_int=None):
         self.offset_series = None
+        self.offset_array = None
         self.offset_int = offset_int
 
     def set_offset_list(self, offset_list):
@@ -54,6 +140,12 @@ class OffsetMapper(object):
 
         if self.offset_series is None:
             self.offset_series = pd.Series(data=list(range(len(offset_list))), index=offset_list)
+
+            zone_ids = np.asanyarray(offset_list)
+            if np.issubdtype(zone_ids.dtype, np.integer) and \
+                    zone_ids.min() >= 0 and zone_ids.max() <= DENSE_OFFSET_MAX_ID:
+                self.offset_array = np.full(zone_ids.max() + 1, NOT_IN_SKIM, dtype=np.intp)
+                self.offset_array[zone_ids] = np.arange(len(zone_ids))
         else:
             # make sure it offsets are the same
             assert (offset_list == self.offset_series.index).all()
@@ -90,9 +182,15 @@ class OffsetMapper(object):
         offsets : numpy array of int
         """
 
-        NOT_IN_SKIM = -1
+        if self.offset_array is not None and np.issubdtype(np.asanyarray(zone_ids).dtype, np.integer):
+            zone_ids = np.asanyarray(zone_ids)
+            in_array = (zone_ids >= 0) & (zone_ids < len(self.offset_array))
+            if in_array.all():
+                offsets = self.offset_array[zone_ids]
+            else:
+                offsets = np.where(in_array, self.offset_array[np.where(in_array, zone_ids, 0)], NOT_IN_SKIM)
 
-        if self.offset_series is not None:
+        elif self.offset_series is not None:
             assert(self.offset_int is None)
             assert isinstance(self.offset_series, pd.Series)
             offsets = np.asanyarray(quick_loc_series(zone_ids, self.offset_series).fillna(NOT_IN_SKIM).astype(int))
@@ -149,14 +247,12 @@ class SkimWrapper(object):
 
         mapped_orig = self.offset_mapper.map(orig)
         mapped_dest = self.offset_mapper.map(dest)
-        result = self.data[mapped_orig, mapped_dest]
 
-        # FIXME - should return nan if not in skim (negative indices wrap around)
-        # NOT_IN_SKIM = np.nan
-        # in_skim = \
-        #     (mapped_orig <0) & (mapped_orig < self.data.shape[0]) & \
-        #     (mapped_dest <0) & (mapped_dest < self.data.shape[0])
-        # result = np.where(in_skim, result, NOT_IN_SKIM)
+        # ids not in skim (e.g. NO_DEST_TAZ placeholder destinations) have NaN skim values
+        mapped_orig, not_in_skim = in_skim_offsets(mapped_orig, self.data.shape[0])
+        mapped_dest, not_in_skim = in_skim_offsets(mapped_dest, self.data.shape[1], not_in_skim)
+
+        result = set_not_in_skim(upcast(self.data[mapped_orig, mapped_dest]), not_in_skim)
 
         return result
 
@@ -168,13 +264,21 @@ class SkimDict(object):
     dictionary - i.e. use brackets to add and get skim objects.
 
     Note that keys are either strings or tuples of two strings (to support stacking of skims.)
+
+    If skim_loader is specified, skims are loaded lazily: skim_data blocks are (initially unfilled)
+    buffers and skim_loader(key, data) is called to read the skim with key into data (a view of
+    its slice of the block) the first time it is accessed. loaded_keys are the keys of any skims
+    that have already been loaded into skim_data.
     """
 
-    def __init__(self, skim_data, skim_info):
+    def __init__(self, skim_data, skim_info, skim_loader=None, loaded_keys=None):
 
         self.skim_info = skim_info
         self.skim_data = skim_data
 
+        self.skim_loader = skim_loader
+        self.loaded = set(loaded_keys) if loaded_keys is not None else set()
+
         self.offset_mapper = OffsetMapper()
         self.usage = set()
 
@@ -182,6 +286,25 @@ class SkimDict(object):
 
         self.usage.add(key)
 
+    def load(self, key):
+        """
+        Load skim with key into skim_data if skims are lazily loaded and it has not been loaded yet
+        """
+
+        if self.skim_loader is None or key in self.loaded:
+            return
+
+        with LOAD_LOCK:
+            if key in self.loaded:
+                return
+
+            block, offset = self.skim_info['block_offsets'].get(key)
+
+            logger.debug("SkimDict lazily loading skim %s into block %s offset %s" % (key, block, offset))
+            self.skim_loader(key, self.skim_data[block][:, :, offset])
+
+            self.loaded.add(key)
+
     def get(self, key):
         """
         Get an available wrapped skim object (not the lookup)
@@ -201,6 +324,7 @@ class SkimDict(object):
         block_data = self.skim_data[block]
 
         self.touch(key)
+        self.load(key)
 
         data = block_data[:, :, offset]
 
@@ -379,8 +503,8 @@ class SkimStack(object):
 
     def lookup(self, orig, dest, dim3, key):
 
-        orig = self.offset_mapper.map(orig)
-        dest = self.offset_mapper.map(dest)
+        mapped_orig = self.offset_mapper.map(orig)
+        mapped_dest = self.offset_mapper.map(dest)
 
         assert key in self.key1_blocks, "SkimStack key %s missing" % key
         assert key in self.skim_dim3, "SkimStack key %s missing" % key
@@ -391,11 +515,22 @@ class SkimStack(object):
 
         self.touch(key)
 
-        # skim_indexes = dim3.map(skim_keys_to_indexes).astype('int')
-        # this should be faster than map
-        skim_indexes = np.vectorize(skim_keys_to_indexes.get)(dim3)
+        mapped_orig, not_in_skim = in_skim_offsets(mapped_orig, stacked_skim_data.shape[0])
+        mapped_dest, not_in_skim = in_skim_offsets(mapped_dest, stacked_skim_data.shape[1], not_in_skim)
+
+        # dim3 keys (e.g. time periods) are mapped once per distinct key (faster with categorical dim3)
+        skim_indexes = map_keys(dim3, skim_keys_to_indexes)
+
+        if (skim_indexes == NOT_IN_SKIM).any():
+            missing = sorted(set(np.asanyarray(dim3)[skim_indexes == NOT_IN_SKIM].tolist()), key=str)
+            raise RuntimeError("SkimStack key %s has no skims for %s" % (key, missing))
+
+        if self.skim_dict.skim_loader is not None:
+            indexes_to_skim_keys = {v: k for k, v in skim_keys_to_indexes.items()}
+            for skim_index in pd.unique(skim_indexes):
+                self.skim_dict.load((key, indexes_to_skim_keys[skim_index]))
 
-        return stacked_skim_data[orig, dest, skim_indexes]
+        return set_not_in_skim(upcast(stacked_skim_data[mapped_orig, mapped_dest, skim_indexes]), not_in_skim)
 
     def wrap(self, left_key, right_key, skim_key):
         """
@@ -547,13 +682,13 @@ class DataFrameMatrix(object):
         series with one row per row_id, with the value from the column specified in col_ids
 
         """
-        # col_indexes = segments.map(self.cols_to_indexes).astype('int')
-        # this should be faster than map
-        col_indexes = np.vectorize(self.cols_to_indexes.get)(col_ids)
+        col_indexes = map_keys(col_ids, self.cols_to_indexes)
+        assert (col_indexes != NOT_IN_SKIM).all(), "DataFrameMatrix.get col_ids not in df columns"
 
         row_indexes = self.offset_mapper.map(np.asanyarray(row_ids))
+        row_indexes, not_in_df = in_skim_offsets(row_indexes, self.data.shape[0])
 
-        result = self.data[row_indexes, col_indexes]
+        result = set_not_in_skim(self.data[row_indexes, col_indexes], not_in_df)
 
         # FIXME - if ids (or col_ids?) is a series, return series with same index?
         if isinstance(row_ids, pd.Series):
@@ -19,7 +19,9 @@ def track_skim_usage(output_dir):
     """
     write statistics on skim usage (diagnostic to detect loading of un-needed skims)
 
-    FIXME - have not yet implemented a facility to avoid loading of unused skims
+    Also writes skim_usage_manifest.txt listing the omx matrix names of the skims that were used,
+    which can be specified as the skim_usage_manifest setting of subsequent lazy_load_skims runs
+    to preload exactly those skims.
 
     Parameters
     ----------
@@ -67,6 +69,15 @@ def track_skim_usage(output_dir):
             for key in unused:
                 print(key, file=output_file)
 
+    stack_usage = skim_stack.usage if skim_stack is not None else set()
+    used_omx_keys = [omx_key for skim_key, omx_key in skim_dict.skim_info['omx_keys'].items()
+                     if skim_key in skim_dict.usage
+                     or (isinstance(skim_key, tuple) and skim_key[0] in stack_usage)]
+
+    with open(config.output_file_path('skim_usage_manifest.txt'), mode) as output_file:
+        for omx_key in used_omx_keys:
+            print(omx_key, file=output_file)
+
 
 def write_data_dictionary(output_dir):
     """
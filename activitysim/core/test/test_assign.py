@@ -177,3 +177,35 @@ def test_assign_variables_failing(capsys, data):
 
     # undefined variable should raise error
     assert "'undefined_variable' is not defined" in str(excinfo.value)
+
+
+def test_eval_df_expression():
+
+    df = pd.DataFrame({
+        'a': [1, 2, 3],
+        'b': [1.0, 0.0, np.nan],
+        'c': [True, False, True],
+        't': ['x', 'y', None],
+        'p': pd.Categorical(['AM', 'PM', 'AM'])
+    })
+
+    # simple expressions are evaluated as python and others by df.eval, with same results
+    # (as are expressions over extension dtype columns, e.g. categorical skim time periods)
+    for expression in ["a * b", "(t == 'x') * a", "(t != 'x') & c", "b > 0",
+                       "a > 1 > 0", "a in [1, 2]", "(a > 1) and c",
+                       "(p == 'AM') * a"]:
+        pd.testing.assert_series_equal(assign.eval_df_expression(expression, df), df.eval(expression))
+
+    assert assign.compile_df_expression("(t == 'x') * a") is not None
+    assert assign.compile_df_expression("a > 1 > 0") is None
+    assert assign.compile_df_expression("a in [1, 2]") is None
+
+    # pandas gives '&' and '|' lower precedence than comparisons, python doesn't
+    df = pd.DataFrame({'a': [0, 1, 2, 3], 'b': [1, 0, 1, 0]})
+    for expression in ["a > 1 & b", "a == 2 | b"]:
+        assert assign.compile_df_expression(expression) is None
+        pd.testing.assert_series_equal(assign.eval_df_expression(expression, df), df.eval(expression))
+    assert list(assign.eval_df_expression("a > 1 & b", df)) == [0, 0, 1, 0]
+    assert list(assign.eval_df_expression("a == 2 | b", df)) == [1, 0, 1, 0]
+
+    assert assign.compile_expression(" df.a * 2") is assign.compile_expression(" df.a * 2")
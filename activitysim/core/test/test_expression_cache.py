@@ -0,0 +1,94 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from .. import expression_cache
+from .. import skim
+
+
+def teardown_function(func):
+    expression_cache.set_cache_size(0)
+
+
+def counting_eval(df, func):
+
+    calls = []
+
+    def eval_func():
+        calls.append(1)
+        return func(df)
+
+    return eval_func, calls
+
+
+def test_expression_cache():
+
+    expression_cache.set_cache_size(1000000)
+
+    df = pd.DataFrame({'income': [10, 20, 30], 'zone': [1, 2, 3]})
+    locals_d = {'np': np, 'HIGH_INCOME': 15}
+    expr = '@(df.income > HIGH_INCOME) * np.log(df.zone)'
+
+    eval_func, calls = counting_eval(df, lambda df: (df.income > 15) * np.log(df.zone))
+    v1 = expression_cache.eval_expression(expr, df, locals_d, eval_func, {})
+    v2 = expression_cache.eval_expression(expr, df.copy(), locals_d, eval_func, {})
+    assert len(calls) == 1
+    pdt.assert_series_equal(v1, v2)
+
+    # changing a value in place doesn't change cached value
+    v2.values[:] = 0
+    v3 = expression_cache.eval_expression(expr, df, locals_d, eval_func, {})
+    assert len(calls) == 1
+    pdt.assert_series_equal(v1, v3)
+
+    # column named by constant subscript
+    assert expression_cache.analyze("@df['income'] * 2") == ({'income'}, set())
+
+    # different constant or column contents are different keys
+    locals_d['HIGH_INCOME'] = 25
+    expression_cache.eval_expression(expr, df, locals_d, eval_func, {})
+    df.loc[0, 'zone'] = 5
+    expression_cache.eval_expression(expr, df, locals_d, eval_func, {})
+    assert len(calls) == 3
+
+    # not cacheable (function local)
+    locals_d['rng'] = lambda x: x
+    eval_func, calls = counting_eval(df, lambda df: df.income)
+    for i in range(2):
+        expression_cache.eval_expression('@rng(df.income)', df, locals_d, eval_func, {})
+    assert len(calls) == 2
+
+    # least recently used values are evicted when over budget
+    expression_cache.set_cache_size(2 * 3 * 8)
+    for expr in ['income * 2', 'income * 3', 'income * 4']:
+        eval_func, calls = counting_eval(df, lambda df: df.eval(expr))
+        expression_cache.eval_expression(expr, df, locals_d, eval_func, {})
+    assert expression_cache.CACHE_BYTES <= 2 * 3 * 8
+    assert len(expression_cache.CACHE) == 2
+
+
+def test_expression_cache_skims():
+
+    expression_cache.set_cache_size(1000000)
+
+    skim_data = np.arange(9, dtype=np.float32).reshape(3, 3, 1)
+    skim_dict = skim.SkimDict([skim_data], {'block_offsets': {'DIST': (0, 0)}})
+    skim_dict.offset_mapper.set_offset_int(-1)
+
+    df = pd.DataFrame({'orig': [1, 2, 3], 'dest': [3, 1, 2]})
+    skims = skim_dict.wrap('orig', 'dest')
+    skims.set_df(df)
+
+    eval_func, calls = counting_eval(df, lambda df: skims['DIST'])
+    expression_cache.eval_expression("@skims['DIST']", df, {'skims': skims}, eval_func, {})
+    v = expression_cache.eval_expression("@skims['DIST']", df, {'skims': skims}, eval_func, {})
+    assert len(calls) == 1
+    assert list(v) == [2, 3, 7]
+
+    # zero size disables cache
+    expression_cache.set_cache_size(0)
+    expression_cache.eval_expression("@skims['DIST']", df, {'skims': skims}, eval_func, {})
+    assert len(calls) == 2
@@ -2,6 +2,7 @@
 # See full license in LICENSE.txt.
 import os
 
+import pandas as pd
 import pytest
 
 from .. import inject
@@ -40,3 +41,33 @@ def test_defaults():
 
     data_dir = os.path.join(os.path.dirname(__file__), 'data')
     inject.add_injectable("data_dir", data_dir)
+
+
+def test_reinject_decorated_tables_keep_cached_injectables():
+
+    inject.clear_cache()
+
+    configs_dir = os.path.join(os.path.dirname(__file__), 'configs_test_defaults')
+    inject.add_injectable("configs_dir", configs_dir)
+
+    settings = inject.get_injectable("settings")
+    inject.add_table("not_decorated", pd.DataFrame({'a': [1, 2]}))
+
+    inject.reinject_decorated_tables(keep_cached_injectables=True)
+
+    # cached value of decorated injectable survives
+    assert inject.get_injectable("settings") is settings
+
+    # overridden decorated injectable is restored
+    with pytest.raises(RuntimeError) as excinfo:
+        inject.get_injectable("configs_dir")
+    assert "directory does not exist" in str(excinfo.value)
+
+    # tables added since are dropped
+    assert inject.get_table("not_decorated", None) is None
+
+    # cached values aren't kept unless keep_cached_injectables
+    inject.add_injectable("configs_dir", configs_dir)
+    inject.reinject_decorated_tables()
+    inject.add_injectable("configs_dir", configs_dir)
+    assert inject.get_injectable("settings") is not settings
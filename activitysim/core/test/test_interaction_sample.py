@@ -0,0 +1,126 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import inject
+from .. import interaction_sample
+from .. import pipeline
+
+
+@pytest.fixture
+def choosers():
+    df = pd.DataFrame({
+        'income': [10, 50, 100, 20, 80, 35],
+        'age': [20, 35, 50, 65, 40, 28],
+        'area': [1, 2, 3, 1, 2, 3],
+        'unused': [0, 1, 2, 3, 4, 5],
+    }, index=pd.Index([1, 2, 3, 4, 5, 6], name='person_id'))
+    return df
+
+
+@pytest.fixture
+def alternatives():
+    df = pd.DataFrame({
+        'size_term': [5.0, 10.0, 20.0, 1.0, 8.0],
+        'density': [0.5, 1.0, 2.0, 0.1, 1.5],
+        'area': [1, 1, 2, 3, 3],
+        'unused_alt': [9, 8, 7, 6, 5],
+    }, index=pd.Index([101, 102, 103, 104, 105], name='zone_id'))
+    return df
+
+
+def spec_df(expressions):
+    return pd.DataFrame({'coefficient': [0.1 * (i + 1) for i in range(len(expressions))]},
+                        index=pd.Index(expressions, name='Expression'))
+
+
+def run_sample(choosers, alternatives, spec, slim, locals_d=None):
+
+    inject.add_injectable("settings", {'check_for_variability': False, 'slim_interaction_sample': slim})
+
+    rng = pipeline.get_rn_generator()
+    rng.begin_step('test_interaction_sample')
+    rng.add_channel('persons', choosers)
+    try:
+        return interaction_sample.interaction_sample(
+            choosers, alternatives.copy(), spec, sample_size=4, alt_col_name='zone_id',
+            locals_d=locals_d, trace_label='test')
+    finally:
+        rng.end_step('test_interaction_sample')
+        rng.drop_channel('persons')
+
+
+def test_slim_interaction_sample(choosers, alternatives):
+
+    spec = spec_df([
+        'income / 100',                          # chooser only
+        '@np.log1p(df.size_term)',               # alternative only
+        'density * 2',                           # alternative only (DataFrame.eval)
+        '@df.income * df.density / 100',         # chooser and alternative
+        '(area_chooser == area) * 1',            # column in both choosers and alternatives
+        '_d@df.density * df.age / 100',          # temp
+        '@_d * 2',
+    ])
+
+    assert interaction_sample.referenced_columns_known(spec, choosers, alternatives)
+
+    alt_spec, chooser_spec, interaction_spec = \
+        interaction_sample.split_spec_terms(spec, choosers, alternatives, None)
+    assert list(alt_spec.index) == ['@np.log1p(df.size_term)', 'density * 2']
+    assert list(chooser_spec.index) == ['income / 100']
+
+    # unused columns are not repeated in slim interaction dataset
+    chooser_columns, alt_columns = \
+        interaction_sample.referenced_columns(interaction_spec, choosers, alternatives, None)
+    assert chooser_columns == ['income', 'age', 'area']
+    assert alt_columns == ['density', 'area']
+
+    expected = run_sample(choosers, alternatives, spec, slim=False)
+    choices = run_sample(choosers, alternatives, spec, slim=True)
+
+    pdt.assert_frame_equal(choices, expected)
+
+
+def test_slim_interaction_sample_no_cross_join(choosers, alternatives, monkeypatch):
+
+    spec = spec_df([
+        'income / 100',                          # chooser only
+        '@np.log(df.age)',                       # chooser only
+        'area_chooser * 0.5',                    # chooser column also in alternatives
+        '@np.log1p(df.size_term)',               # alternative only
+        'area * 2',                              # alternative column also in choosers
+    ])
+
+    alt_spec, chooser_spec, interaction_spec = \
+        interaction_sample.split_spec_terms(spec, choosers, alternatives, None)
+    assert list(chooser_spec.index) == ['income / 100', '@np.log(df.age)', 'area_chooser * 0.5']
+    assert interaction_spec.empty
+
+    expected = run_sample(choosers, alternatives, spec, slim=False)
+
+    # utilities are broadcast from chooser-only and alternative-only terms without a cross join
+    def no_interaction_dataset(*args, **kwargs):
+        raise AssertionError("interaction_dataset called")
+    monkeypatch.setattr(interaction_sample.logit, 'interaction_dataset', no_interaction_dataset)
+
+    choices = run_sample(choosers, alternatives, spec, slim=True)
+
+    pdt.assert_frame_equal(choices, expected)
+
+
+def test_slim_interaction_sample_indirect_columns(choosers, alternatives):
+
+    # column named by a local can't be determined from expression text, so the full
+    # interaction dataset is used
+    spec = spec_df(['@df[col_name] * 2', '@np.log1p(df.size_term)'])
+    locals_d = {'col_name': 'income'}
+
+    assert not interaction_sample.referenced_columns_known(spec, choosers, alternatives)
+
+    expected = run_sample(choosers, alternatives, spec, slim=False, locals_d=locals_d)
+    choices = run_sample(choosers, alternatives, spec, slim=True, locals_d=locals_d)
+
+    pdt.assert_frame_equal(choices, expected)
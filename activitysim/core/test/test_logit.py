@@ -149,3 +149,35 @@ def test_interaction_dataset_sampled(
 
     interacted, expected = interacted.align(expected, axis=1)
     pdt.assert_frame_equal(interacted, expected)
+
+
+def test_nest_tree():
+
+    nest_spec = {
+        'name': 'root', 'coefficient': 1.0, 'alternatives': [
+            'walk',
+            {'name': 'auto', 'coefficient': 0.5, 'alternatives': ['sov', 'hov']}]}
+
+    raw_utilities = pd.DataFrame([[0.0, 1.0, 2.0], [0.5, -999, -999]], columns=['hov', 'walk', 'sov'])
+
+    nest_tree = logit.NestTree(nest_spec)
+    assert nest_tree.names == ['walk', 'sov', 'hov', 'auto', 'root']
+    assert nest_tree.probability_names == ['walk', 'auto', 'sov', 'hov']
+
+    exp_utilities, logsums = nest_tree.exp_utilities(raw_utilities)
+
+    exp_auto = (np.exp(2.0 / 0.5) + np.exp(0.0 / 0.5)) ** 0.5
+    np.testing.assert_allclose(exp_utilities[0], [np.e, np.exp(4.0), 1.0, exp_auto, np.e + exp_auto])
+    np.testing.assert_allclose(logsums, np.log(exp_utilities[:, -1]))
+
+    probabilities = nest_tree.nested_probabilities(exp_utilities, raw_utilities.index)
+    np.testing.assert_allclose(probabilities[:, 1] + probabilities[:, 2], [1.0, 1.0])
+    np.testing.assert_allclose(probabilities[0, 0], np.e / (np.e + exp_auto))
+
+    # walk unavailable, and auto has the only non-zero probability
+    np.testing.assert_allclose(probabilities[1, [0, 3]], [0.0, 1.0])
+
+    base_probabilities = nest_tree.base_probabilities(probabilities, ['sov', 'hov', 'walk'])
+    np.testing.assert_allclose(base_probabilities.sum(axis=1), [1.0, 1.0])
+    np.testing.assert_allclose(base_probabilities[1], [0.0, 1.0, 0.0])
+    np.testing.assert_allclose(base_probabilities[0, 2], np.e / (np.e + exp_auto))
@@ -0,0 +1,194 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import inject
+from .. import mp_tasks
+
+
+@pytest.fixture
+def tables():
+    households = pd.DataFrame({
+        'hhsize': [1, 5, 2, 1, 3, 4, 1, 2, 5, 1, 2, 5],
+    }, index=pd.Index(np.arange(100, 112), name='household_id'))
+
+    persons = pd.DataFrame({
+        'household_id': np.repeat(households.index, households.hhsize),
+    }, index=pd.Index(np.arange(households.hhsize.sum()), name='person_id'))
+
+    land_use = pd.DataFrame({
+        'area': [1, 2, 3],
+    }, index=pd.Index([1, 2, 3], name='zone_id'))
+
+    return {'households': households, 'persons': persons, 'land_use': land_use}
+
+
+def check_apportioned(tables, rows, num_sub_procs):
+
+    # every row of a sliced table is assigned to exactly one sub_proc
+    for table_name in ['households', 'persons']:
+        assert len(rows[table_name]) == num_sub_procs
+        positions = np.concatenate(rows[table_name])
+        assert np.array_equal(np.sort(positions), np.arange(len(tables[table_name])))
+
+    # mirrored tables aren't sliced
+    assert rows['land_use'] is None
+
+    # persons follow their households
+    for hh_rows, person_rows in zip(rows['households'], rows['persons']):
+        hh_ids = tables['households'].index[hh_rows]
+        assert set(tables['persons'].household_id.iloc[person_rows]) == set(hh_ids)
+
+
+def test_apportion_rows(tables):
+
+    slice_rules = mp_tasks.build_slice_rules({'tables': ['households', 'persons']}, tables)
+
+    assert slice_rules['households'] == {'slice_by': 'primary', 'weight': None}
+    assert slice_rules['persons'] == {'slice_by': 'column', 'column': 'household_id', 'source': 'households'}
+    assert slice_rules['land_use'] == {'slice_by': None}
+
+    rows = mp_tasks.apportion_rows(tables, slice_rules, num_sub_procs=3)
+
+    check_apportioned(tables, rows, 3)
+
+    # unweighted primary table is sliced in strides
+    assert [list(r) for r in rows['households']] == [[0, 3, 6, 9], [1, 4, 7, 10], [2, 5, 8, 11]]
+
+
+def test_apportion_rows_weighted(tables):
+
+    slice_info = {'tables': ['households', 'persons'], 'weight': 'hhsize'}
+    slice_rules = mp_tasks.build_slice_rules(slice_info, tables)
+
+    assert slice_rules['households'] == {'slice_by': 'primary', 'weight': 'hhsize'}
+
+    rows = mp_tasks.apportion_rows(tables, slice_rules, num_sub_procs=4)
+
+    check_apportioned(tables, rows, 4)
+
+    # primary table is cut into runs of rows with equal total weight
+    hhsize = tables['households'].hhsize.values
+    assert [hhsize[r].sum() for r in rows['households']] == [8, 8, 8, 8]
+    for r in rows['households']:
+        assert np.array_equal(r, np.arange(r[0], r[-1] + 1))
+
+    # persons per slice follow the weight
+    assert [len(r) for r in rows['persons']] == [8, 8, 8, 8]
+
+    with pytest.raises(RuntimeError) as excinfo:
+        slice_rules['households']['weight'] = 'bogus'
+        mp_tasks.apportion_rows(tables, slice_rules, num_sub_procs=4)
+    assert "slice weight column 'bogus' not in primary slice table" in str(excinfo.value)
+
+
+def test_apportion_rows_zero_weight(tables):
+
+    tables['households']['hhsize'] = 0
+
+    slice_info = {'tables': ['households', 'persons'], 'weight': 'hhsize'}
+    slice_rules = mp_tasks.build_slice_rules(slice_info, tables)
+
+    rows = mp_tasks.apportion_rows(tables, slice_rules, num_sub_procs=3)
+
+    # falls back to slicing in strides
+    assert [list(r) for r in rows['households']] == [[0, 3, 6, 9], [1, 4, 7, 10], [2, 5, 8, 11]]
+
+
+@pytest.fixture(autouse=True)
+def dirs(tmpdir):
+
+    configs_dir = tmpdir.mkdir('configs')
+    configs_dir.join('shadow_pricing.yaml').write(
+        "shadow_pricing_models:\n"
+        "  school: school_location\n"
+        "  workplace: workplace_location\n")
+
+    inject.add_injectable('configs_dir', str(configs_dir))
+    inject.add_injectable('output_dir', str(tmpdir.mkdir('output')))
+
+    yield
+
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+@pytest.fixture
+def run_list_settings():
+
+    settings = {
+        'multiprocess': True,
+        'models': [
+            'initialize_landuse',
+            'initialize_households',
+            'compute_accessibility',
+            'school_location',
+            'workplace_location',
+            'auto_ownership_simulate',
+        ],
+        'multiprocess_steps': [
+            {'name': 'mp_initialize', 'begin': 'initialize_landuse'},
+            {'name': 'mp_accessibility', 'begin': 'compute_accessibility',
+             'slice': {'tables': ['accessibility']}},
+            {'name': 'mp_households', 'begin': 'school_location',
+             'slice': {'tables': ['households', 'persons']}},
+        ],
+    }
+
+    return settings
+
+
+def test_get_run_list_num_batches(run_list_settings):
+
+    settings = run_list_settings
+    settings['multiprocess_steps'][1].update({'num_processes': 2, 'num_batches': 5})
+    inject.add_injectable('settings', settings)
+
+    run_list = mp_tasks.get_run_list()
+
+    step = run_list['multiprocess_steps'][1]
+    assert step['num_batches'] == 5
+    assert step['num_processes'] == 2
+
+    # num_processes is capped at num_batches
+    settings['multiprocess_steps'][1].update({'num_processes': 8, 'num_batches': 3})
+    run_list = mp_tasks.get_run_list()
+    assert run_list['multiprocess_steps'][1]['num_processes'] == 3
+
+
+@pytest.mark.parametrize("num_batches", [1, 2.5, -2])
+def test_get_run_list_bad_num_batches(run_list_settings, num_batches):
+
+    settings = run_list_settings
+    settings['multiprocess_steps'][1].update({'num_processes': 2, 'num_batches': num_batches})
+    inject.add_injectable('settings', settings)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        mp_tasks.get_run_list()
+    assert "bad value (%s) for num_batches for step mp_accessibility" % num_batches in str(excinfo.value)
+
+
+def test_get_run_list_num_batches_without_slice(run_list_settings):
+
+    settings = run_list_settings
+    settings['multiprocess_steps'][0]['num_batches'] = 4
+    inject.add_injectable('settings', settings)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        mp_tasks.get_run_list()
+    assert "num_batches but no slice info for step mp_initialize" in str(excinfo.value)
+
+
+def test_get_run_list_num_batches_shadow_pricing(run_list_settings):
+
+    settings = run_list_settings
+    settings['multiprocess_steps'][2].update({'num_processes': 2, 'num_batches': 4})
+    inject.add_injectable('settings', settings)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        mp_tasks.get_run_list()
+    assert "shadow priced models ['school_location', 'workplace_location'] in step mp_households" \
+        in str(excinfo.value)
@@ -6,6 +6,7 @@ import pytest
 
 import tables
 
+from activitysim.core import config
 from activitysim.core import tracing
 from activitysim.core import pipeline
 from activitysim.core import inject
@@ -137,6 +138,92 @@ def test_pipeline_checkpoint_drop():
     pipeline.close_pipeline()
     close_handlers()
 
+
+def test_pipeline_run_parquet():
+
+    pytest.importorskip('pyarrow')
+
+    config.override_setting('pipeline_store_format', 'parquet')
+    inject.add_injectable('pipeline_file_name', 'pipeline.parquet')
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step_add_col.table_name=table2;column_name=c2'
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    table2 = pipeline.get_table("table2")
+    assert pipeline.get_table("table2", checkpoint_name="step2").columns.tolist() == ['c']
+    assert pipeline.get_table("table2", columns=['c2']).c2.tolist() == table2.c2.tolist()
+
+    pipeline.close_pipeline()
+
+    assert pipeline.get_checkpoints().checkpoint_name.tolist()[-1] == 'step_add_col.table_name=table2;column_name=c2'
+
+    # resume from store
+    pipeline.open_pipeline(resume_after='_')
+    assert pipeline.get_table("table2").equals(table2)
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+def test_pipeline_background_checkpoint_writes():
+
+    pytest.importorskip('pyarrow')
+
+    config.override_setting('pipeline_store_format', 'parquet')
+    inject.add_injectable('pipeline_file_name', 'pipeline.parquet')
+    config.override_setting('checkpoint_write_queue_size', 1)
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step_add_col.table_name=table2;column_name=c2'
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    # reading from store waits for pending writes
+    assert pipeline.get_table("table2", checkpoint_name="step2").columns.tolist() == ['c']
+    assert len(pipeline.get_checkpoints()) == 4
+
+    table2 = pipeline.get_table("table2")
+
+    pipeline.close_pipeline()
+
+    pipeline.open_pipeline(resume_after='_')
+    assert pipeline.last_checkpoint() == 'step_add_col.table_name=table2;column_name=c2'
+    assert pipeline.get_table("table2").equals(table2)
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+def test_pipeline_background_checkpoint_writes_hdf5():
+
+    # hdf5 pipeline stores can't be written in the background
+    config.override_setting('checkpoint_write_queue_size', 1)
+
+    inject.add_step('step1', steps.step1)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        pipeline.run(models=['step1'], resume_after=None)
+    assert "checkpoint_write_queue_size requires pipeline_store_format parquet" in str(excinfo.value)
+
+    close_handlers()
+
+
 # if __name__ == "__main__":
 #
 #     print "\n\ntest_pipeline_run"
@@ -0,0 +1,55 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+import os
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import pipeline_store
+
+pytest.importorskip('pyarrow')
+
+
+def test_parquet_column_deltas(tmpdir):
+
+    store_dir = os.path.join(str(tmpdir), 'pipeline.parquet')
+    store = pipeline_store.open_store(store_dir, mode='a', store_format=pipeline_store.PARQUET)
+
+    df = pd.DataFrame({'a': [1, 2, 3], 'b': ['x', 'y', 'z']}, index=pd.Index([10, 20, 30], name='person_id'))
+    store.write_df(df, 'persons', 'step1')
+
+    # only the new column is written, unchanged columns are referenced
+    df2 = df.copy()
+    df2['c'] = np.array([0.5, 1.5, 2.5], dtype=np.float32)
+    store.write_df(df2, 'persons', 'step2', base_checkpoint_name='step1')
+    assert pd.read_parquet(os.path.join(store_dir, 'step2', 'persons.parquet')).columns.tolist() == ['c']
+
+    # unchanged table doesn't write any columns
+    store.write_df(df2, 'persons', 'step3', base_checkpoint_name='step2')
+    assert not os.path.exists(os.path.join(store_dir, 'step3', 'persons.parquet'))
+
+    # changed column
+    df4 = df2.copy()
+    df4['a'] = df4.a * 2
+    store.write_df(df4, 'persons', 'step4', base_checkpoint_name='step3')
+    assert pd.read_parquet(os.path.join(store_dir, 'step4', 'persons.parquet')).columns.tolist() == ['a']
+
+    # different index (e.g. rows added) writes all columns
+    df5 = df4.iloc[:2]
+    store.write_df(df5, 'persons', 'step5', base_checkpoint_name='step4')
+    assert pd.read_parquet(os.path.join(store_dir, 'step5', 'persons.parquet')).columns.tolist() == ['a', 'b', 'c']
+
+    store.close()
+
+    with pipeline_store.open_store(store_dir, mode='r', store_format=pipeline_store.PARQUET) as store:
+        pdt.assert_frame_equal(store['persons/step1'], df)
+        pdt.assert_frame_equal(store['persons/step3'], df2)
+        pdt.assert_frame_equal(store.read_df('persons', 'step4'), df4)
+        pdt.assert_frame_equal(store.read_df('persons', 'step5'), df5)
+        pdt.assert_frame_equal(store.read_df('persons', 'step4', columns=['c', 'a']), df4[['c', 'a']])
+        pdt.assert_frame_equal(store.read_df('persons', 'step4', columns=[]), df4[[]])
+
+        with pytest.raises(KeyError):
+            store.read_df('persons', 'bogus')
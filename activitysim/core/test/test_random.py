@@ -109,3 +109,107 @@ def test_channel():
     npt.assert_almost_equal(np.asanyarray(rands).flatten(), test1_expected_rands2)
 
     rng.end_step('test_step')
+
+
+def test_counter_channel():
+
+    rng = random.Random()
+    rng.set_channel_type(random.COUNTER_CHANNEL)
+
+    persons = pd.DataFrame({
+        "household_id": [1, 1, 2, 2, 2],
+    }, index=[1, 2, 3, 4, 5])
+    persons.index.name = 'person_id'
+
+    rng.begin_step('test_step')
+
+    rng.add_channel('persons', persons)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.set_channel_type(random.SIMPLE_CHANNEL)
+    assert "call set_channel_type before the first step" in str(excinfo.value)
+
+    rands = rng.random_for_df(persons)
+    assert rands.shape == (5, 1)
+    assert ((rands >= 0) & (rands < 1)).all()
+
+    # second call should return something different
+    rands2 = rng.random_for_df(persons)
+    assert not np.isclose(rands, rands2).any()
+
+    # rands for a row depend only on row index and offset, not on df order or membership
+    rands3 = rng.random_for_df(persons.iloc[[4, 1]], n=2)
+
+    choices = rng.choice_for_df(persons, [1, 2, 3, 4], 3, replace=False)
+    assert choices.shape == (15, )
+    assert all(len(set(c)) == 3 for c in choices.reshape(5, 3))
+
+    rng.end_step('test_step')
+
+    # if we use the same step name a second time, we should get the same results as before
+    rng.begin_step('test_step')
+
+    npt.assert_almost_equal(rng.random_for_df(persons.iloc[::-1]), rands[::-1])
+    npt.assert_almost_equal(rng.random_for_df(persons), rands2)
+    npt.assert_almost_equal(rng.random_for_df(persons.iloc[[4, 1]], n=2), rands3)
+
+    rng.end_step('test_step')
+
+    # a different step should give a different stream
+    rng.begin_step('test_step2')
+    assert not np.isclose(rng.random_for_df(persons), rands).any()
+
+    normals = rng.normal_for_df(persons, mu=10, sigma=0.1)
+    assert normals.shape == (5, )
+    assert (np.abs(normals - 10) < 1).all()
+
+    rng.end_step('test_step2')
+
+
+def test_counter_channel_distribution():
+
+    rng = random.Random()
+    rng.set_channel_type(random.COUNTER_CHANNEL)
+
+    df = pd.DataFrame(index=pd.Index(np.arange(100000), name='person_id'))
+
+    rng.begin_step('test_step')
+    rng.add_channel('persons', df)
+
+    rands = rng.random_for_df(df, n=2)
+    assert abs(rands.mean() - 0.5) < 0.01
+    assert abs(np.corrcoef(rands[:, 0], rands[:, 1])[0, 1]) < 0.01
+
+    normals = rng.normal_for_df(df)
+    assert abs(normals.mean()) < 0.02
+    assert abs(normals.std() - 1) < 0.02
+
+    rng.end_step('test_step')
+
+
+def test_extend_channel():
+
+    rng = random.Random()
+
+    tours = pd.DataFrame(index=pd.Index([10, 11, 12], name='tour_id'))
+    more_tours = pd.DataFrame(index=pd.Index([5, 20], name='tour_id'))
+    all_tours = pd.concat([tours, more_tours])
+
+    rng.begin_step('test_step')
+    rng.add_channel('tours', tours)
+    rands = rng.random_for_df(tours)
+
+    # extending channel (with sparse ids) mid-step does not disturb offsets of existing rows
+    rng.add_channel('tours', more_tours)
+    rands2 = rng.random_for_df(all_tours)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.random_for_df(pd.DataFrame(index=pd.Index([7], name='tour_id')))
+    assert "no row state" in str(excinfo.value)
+
+    rng.end_step('test_step')
+
+    rng.begin_step('test_step')
+    npt.assert_almost_equal(rng.random_for_df(all_tours.iloc[:3]), rands)
+    npt.assert_almost_equal(rng.random_for_df(all_tours.iloc[::-1]), rands2[::-1])
+    rng.end_step('test_step')
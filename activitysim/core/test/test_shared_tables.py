@@ -0,0 +1,46 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from .. import shared_tables
+
+
+def test_shared_tables():
+
+    persons = pd.DataFrame({
+        'household_id': np.array([3, 1, 1, 2], dtype=np.int32),
+        'age': np.array([30, 8, 41, 66], dtype=np.int8),
+        'ptype': pd.Categorical(['adult', 'child', 'adult', 'retired']),
+        'name': ['a', 'b', None, 'd'],
+        'income': [1.5, np.nan, 2.0, 3.0],
+        'is_worker': [True, False, True, False],
+    }, index=pd.Index([10, 11, 12, 13], name='person_id'))
+    empty = persons.iloc[:0]
+    multi = pd.DataFrame({'x': [1, 2]}, index=pd.MultiIndex.from_tuples([(1, 'a'), (2, 'b')], names=['i', 'j']))
+    ranged = pd.DataFrame({'x': [1.0, 2.0, 3.0]})
+
+    block, tables_info = shared_tables.share_tables(
+        {'persons': persons, 'empty': empty, 'multi': multi, 'ranged': ranged})
+
+    try:
+        tables = shared_tables.read_shared_tables(tables_info)
+        pdt.assert_frame_equal(tables['persons'], persons)
+        pdt.assert_frame_equal(tables['empty'], empty)
+        pdt.assert_frame_equal(tables['multi'], multi)
+        pdt.assert_frame_equal(tables['ranged'], ranged)
+
+        # tables are copies
+        tables['persons'].age = 0
+        assert shared_tables.read_shared_tables(tables_info)['persons'].age.tolist() == [30, 8, 41, 66]
+
+        # slice rows
+        rows = {'persons': np.array([3, 0]), 'ranged': np.array([2])}
+        tables = shared_tables.read_shared_tables(tables_info, rows=rows, table_names=['persons', 'ranged'])
+        assert list(tables.keys()) == ['persons', 'ranged']
+        pdt.assert_frame_equal(tables['persons'], persons.iloc[[3, 0]])
+        pdt.assert_frame_equal(tables['ranged'], ranged.iloc[[2]])
+    finally:
+        shared_tables.release([block])
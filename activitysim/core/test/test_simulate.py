@@ -11,6 +11,7 @@ import pytest
 
 from .. import inject
 
+from .. import chunk
 from .. import simulate
 
 
@@ -87,3 +88,111 @@ def test_simple_simulate_chunked(data, spec):
     choices = simulate.simple_simulate(choosers=data, spec=spec, nest_spec=None, chunk_size=2)
     expected = pd.Series([1, 1, 1], index=data.index)
     pdt.assert_series_equal(choices, expected)
+
+
+def test_simple_simulate_adaptive_chunked(data, spec, tmpdir):
+
+    inject.add_injectable("settings", {'check_for_variability': False})
+    inject.add_injectable("output_dir", str(tmpdir))
+
+    choosers = pd.concat([data] * 100, ignore_index=True)
+
+    chunk.set_adaptive(True)
+    try:
+        choices = simulate.simple_simulate(choosers=choosers, spec=spec, nest_spec=None, chunk_size=200,
+                                           trace_label='test')
+        pdt.assert_series_equal(choices, pd.Series(1, index=choosers.index))
+
+        # row size measured by probe chunk and saved for next run
+        assert list(chunk.MEASURED) == ['test.simple_simulate']
+        row_size = chunk.ROW_SIZES['test.simple_simulate']
+        chunk.save_row_sizes()
+
+        chunk.set_adaptive(True)
+        assert chunk.ROW_SIZES == {'test.simple_simulate': row_size}
+        rows_per_chunk, _ = chunk.rows_per_chunk(200, 1000, len(choosers), 'test.simple_simulate')
+        assert rows_per_chunk == int(200 / row_size)
+    finally:
+        chunk.set_adaptive(False)
+
+
+def test_simple_simulate_chunk_threads(data, spec):
+
+    choosers = pd.concat([data] * 20, ignore_index=True)
+
+    nest_spec = {'name': 'root', 'coefficient': 1.0, 'alternatives': ['alt0', 'alt1']}
+
+    inject.add_injectable("settings", {'check_for_variability': False})
+    expected = simulate.simple_simulate_logsums(choosers=choosers, spec=spec, nest_spec=nest_spec, chunk_size=200)
+
+    inject.add_injectable("settings", {'check_for_variability': False, 'chunk_threads': 2})
+    assert chunk.chunk_threads(200) == 2
+    assert chunk.chunk_threads(0) == 1
+
+    logsums = simulate.simple_simulate_logsums(choosers=choosers, spec=spec, nest_spec=nest_spec, chunk_size=200)
+    pdt.assert_series_equal(logsums, expected)
+
+    choices = simulate.simple_simulate(choosers=choosers, spec=spec, nest_spec=None, chunk_size=200)
+    pdt.assert_series_equal(choices, pd.Series(1, index=choosers.index))
+
+    # results are in chunk order, whatever order chunks finish in
+    results = chunk.run_chunks(((i, 10 - i) for i in range(10)), lambda i, j: i * j, num_threads=3)
+    assert results == [i * (10 - i) for i in range(10)]
+
+
+def test_chunk_sink():
+
+    index = pd.Index([10, 20, 30, 40, 50], name='person_id')
+    df = pd.DataFrame({'choice': [1, 2, 3, 4, 5], 'logsum': [0.5, 1.5, 2.5, 3.5, 4.5]}, index=index)
+
+    sink = chunk.ChunkSink(index)
+    for chunk_df in [df.iloc[:2], df.iloc[2:4], df.iloc[4:]]:
+        sink.append(chunk_df)
+    pdt.assert_frame_equal(sink.result(), df)
+
+    # series, with dtype promoted by a later chunk
+    sink = chunk.ChunkSink(index)
+    sink.append(df.choice.iloc[:3])
+    sink.append(df.logsum.iloc[3:].rename('choice'))
+    pdt.assert_series_equal(sink.result(), pd.Series([1, 2, 3, 3.5, 4.5], index=index, name='choice'))
+
+    # rows located by index
+    sink = chunk.ChunkSink(index, ordered=False)
+    chunk.run_chunks([(df.iloc[[1, 3]], ), (df.iloc[[0, 2, 4]], )], lambda chunk_df: chunk_df, sink=sink)
+    pdt.assert_frame_equal(sink.result(), df)
+
+    # single chunk is returned as is
+    sink = chunk.ChunkSink(index)
+    sink.append(df)
+    assert sink.result() is df
+
+
+def test_eval_utilities_dedupe(data, spec):
+
+    choosers = pd.concat([data, data, data.iloc[[2, 0]]], ignore_index=True)
+    choosers['unused'] = np.arange(len(choosers))
+
+    assert simulate.spec_chooser_columns(spec, choosers, None) == ['thing1', 'thing2']
+
+    first_rows, row_codes = simulate.unique_rows(choosers, ['thing1', 'thing2'])
+    assert list(first_rows) == [0, 1, 2]
+    assert list(row_codes) == [0, 1, 2, 0, 1, 2, 2, 0]
+
+    expected = simulate.eval_utilities(spec, choosers)
+    utilities = simulate.eval_utilities(spec, choosers, dedupe=True)
+
+    pdt.assert_frame_equal(utilities, expected)
+
+
+def test_eval_utilities_dedupe_function_of_df():
+
+    choosers = pd.DataFrame({'age': [30, 30, 30, 30], 'income': [1000, 2000, 3000, 4000]})
+    spec = pd.DataFrame({'alt0': [1.0, 1.0]}, index=pd.Index(['age', '@f(df)'], name='Expression'))
+    locals_d = {'f': lambda df: df.income / 1000}
+
+    # columns f refers to can't be determined from expression text, so choosers aren't deduped
+    assert simulate.spec_chooser_columns(spec, choosers, locals_d) is None
+
+    utilities = simulate.eval_utilities(spec, choosers, locals_d, dedupe=True)
+
+    assert list(utilities.alt0) == [31, 32, 33, 34]
@@ -58,6 +58,38 @@ def test_offset_list(data):
         [52, 99, 16])
 
 
+def test_offset_array(data):
+
+    offset_mapper = skim.OffsetMapper()
+    offset_mapper.set_offset_list([10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
+
+    # non-contiguous int zone ids are mapped with a dense lookup array
+    assert offset_mapper.offset_array is not None
+    npt.assert_array_equal(offset_mapper.map(np.array([60, 100, 20])), [5, 9, 1])
+    npt.assert_array_equal(offset_mapper.map(np.array([60, 5, 1000, -10])), [5, -1, -1, -1])
+
+    sk = skim.SkimWrapper(data, offset_mapper)
+
+    # ids not in skim have NaN values rather than wrapping around
+    npt.assert_array_equal(sk.get([60, 5], [30, 100]), [52, np.nan])
+
+
+def test_not_in_skim(data):
+
+    sk = skim.SkimWrapper(data, skim.OffsetMapper(-1))
+
+    # e.g. NO_DEST_TAZ (-1) placeholder destinations of persons without a workplace
+    values = sk.get([6, 10, 2], [3, -1, 7])
+    npt.assert_array_equal(values, [52, np.nan, 16])
+    assert values.dtype == np.float64
+
+    # skim values (and dtype) unchanged if all ids are in skim
+    assert sk.get([6, 10, 2], [3, 10, 7]).dtype == data.dtype
+
+    dfm = skim.DataFrameMatrix(pd.DataFrame({'a': [1, 2, 3], 'b': [10, 20, 30]}, index=[100, 101, 102]))
+    npt.assert_array_equal(dfm.get(row_ids=[100, -1, 102], col_ids=['a', 'b', 'b']), [1, np.nan, 30])
+
+
 # fixme - nan support disabled in skim.py (not sure we need it?)
 # def test_skim_nans(data):
 #     sk = skim.SkimWrapper(data)
@@ -144,3 +176,84 @@ def test_3dskims(data):
         ),
         check_dtype=False
     )
+
+    # categorical skim keys (e.g. from skim_time_period_label as_category) are mapped by code
+    df['period'] = pd.Categorical(df.period, categories=['EA', 'AM', 'PM'])
+    npt.assert_array_equal(skims3d["SOV"], [12, 930, 47])
+
+    df['period'] = pd.Categorical(['AM', 'EA', 'PM'], categories=['EA', 'AM', 'PM'])
+    with pytest.raises(RuntimeError) as excinfo:
+        skims3d["SOV"]
+    assert "no skims for ['EA']" in str(excinfo.value)
+
+    # zones not in skim have NaN values
+    df['period'] = ['AM', 'PM', 'AM']
+    df['taz_r'] = [2, 3, -1]
+    npt.assert_array_equal(skims3d["SOV"], [12, 930, np.nan])
+
+
+def test_lazy_skims(data):
+
+    skim_data = np.zeros(data.shape + (3,), dtype=int)
+
+    skim_info = {
+        'block_offsets': {'DIST': (0, 0), ('SOV', 'AM'): (0, 1), ('SOV', 'PM'): (0, 2)},
+        'key1_block_offsets': {'DIST': (0, 0), 'SOV': (0, 1)}
+    }
+
+    source = {'DIST': data, ('SOV', 'AM'): data*10, ('SOV', 'PM'): data*100}
+    loads = []
+
+    def skim_loader(key, a):
+        loads.append(key)
+        a[:] = source[key]
+
+    skim_dict = skim.SkimDict([skim_data], skim_info, skim_loader=skim_loader)
+    stack = skim.SkimStack(skim_dict)
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+        "period": ["AM", "AM", "AM"]
+    })
+
+    skims3d = stack.wrap(left_key="taz_l", right_key="taz_r", skim_key="period")
+    skims3d.set_df(df)
+
+    # only the skims actually looked up are loaded
+    npt.assert_array_equal(skims3d["SOV"], [120, 930, 470])
+    assert loads == [('SOV', 'AM')]
+    assert (skim_data[:, :, 2] == 0).all()
+
+    skims = skim_dict.wrap("taz_l", "taz_r")
+    skims.set_df(df)
+    npt.assert_array_equal(skims["DIST"], [12, 93, 47])
+    npt.assert_array_equal(skims["DIST"], [12, 93, 47])
+    assert loads == [('SOV', 'AM'), 'DIST']
+
+    # preloaded skims are not reloaded
+    skim_dict = skim.SkimDict([skim_data], skim_info, skim_loader=skim_loader, loaded_keys=['DIST'])
+    skim_dict.get('DIST')
+    assert loads == [('SOV', 'AM'), 'DIST']
+
+
+def test_reduced_precision_skims(data):
+
+    skim_info = {
+        'block_offsets': {'DIST': (0, 0), ('BOARDS', 'AM'): (1, 0)},
+        'key1_block_offsets': {'DIST': (0, 0), 'BOARDS': (1, 0)}
+    }
+    skim_data = [data.astype(np.float16).reshape(data.shape + (1,)),
+                 (data % 4).astype(np.int8).reshape(data.shape + (1,))]
+
+    skim_dict = skim.SkimDict(skim_data, skim_info)
+    stack = skim.SkimStack(skim_dict)
+
+    # lookups are upcast so expression arithmetic doesn't overflow
+    dist = skim_dict.get('DIST').get([1, 9], [2, 3])
+    assert dist.dtype == np.float32
+    npt.assert_array_equal(dist, [12, 93])
+
+    boards = stack.lookup(np.array([1, 9]), np.array([2, 3]), np.array(['AM', 'AM']), 'BOARDS')
+    assert boards.dtype == np.float32
+    npt.assert_array_equal(boards * 100, [0, 100])
@@ -184,3 +184,73 @@ def test_basic(persons, tdd_alts):
     ends = pd.Series([10, 10, 10, 9])
     periods_available = timetable.remaining_periods_available(person_ids, starts, ends)
     pdt.assert_series_equal(periods_available, pd.Series([6, 3, 4, 3]))
+
+
+def test_packed_windows(persons, tdd_alts):
+
+    # packed and unpacked timetables should agree for random schedules (and subtour masks)
+    rng = np.random.RandomState(0)
+
+    num_persons = len(persons.index)
+    num_alts = len(tdd_alts.index)
+
+    person_windows = tt.create_timetable_windows(persons, tdd_alts)
+    packed = tt.TimeTable(person_windows, tdd_alts, 'person_windows')
+    unpacked = tt.TimeTable(person_windows.copy(), tdd_alts, 'person_windows')
+    unpacked.packed = False
+    assert packed.packed
+
+    for i in range(3):
+
+        tdds = pd.Series(rng.randint(num_alts, size=num_persons))
+        person_ids = pd.Series(range(num_persons))
+        available = packed.tour_available(person_ids, tdds)
+        pdt.assert_series_equal(available, unpacked.tour_available(person_ids, tdds))
+        packed.assign(person_ids[available], tdds[available])
+        unpacked.assign(person_ids[available], tdds[available])
+        assert (packed.windows == unpacked.windows).all()
+
+        person_ids = pd.Series(np.repeat(range(num_persons), num_alts))
+        tdds = pd.Series(list(range(num_alts)) * num_persons)
+        pdt.assert_series_equal(packed.tour_available(person_ids, tdds),
+                                unpacked.tour_available(person_ids, tdds))
+
+        periods = pd.Series(tdd_alts.start.values[tdds])
+        for method in ['previous_tour_ends', 'previous_tour_begins',
+                       'adjacent_window_before', 'adjacent_window_after']:
+            pdt.assert_series_equal(getattr(packed, method)(person_ids, periods),
+                                    getattr(unpacked, method)(person_ids, periods))
+
+        starts = pd.Series(tdd_alts.start.values[tdds])
+        ends = pd.Series(tdd_alts.end.values[tdds])
+        pdt.assert_series_equal(packed.remaining_periods_available(person_ids, starts, ends),
+                                unpacked.remaining_periods_available(person_ids, starts, ends))
+
+        if i == 1:
+            tdds = pd.Series(rng.randint(num_alts, size=num_persons))
+            person_ids = pd.Series(range(num_persons))
+            packed.assign_subtour_mask(person_ids, tdds)
+            unpacked.assign_subtour_mask(person_ids, tdds)
+
+
+def test_available_tdds(persons, tdd_alts):
+
+    person_windows = tt.create_timetable_windows(persons, tdd_alts)
+    timetable = tt.TimeTable(person_windows, tdd_alts, 'person_windows')
+
+    timetable.assign(pd.Series([0, 1, 2, 3]), pd.Series([0, 1, 2, 15]))
+
+    # duplicate and identical (empty) windows
+    person_ids = pd.Series([5, 0, 1, 4, 2, 0, 3])
+    tdds = pd.Series(tdd_alts.index[::-1])
+
+    for packed in [True, False]:
+        timetable.packed = packed
+        row_ixs, tdd_ixs = timetable.available_tdds(person_ids, tdds)
+
+        all_row_ixs = np.repeat(np.arange(len(person_ids)), len(tdds))
+        all_tdd_ixs = np.tile(np.arange(len(tdds)), len(person_ids))
+        available = timetable.tour_available(person_ids.iloc[all_row_ixs], tdds.iloc[all_tdd_ixs]).values
+
+        np.testing.assert_array_equal(row_ixs, all_row_ixs[available])
+        np.testing.assert_array_equal(tdd_ixs, all_tdd_ixs[available])
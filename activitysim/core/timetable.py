@@ -40,6 +40,18 @@ COLLISIONS = [
 
 COLLISION_LIST = [a + (b << I_BIT_SHIFT) for a, b in COLLISIONS]
 
+# packed windows
+# timetables with no more than MAX_PACKED_PERIODS periods (including padding) also keep each
+# window row packed into one uint64 word for each of the three time_window state bits, with one
+# bit per period. Since assigning a tour is a bitwise_or of state codes, assignment is a bitwise_or
+# of the packed words, and testing a row for collisions with a tdd alt's footprint is a handful of
+# bitwise ops on the words instead of a test of every period.
+MAX_PACKED_PERIODS = 64
+STATE_BITS = [0x1, 0x2, 0x4]
+P_MIDDLE, P_START, P_END = range(len(STATE_BITS))
+
+ONE = np.uint64(1)
+
 
 # str versions of time windows period states
 C_EMPTY = str(I_EMPTY)
@@ -49,6 +61,58 @@ C_MIDDLE = str(I_MIDDLE)
 C_START_END = str(I_START_END)
 
 
+def pack_periods(a):
+    """
+    pack (n_rows, n_periods) array of bools into uint64 array of n_rows with one bit per period
+    """
+
+    assert a.shape[1] <= MAX_PACKED_PERIODS
+
+    # packbits puts the first bit in the high bit of the first byte (and bitorder='little' needs
+    # numpy >= 1.17), so pack periods in reverse order into a big-endian word to put period i in bit i
+    bits = np.zeros((a.shape[0], MAX_PACKED_PERIODS), dtype=bool)
+    bits[:, MAX_PACKED_PERIODS - a.shape[1]:] = a[:, ::-1]
+    packed = np.packbits(bits, axis=1)
+
+    return packed.view('>u8')[:, 0].astype(np.uint64)
+
+
+def pack_states(windows):
+    """
+    pack (n_rows, n_periods) array of time_window states into (n_rows, 3) uint64 array
+    with a packed word for each of the state bits in STATE_BITS
+    """
+
+    return np.column_stack([pack_periods(np.bitwise_and(windows, bit) != 0) for bit in STATE_BITS])
+
+
+def collision_masks(packed):
+    """
+    return (middle, occupied, start_only, end_only) period masks for packed window states
+
+    a footprint and a window collide in a period if either is I_MIDDLE and the other is occupied,
+    or if both are I_START or both are I_END (see COLLISIONS)
+    """
+
+    middle = packed[:, P_MIDDLE]
+    start = packed[:, P_START]
+    end = packed[:, P_END]
+
+    return middle, start | end, start & ~end, end & ~start
+
+
+def popcount(x):
+    """
+    number of bits set in each element of uint64 array
+    """
+
+    x = x - ((x >> ONE) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
 def tour_map(persons, tours, tdd_alts, persons_id_col='person_id'):
 
     sigil = {
@@ -216,6 +280,27 @@ class TimeTable(object):
         assert (tdd_alts_df.index == list(range(tdd_alts_df.shape[0]))).all()
         self.tdd_footprints = np.asanyarray([list(r) for r in w_strings]).astype(int)
 
+        # - packed windows and tdd_alt footprint collision masks (if windows are narrow enough)
+        self.packed = len(int_time_periods) <= MAX_PACKED_PERIODS
+        if self.packed:
+            self.tdd_collision_masks = collision_masks(pack_states(self.tdd_footprints))
+            # padding periods at both ends of day are never available
+            self.padding_mask = ONE | (ONE << np.uint64(len(int_time_periods) - 1))
+        self.pack_windows()
+
+    def pack_windows(self, row_ixs=None):
+        """
+        update packed windows (all rows, or only row_ixs) from self.windows
+        """
+
+        if not self.packed:
+            return
+
+        if row_ixs is None:
+            self.packed_windows = pack_states(self.windows)
+        else:
+            self.packed_windows[row_ixs] = pack_states(self.windows[row_ixs])
+
     def begin_transaction(self, transaction_loggers):
         """
         begin a transaction for an estimator or list of estimators
@@ -236,6 +321,7 @@ class TimeTable(object):
             logger.log("timetable.rollback %s" % self.windows_table_name)
         self.windows_df = self.checkpoint_df
         self.windows = self.windows_df.values
+        self.pack_windows()
         self.checkpoint_df = None
         self.transaction_loggers = None
 
@@ -249,6 +335,15 @@ class TimeTable(object):
 
         return windows
 
+    def slice_packed_windows_by_row_id(self, window_row_ids):
+        """
+        return packed windows array slice containing rows for specified window_row_ids
+        (in window_row_ids order)
+        """
+        row_ixs = window_row_ids.map(self.window_row_ix).values
+
+        return self.packed_windows[row_ixs]
+
     def slice_windows_by_row_id_and_period(self, window_row_ids, periods):
 
         # row ixs of tour_df group rows in windows
@@ -291,6 +386,40 @@ class TimeTable(object):
         # do not write through to pandas dataframe
         pipeline.replace_table(self.windows_table_name, self.get_windows_df())
 
+    def sliced_windows_available(self, windows, tdd_ixs):
+        """
+        test whether windows allow tours with corresponding tdd alts' time windows
+
+        Parameters
+        ----------
+        windows : numpy array
+            windows rows (packed windows rows if self.packed) one per tdd_ix
+        tdd_ixs : numpy array of int
+            tdd_alt ids
+
+        Returns
+        -------
+        available : numpy array of bool
+        """
+
+        if self.packed:
+            footprint_middle, footprint_occupied, footprint_start, footprint_end = \
+                [mask[tdd_ixs] for mask in self.tdd_collision_masks]
+            window_middle, window_occupied, window_start, window_end = collision_masks(windows)
+
+            collisions = \
+                (footprint_middle & window_occupied) | (window_middle & footprint_occupied) | \
+                (footprint_start & window_start) | (footprint_end & window_end)
+
+            return collisions == 0
+
+        # numpy array with one tdd_footprints_df row for tdds
+        tour_footprints = self.tdd_footprints[tdd_ixs]
+
+        x = tour_footprints + (windows << I_BIT_SHIFT)
+
+        return ~np.isin(x, COLLISION_LIST).any(axis=1)
+
     def tour_available(self, window_row_ids, tdds):
         """
         test whether time window allows tour with specific tdd alt's time window
@@ -310,21 +439,69 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(tdds)
 
-        # numpy array with one tdd_footprints_df row for tdds
-        tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
-
         # numpy array with one windows row for each person
-        windows = self.slice_windows_by_row_id(window_row_ids)
+        if self.packed:
+            windows = self.slice_packed_windows_by_row_id(window_row_ids)
+        else:
+            windows = self.slice_windows_by_row_id(window_row_ids)
 
         # t0 = tracing.print_elapsed_time("slice_windows_by_row_id", t0, debug=True)
 
-        x = tour_footprints + (windows << I_BIT_SHIFT)
-
-        available = ~np.isin(x, COLLISION_LIST).any(axis=1)
+        available = self.sliced_windows_available(windows, tdds.values.astype(int))
         available = pd.Series(available, index=window_row_ids.index)
 
         return available
 
+    def available_tdds(self, window_row_ids, tdds):
+        """
+        enumerate the available (window_row_id, tdd) pairs without testing every pair
+
+        Each distinct window (e.g. the empty windows of persons with nothing scheduled yet)
+        is only tested against the tdd alts once.
+
+        Parameters
+        ----------
+        window_row_ids : pandas Series
+            series of window_row_ids (e.g. one per tour)
+        tdds : pandas series
+            series of tdd_alt ids to test, index irrelevant
+
+        Returns
+        -------
+        row_ixs : numpy array of int
+            ordinal positions in window_row_ids of available pairs
+        tdd_ixs : numpy array of int
+            ordinal positions in tdds of available pairs
+            (grouped by row_ix in window_row_ids order, and in tdds order within each row)
+        """
+
+        if self.packed:
+            windows = self.slice_packed_windows_by_row_id(window_row_ids)
+        else:
+            windows = self.slice_windows_by_row_id(window_row_ids)
+
+        distinct_windows, window_distinct_ixs = np.unique(windows, axis=0, return_inverse=True)
+        window_distinct_ixs = window_distinct_ixs.ravel()
+
+        # (num_distinct_windows, num_tdds) availability of every tdd alt in every distinct window
+        num_distinct, num_tdds = len(distinct_windows), len(tdds)
+        available = self.sliced_windows_available(
+            np.repeat(distinct_windows, num_tdds, axis=0),
+            np.tile(tdds.values.astype(int), num_distinct)).reshape(num_distinct, num_tdds)
+
+        # available tdd positions of each distinct window, concatenated in distinct window order
+        distinct_tdd_ixs = np.nonzero(available)[1]
+        distinct_counts = available.sum(axis=1)
+        distinct_offsets = np.cumsum(distinct_counts) - distinct_counts
+
+        # expand to available tdd positions of each window row
+        row_counts = distinct_counts[window_distinct_ixs]
+        row_ixs = np.repeat(np.arange(len(window_distinct_ixs)), row_counts)
+        nth_available = np.arange(row_counts.sum()) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+        tdd_ixs = distinct_tdd_ixs[distinct_offsets[window_distinct_ixs][row_ixs] + nth_available]
+
+        return row_ixs, tdd_ixs
+
     def assign(self, window_row_ids, tdds):
         """
         Assign tours (represented by tdd alt ids) to persons
@@ -352,6 +529,7 @@ class TimeTable(object):
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
         self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], tour_footprints)
+        self.pack_windows(row_ixs)
 
     def assign_subtour_mask(self, window_row_ids, tdds):
         """
@@ -389,6 +567,7 @@ class TimeTable(object):
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
         self.windows[row_ixs] = (tour_footprints == 0) * I_MIDDLE
+        self.pack_windows()
 
     def assign_footprints(self, window_row_ids, footprints):
         """
@@ -417,6 +596,7 @@ class TimeTable(object):
         row_ixs = window_row_ids.map(self.window_row_ix).values
 
         self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], footprints)
+        self.pack_windows(row_ixs)
 
     def pairwise_available(self, window1_row_ids, window2_row_ids):
 
@@ -449,6 +629,28 @@ class TimeTable(object):
 
         time_col_ixs = periods.map(self.time_ix).values
 
+        if self.packed:
+            # bits set for periods that are unavailable (in the middle of a tour, or padding)
+            unavailable = \
+                self.slice_packed_windows_by_row_id(window_row_ids)[:, P_MIDDLE] | self.padding_mask
+            time_bits = ONE << time_col_ixs.astype(np.uint64)
+
+            if before:
+                # index of last unavailable window before time (smear highest bit down and count)
+                x = unavailable & (time_bits - ONE)
+                for shift in [1, 2, 4, 8, 16, 32]:
+                    x |= x >> np.uint64(shift)
+                first_unavailable = np.maximum(popcount(x) - 1, 0)
+                available_run_length = time_col_ixs - first_unavailable - 1
+            else:
+                # index of first unavailable window after time (count bits below lowest set bit)
+                x = unavailable & ~((time_bits << ONE) - ONE)
+                first_unavailable = \
+                    np.minimum(popcount((x & (~x + ONE)) - ONE), len(self.time_ix))
+                available_run_length = first_unavailable - time_col_ixs - 1
+
+            return pd.Series(available_run_length, index=window_row_ids.index)
+
         # sliced windows with 1s where windows state is I_MIDDLE and 0s elsewhere
         available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE) * 1
 
@@ -546,7 +748,16 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(periods)
 
-        window = self.slice_windows_by_row_id_and_period(window_row_ids, periods)
+        if self.packed:
+            # reassemble period states from their packed state bits
+            time_col_ixs = periods.map(self.time_ix).values.astype(np.uint64)
+            packed_windows = self.slice_packed_windows_by_row_id(window_row_ids)
+            window = np.zeros(len(window_row_ids), dtype=np.uint64)
+            for p, bit in enumerate(STATE_BITS):
+                window |= ((packed_windows[:, p] >> time_col_ixs) & ONE) * np.uint64(bit)
+            window = window.astype(np.int64)
+        else:
+            window = self.slice_windows_by_row_id_and_period(window_row_ids, periods)
 
         return pd.Series(np.isin(window, states), window_row_ids.index)
 
@@ -620,7 +831,11 @@ class TimeTable(object):
         assert len(window_row_ids) == len(starts)
         assert len(window_row_ids) == len(ends)
 
-        available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE).sum(axis=1)
+        if self.packed:
+            middle = self.slice_packed_windows_by_row_id(window_row_ids)[:, P_MIDDLE]
+            available = len(self.time_ix) - popcount(middle)
+        else:
+            available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE).sum(axis=1)
 
         # don't count time window padding at both ends of day
         available -= 2